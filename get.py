@@ -14,14 +14,255 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import os
+import re
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import atexit
+import hashlib
+import json
+import httplib
+import urllib2
+import tarfile
+import urlparse
+import posixpath
+import tempfile
+import argparse
+import threading
+import contextlib
+import traceback
+import subprocess
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 from packman import logger
 from packman.packman import get_package_config as get_conf
 from packman import utils
 from packman import python
-from packman import retrieve
 
 lgr = logger.init()
 
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_BLOCK_SIZE = 65536
+# pip's cache of downloaded and built wheels, shared by all packages.
+PIP_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'cloudify-packager', 'pip')
+
+# agent -> the config of its package.
+AGENTS = collections.OrderedDict([
+    ('ubuntu-precise', 'Ubuntu-precise-agent'),
+    ('ubuntu-trusty', 'Ubuntu-trusty-agent'),
+    ('centos-final', 'centos-Final-agent'),
+    ('debian-jessie', 'debian-jessie-agent'),
+])
+
+
+class _HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class _HeadRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Follows redirects of HEAD requests with HEAD requests
+
+    urllib2 would otherwise turn them into GET requests. (get-cloudify.py
+    has its own, as it's downloaded and run on its own.)
+    """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_req = urllib2.HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+        if new_req is not None and req.get_method() == 'HEAD':
+            new_req = _HeadRequest(new_req.get_full_url(),
+                                   headers=new_req.headers,
+                                   origin_req_host=req.get_origin_req_host(),
+                                   unverifiable=True)
+        return new_req
+
+
+_etags = {}
+
+
+def _resolve_etag(url):
+    """Returns the ETag of the resource a url redirects to, or None
+
+    ETags are resolved once per process.
+    """
+    if url in _etags:
+        return _etags[url]
+    opener = urllib2.build_opener(_HeadRedirectHandler)
+    try:
+        response = opener.open(_HeadRequest(url), timeout=DOWNLOAD_TIMEOUT)
+    except (IOError, httplib.HTTPException) as ex:
+        lgr.debug('Could not resolve the ETag of {0} ({1})'.format(url, ex))
+        return None
+    try:
+        _etags[url] = response.info().getheader('etag')
+        return _etags[url]
+    finally:
+        response.close()
+
+
+class _TeeReader(object):
+    """Reads a file, writing whatever is read to another file
+    """
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+    def read(self, size=-1):
+        data = self.source.read(size) if size >= 0 else self.source.read()
+        self.destination.write(data)
+        return data
+
+
+def _extract(archive_path, extract_dir):
+    with contextlib.closing(tarfile.open(archive_path)) as archive:
+        archive.extractall(extract_dir)
+
+
+def _move_into(source_dir, destination_dir):
+    """Moves the contents of a directory into another, merging the
+    directories they both have
+    """
+    for name in os.listdir(source_dir):
+        source = os.path.join(source_dir, name)
+        destination = os.path.join(destination_dir, name)
+        try:
+            os.rename(source, destination)
+        except OSError as ex:
+            # the destination has the directory (a concurrent extraction
+            # may have just moved it there).
+            if ex.errno not in (errno.EEXIST, errno.ENOTEMPTY) or \
+                    os.path.islink(source) or not os.path.isdir(source):
+                raise
+            _move_into(source, destination)
+
+
+@contextlib.contextmanager
+def _staged_extraction(extract_dir):
+    """Yields a temporary directory to extract an archive into, whose
+    contents are moved into `extract_dir` once extracting succeeds
+
+    Archives extracted concurrently into the same directory are thus each
+    extracted in a directory of their own, and a failed extraction leaves
+    nothing behind.
+    """
+    if not extract_dir:
+        yield None
+        return
+    staging_dir = tempfile.mkdtemp(prefix='.extract-', dir=extract_dir)
+    try:
+        yield staging_dir
+        _move_into(staging_dir, extract_dir)
+    finally:
+        shutil.rmtree(staging_dir, True)
+
+
+def _download(url, path, extract_dir=None):
+    """Downloads a url to `path`, extracting it (as a tar archive) into
+    `extract_dir` while it streams in
+    """
+    response = urllib2.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        length = response.info().getheader('content-length', '')
+        with open(path, 'wb') as f:
+            if extract_dir:
+                with contextlib.closing(tarfile.open(
+                        fileobj=_TeeReader(response, f), mode='r|*')) \
+                        as archive:
+                    archive.extractall(extract_dir)
+            # whatever follows the end of the archive (e.g. padding).
+            shutil.copyfileobj(response, f, DOWNLOAD_BLOCK_SIZE)
+    finally:
+        response.close()
+    if length.isdigit() and os.path.getsize(path) != int(length):
+        raise IOError('Downloaded {0} bytes of {1} instead of {2}'.format(
+            os.path.getsize(path), url, length))
+
+
+class SourceFetcher(object):
+    """Fetches each unique source of a build once
+
+    Sources are keyed by their url and the ETag it resolves to. The first
+    fetch of a source downloads it into `cache_dir`, and every fetch hands
+    out a hard link to it (or a copy, across file systems). Fetches of a
+    source are locked, so that processes sharing `cache_dir` download it
+    once between them.
+
+    Sources fetched with an `extract_dir` are extracted into it (see
+    _staged_extraction). The first fetch extracts the source while it's
+    being downloaded.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.downloaded_bytes = 0
+        self.deduplicated_bytes = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, url, destination, extract_dir=None):
+        key = hashlib.sha256('{0} {1}'.format(
+            url, _resolve_etag(url) or '')).hexdigest()
+        path = os.path.join(self.cache_dir, key)
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        with open('{0}.lock'.format(path), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fetched = os.path.isfile(path)
+            if fetched:
+                lgr.info('{0} was already fetched by this build.'.format(url))
+            else:
+                lgr.info('Downloading {0}...'.format(url))
+                try:
+                    with _staged_extraction(extract_dir) as staging_dir:
+                        _download(url, path + '.part', staging_dir)
+                except Exception:
+                    if os.path.isfile(path + '.part'):
+                        os.remove(path + '.part')
+                    raise
+                os.rename(path + '.part', path)
+        with self._lock:
+            if fetched:
+                self.deduplicated_bytes += os.path.getsize(path)
+            else:
+                self.downloaded_bytes += os.path.getsize(path)
+        if os.path.lexists(destination):
+            os.remove(destination)
+        try:
+            os.link(path, destination)
+        except OSError:
+            shutil.copyfile(path, destination)
+        if fetched and extract_dir:
+            with _staged_extraction(extract_dir) as staging_dir:
+                _extract(destination, staging_dir)
+
+    def report(self):
+        lgr.info('Downloaded {0} bytes of sources, deduplicated {1} '
+                 'bytes.'.format(self.downloaded_bytes,
+                                 self.deduplicated_bytes))
+
+
+_fetcher = None
+
+
+def _get_fetcher():
+    """Returns the build's fetcher
+
+    Unless build_agents sets it, a build is the current process.
+    """
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = SourceFetcher(tempfile.mkdtemp(prefix='cloudify-sources-'))
+        atexit.register(shutil.rmtree, _fetcher.cache_dir, True)
+        atexit.register(_fetcher.report)
+    return _fetcher
+
 
 def _prepare(package):
 
@@ -31,84 +272,428 @@ def _prepare(package):
     common.mkdir(package['package_path'])
 
 
-def create_agent(package, download=False):
-    dl_handler = retrieve.Handler()
-    common = utils.Handler()
+def fetch_sources(package):
+    """Fetches a package's sources concurrently, each to an archive of its
+    own, and extracts them into its sources path while they stream in
+
+    Returns the paths of the archives.
+    """
+    archives = ['{0}/archives/{1}-{2}'.format(
+        package['sources_path'], index,
+        posixpath.basename(urlparse.urlparse(url).path) or 'source')
+        for index, url in enumerate(package['source_urls'])]
+    if not archives:
+        return archives
+    fetcher = _get_fetcher()
+
+    def fetch(source):
+        url, archive = source
+        fetcher.fetch(url, archive, package['sources_path'])
+    pool = ThreadPool(len(archives))
+    try:
+        pool.map(fetch, zip(package['source_urls'], archives))
+    finally:
+        pool.close()
+        pool.join()
+    return archives
+
+
+def _fingerprint(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True)).hexdigest()
+
+
+class BuildManifest(object):
+    """Records the steps of a package's build and their fingerprints
+
+    The manifest is kept beside the package's sources path rather than in
+    it, as the sources path is what gets packaged. With `force`, previous
+    builds are disregarded.
+    """
+    def __init__(self, sources_path, force=False):
+        self.path = '{0}.build.json'.format(sources_path.rstrip('/'))
+        self.steps = {}
+        if not force:
+            try:
+                with open(self.path) as f:
+                    self.steps = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+    def matches(self, step, fingerprint):
+        return fingerprint is not None and \
+            self.steps.get(step) == fingerprint
+
+    def update(self, step, fingerprint):
+        self.steps[step] = fingerprint
+        self._write()
+
+    def clear(self):
+        self.steps = {}
+        self._write()
+
+    def _write(self):
+        temp_path = '{0}.tmp'.format(self.path)
+        with open(temp_path, 'w') as f:
+            json.dump(self.steps, f, indent=2, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+
+def _fingerprint_sources(urls):
+    """Returns the fingerprint of sources, or None if any of them can't be
+    told apart from an updated version (having no ETag)
+    """
+    etags = [_resolve_etag(url) for url in urls]
+    if None in etags:
+        return None
+    return _fingerprint(zip(urls, etags))
+
+
+def _get_modules(package):
+    """Returns the modules of a package
+
+    Package configs list them under `python_modules` (older ones, under
+    `modules`).
+    """
+    for key in ('python_modules', 'modules'):
+        if key in package:
+            return package[key]
+    return []
+
+
+def build_package(package, fetch=True, install=True, force=False):
+    """Builds a package's virtualenv: creates it, fetches the package's
+    sources into it and installs its modules
+
+    Builds are incremental (see BuildManifest). The virtualenv is only
+    rebuilt if the package's config or sources changed, if any of its
+    modules were removed or if it's gone (the manifest outliving it), and
+    only modules which weren't installed yet are installed. With `force`,
+    the package is rebuilt.
+    """
     py_handler = python.Handler()
-    _prepare(package)
-    py_handler.make_venv(package['sources_path'])
-    if download:
-        tar_file = '{0}/{1}.tar.gz'.format(
-            package['sources_path'], package['name'])
-        for url in package['source_urls']:
-            dl_handler.download(url, file=tar_file)
-        common.untar(package['sources_path'], tar_file)
-        for module in package['modules']:
-            py_handler.pip(module, package['sources_path'])
+    manifest = BuildManifest(package['sources_path'], force)
+    modules = _get_modules(package) if install else []
+    config = _fingerprint(dict(
+        (key, value) for key, value in package.items()
+        if key not in ('source_urls', 'modules', 'python_modules')))
+    sources = _fingerprint_sources(package['source_urls']) if fetch \
+        else _fingerprint([])
+    installed = manifest.steps.get('modules', [])
+
+    if manifest.matches('config', config) and \
+            manifest.matches('sources', sources) and \
+            set(installed) <= set(modules) and \
+            os.path.isfile(os.path.join(
+                package['sources_path'], 'bin', 'python')):
+        lgr.info('The virtualenv and sources of {0} are up to date.'.format(
+            package['name']))
+    else:
+        _prepare(package)
+        manifest.clear()
+        installed = []
+        py_handler.make_venv(package['sources_path'])
+        manifest.update('config', config)
+        if fetch:
+            fetch_sources(package)
+        manifest.update('sources', sources)
+
+    pending = [module for module in modules if module not in installed]
+    if len(pending) < len(modules):
+        lgr.info('{0} of the modules of {1} are already installed.'.format(
+            len(modules) - len(pending), package['name']))
+    if pending:
+        install_modules(pending, package['sources_path'])
+        manifest.update('modules', installed + pending)
+
+
+def _get_pins(modules):
+    """Returns the modules pinned to a version (e.g. `celery==3.1.17`)
+    """
+    return [module for module in modules
+            if re.match(r'^[A-Za-z0-9_.\-]+==[^=<>!~,;]+$', module)]
+
+
+def install_modules(modules, venv_path, cache_dir=PIP_CACHE_DIR):
+    """Installs modules into a virtualenv in a single pip run
+
+    The modules are resolved together from a generated requirements file,
+    constrained by a generated constraints file pinning those of them
+    which are pinned, so that they're pinned as the dependencies of the
+    others as well. Downloaded and built wheels are cached in `cache_dir`.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        requirements_path = os.path.join(tempdir, 'requirements.txt')
+        constraints_path = os.path.join(tempdir, 'constraints.txt')
+        with open(requirements_path, 'w') as f:
+            f.write(''.join('{0}\n'.format(module) for module in modules))
+        with open(constraints_path, 'w') as f:
+            f.write(''.join('{0}\n'.format(pin)
+                            for pin in _get_pins(modules)))
+        lgr.info('Installing {0} modules into {1}...'.format(
+            len(modules), venv_path))
+        subprocess.check_call([
+            os.path.join(venv_path, 'bin', 'pip'), 'install',
+            '-r', requirements_path, '-c', constraints_path,
+            '--cache-dir', cache_dir])
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def time_module_installs(package):
+    """Times installing a package's modules one by one, as packman does,
+    and in a single batch (see install_modules)
+
+    Each of them installs into a new virtualenv with a cold pip cache. The
+    package's sources (which modules may be installed from) are fetched
+    to a temporary directory. Returns the seconds each of them took.
+    """
+    py_handler = python.Handler()
+    tempdir = tempfile.mkdtemp()
+    try:
+        package = dict(package, package_path=os.path.join(tempdir, 'package'))
+        _relocate_sources(package, os.path.join(tempdir, 'sources'))
+        build_package(package, fetch=True, install=False, force=True)
+
+        def per_module(venv_path):
+            for module in _get_modules(package):
+                py_handler.pip(module, venv_path)
+
+        def batched(venv_path):
+            install_modules(_get_modules(package), venv_path,
+                            cache_dir=os.environ['PIP_CACHE_DIR'])
 
+        timings = collections.OrderedDict()
+        environ = dict(os.environ)
+        try:
+            for name, install in (('per-module', per_module),
+                                  ('batched', batched)):
+                venv_path = os.path.join(tempdir, name)
+                py_handler.make_venv(venv_path)
+                os.environ['PIP_CACHE_DIR'] = os.path.join(
+                    tempdir, '{0}-cache'.format(name))
+                start = time.time()
+                install(venv_path)
+                timings[name] = time.time() - start
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        return timings
+    finally:
+        shutil.rmtree(tempdir)
 
-def get_ubuntu_precise_agent(download=False):
-    package = get_conf('Ubuntu-precise-agent')
-    create_agent(package, download)
 
+def create_agent(package, download=False, force=False):
+    build_package(package, fetch=download, install=download, force=force)
 
-def get_ubuntu_trusty_agent(download=False):
-    package = get_conf('Ubuntu-trusty-agent')
-    create_agent(package, download)
 
+def get_ubuntu_precise_agent(download=False, force=False):
+    package = get_conf(AGENTS['ubuntu-precise'])
+    create_agent(package, download, force)
 
-def get_centos_final_agent(download=False):
-    package = get_conf('centos-Final-agent')
-    create_agent(package, download)
 
+def get_ubuntu_trusty_agent(download=False, force=False):
+    package = get_conf(AGENTS['ubuntu-trusty'])
+    create_agent(package, download, force)
 
-def get_debian_jessie_agent(download=False):
-    package = get_conf('debian-jessie-agent')
-    create_agent(package, download)
 
+def get_centos_final_agent(download=False, force=False):
+    package = get_conf(AGENTS['centos-final'])
+    create_agent(package, download, force)
 
-def get_celery(download=False):
+
+def get_debian_jessie_agent(download=False, force=False):
+    package = get_conf(AGENTS['debian-jessie'])
+    create_agent(package, download, force)
+
+
+def _isolate_sources(packages, sources_root=None):
+    """Gives the agents' packages sources paths of their own
+
+    Agents sharing a sources path (e.g. both Ubuntu agents) would otherwise
+    overwrite each other's virtualenv, so each of them gets its name
+    appended to it. With `sources_root`, all agents are built under it
+    instead. Modules installed from within the sources path are moved
+    along with it.
+    """
+    shared = collections.Counter(
+        package['sources_path'] for package in packages.values())
+    for agent, package in packages.items():
+        if sources_root:
+            _relocate_sources(
+                package, os.path.join(sources_root, agent, 'env'))
+        elif shared[package['sources_path']] > 1:
+            _relocate_sources(package, '{0}-{1}'.format(
+                package['sources_path'].rstrip('/'), agent))
+
+
+def _relocate_sources(package, sources_path):
+    """Moves a package's sources path, along with the modules installed
+    from within it
+    """
+    original_path = package['sources_path'].rstrip('/')
+    package['sources_path'] = sources_path
+    for key in ('modules', 'python_modules'):
+        if key in package:
+            package[key] = [
+                sources_path + module[len(original_path):]
+                if module.startswith(original_path + '/') else module
+                for module in package[key]]
+
+
+def _get_agent_packages(agents, sources_root=None):
+    packages = collections.OrderedDict(
+        (agent, get_conf(AGENTS[agent])) for agent in agents)
+    _isolate_sources(packages, sources_root)
+    return packages
+
+
+def _build_agent(args):
+    """Builds an agent in a worker process, logging to its own file
+    """
+    global _fetcher
+    agent, package, download, force, log_path, fetch_dir = args
+    _fetcher = SourceFetcher(fetch_dir)
+    # subprocesses (e.g. pip) inherit the redirection as well.
+    with open(log_path, 'a') as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    start = time.time()
+    try:
+        create_agent(package, download, force)
+        code = 0
+    except SystemExit as ex:
+        code = ex.code if isinstance(ex.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    _fetcher.report()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return agent, code, time.time() - start, \
+        _fetcher.downloaded_bytes, _fetcher.deduplicated_bytes
+
+
+def build_agents(agents, download=False, jobs=None, log_dir='.',
+                 sources_root=None, force=False):
+    """Builds agents concurrently, each in a worker process of its own
+
+    Up to `jobs` agents (defaults to all of them) are built at once, each
+    logging to `<log_dir>/<agent>.log`. Sources are fetched once for all
+    agents (see SourceFetcher). Returns the exit code of each agent's
+    build, in the order of `agents`.
+    """
+    packages = _get_agent_packages(agents, sources_root)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    fetch_dir = tempfile.mkdtemp(prefix='cloudify-sources-')
+    tasks = [(agent, package, download, force,
+              os.path.join(log_dir, '{0}.log'.format(agent)), fetch_dir)
+             for agent, package in packages.items()]
+    jobs = min(jobs or len(tasks), len(tasks))
+    lgr.info('Building {0} agents, {1} at a time...'.format(
+        len(tasks), jobs))
+
+    start = time.time()
+    codes = {}
+    fetcher = SourceFetcher(fetch_dir)
+    # a worker process per agent, so that agents don't share any state
+    # other than fetched sources.
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        for agent, code, duration, downloaded, deduplicated in \
+                pool.imap_unordered(_build_agent, tasks):
+            codes[agent] = code
+            fetcher.downloaded_bytes += downloaded
+            fetcher.deduplicated_bytes += deduplicated
+            if code == 0:
+                lgr.info('Built {0} in {1:.1f}s.'.format(agent, duration))
+            else:
+                lgr.error('Building {0} failed with exit code {1} after '
+                          '{2:.1f}s (see {3}).'.format(
+                              agent, code, duration, os.path.join(
+                                  log_dir, '{0}.log'.format(agent))))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(fetch_dir, True)
+    lgr.info('Built {0} of {1} agents in {2:.1f}s.'.format(
+        codes.values().count(0), len(tasks), time.time() - start))
+    fetcher.report()
+    return collections.OrderedDict(
+        (agent, codes[agent]) for agent in packages)
+
+
+def get_celery(download=False, force=False):
     package = get_conf('celery')
+    build_package(package, fetch=True, install=download, force=force)
 
-    dl_handler = retrieve.Handler()
-    common = utils.Handler()
-    py_handler = python.Handler()
-    _prepare(package)
-    py_handler.make_venv(package['sources_path'])
-    tar_file = '{0}/{1}.tar.gz'.format(
-        package['sources_path'], package['name'])
-    for url in package['source_urls']:
-        dl_handler.download(url, file=tar_file)
-    common.untar(package['sources_path'], tar_file)
-    if download:
-        for module in package['modules']:
-            py_handler.pip(module, package['sources_path'])
-
-
-def get_manager(download=False):
+
+def get_manager(download=False, force=False):
     package = get_conf('manager')
+    build_package(package, fetch=True, install=download, force=force)
 
-    dl_handler = retrieve.Handler()
     common = utils.Handler()
-    py_handler = python.Handler()
-    _prepare(package)
-    py_handler.make_venv(package['sources_path'])
-    tar_file = '{0}/{1}.tar.gz'.format(
-        package['sources_path'], package['name'])
-    for url in package['source_urls']:
-        dl_handler.download(url, file=tar_file)
-    common.untar(package['sources_path'], tar_file)
-
     common.mkdir(package['file_server_dir'])
     common.cp(package['resources_path'], package['file_server_dir'])
-    if download:
-        for module in package['modules']:
-            py_handler.pip(module, package['sources_path'])
 
 
-def main():
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Builds Cloudify agents concurrently.')
+    parser.add_argument(
+        'agents', nargs='*', metavar='AGENT',
+        help='Agents to build: {0} or all.'.format(', '.join(AGENTS)))
+    parser.add_argument(
+        '--download', action='store_true',
+        help='Download the agents\' sources and install their modules.')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Rebuild the agents from scratch, rather than only the steps '
+             'whose inputs changed since their last build.')
+    parser.add_argument(
+        '--compareinstalls', action='store_true',
+        help='Rather than build the agents, compare the time installing '
+             'their modules one by one takes with installing them in a '
+             'single batch.')
+    parser.add_argument(
+        '--jobs', type=int,
+        help='Number of agents to build concurrently (defaults to all).')
+    parser.add_argument(
+        '--logdir', default='.',
+        help='Directory to write the logs of the agents to.')
+    parser.add_argument(
+        '--sourcesroot',
+        help='Directory to build the agents\' virtualenvs under, rather '
+             'than their configured sources paths.')
+    args = parser.parse_args(args)
+    if 'all' in args.agents:
+        args.agents = list(AGENTS)
+    unknown = [agent for agent in args.agents if agent not in AGENTS]
+    if unknown:
+        parser.error('Unknown agents: {0}'.format(', '.join(unknown)))
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+    return args
+
 
-    lgr.debug('VALIDATED!')
+def main(args=None):
+    args = parse_args(args)
+    if not args.agents:
+        lgr.debug('VALIDATED!')
+        return
+    if args.compareinstalls:
+        for agent, package in _get_agent_packages(
+                args.agents, args.sourcesroot).items():
+            timings = time_module_installs(package)
+            lgr.info('{0}: {1}'.format(agent, ', '.join(
+                '{0} {1:.1f}s'.format(name, duration)
+                for name, duration in timings.items())))
+        return
+    codes = build_agents(args.agents, download=args.download,
+                         jobs=args.jobs, log_dir=args.logdir,
+                         sources_root=args.sourcesroot, force=args.force)
+    sys.exit(0 if all(code == 0 for code in codes.values()) else 1)
 
 
 if __name__ == '__main__':
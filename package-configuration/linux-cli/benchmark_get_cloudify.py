@@ -0,0 +1,482 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Micro-benchmarks for get-cloudify.py
+
+Usage: python benchmark_get_cloudify.py [-n ITERATIONS] [--json PATH]
+                                        [BENCHMARK ...]
+
+Every benchmark prints the wall-clock time of each of its variants.
+"""
+import sys
+import time
+import argparse
+import logging
+import subprocess
+import os
+import shutil
+import tempfile
+import zipfile
+import json
+import glob
+import platform
+import posixpath
+import urllib
+import urlparse
+import contextlib
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+from threading import Thread
+
+
+get_cloudify = __import__("get-cloudify")
+
+
+def _timed(func, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        func()
+    return time.time() - start
+
+
+class _LegacyPipeReader(Thread):
+    def __init__(self, fd, proc):
+        Thread.__init__(self)
+        self.fd = fd
+        self.proc = proc
+        self.aggr = ''
+
+    def run(self):
+        while self.proc.poll() is None:
+            output = self.fd.readline()
+            if len(output) > 0:
+                self.aggr += output
+            else:
+                time.sleep(0.1)
+
+
+def _legacy_run(cmd):
+    """The thread-per-pipe, sleep-polling runner run() used to be
+    """
+    pipe = subprocess.PIPE
+    proc = subprocess.Popen(cmd, shell=True, stdout=pipe, stderr=pipe)
+    readers = [_LegacyPipeReader(proc.stdout, proc),
+               _LegacyPipeReader(proc.stderr, proc)]
+    for reader in readers:
+        reader.start()
+    while proc.poll() is None:
+        time.sleep(0.1)
+    for reader in readers:
+        reader.join()
+    return proc
+
+
+def bench_run(iterations):
+    """Many short commands through the legacy and the current runner
+    """
+    cmd = 'echo Hi!'
+    return [
+        ('threaded', _timed(lambda: _legacy_run(cmd), iterations)),
+        ('multiplexed', _timed(lambda: get_cloudify.run(cmd), iterations)),
+    ]
+
+
+def _make_wheel(wheelhouse, name, version, requires=()):
+    dist_info = '{0}-{1}.dist-info'.format(name, version)
+    path = os.path.join(wheelhouse, '{0}-{1}-py2.py3-none-any.whl'.format(
+        name, version))
+    with zipfile.ZipFile(path, 'w') as wheel:
+        wheel.writestr('{0}/__init__.py'.format(name), '')
+        wheel.writestr(dist_info + '/METADATA', (
+            'Metadata-Version: 2.1\nName: {0}\nVersion: {1}\n').format(
+            name, version) + ''.join(
+            'Requires-Dist: {0}\n'.format(requirement)
+            for requirement in requires))
+        wheel.writestr(dist_info + '/WHEEL', (
+            'Wheel-Version: 1.0\nRoot-Is-Purelib: true\n'
+            'Tag: py2-none-any\nTag: py3-none-any\n'))
+        wheel.writestr(dist_info + '/RECORD', '')
+
+
+def bench_wheelhouse(iterations):
+    """Resolving a wheel from a 500 wheel wheelhouse, with and without
+    its index
+    """
+    wheelhouse = tempfile.mkdtemp()
+    destination = tempfile.mkdtemp()
+    try:
+        for i in range(250):
+            for version in ('1.0', '1.1'):
+                _make_wheel(wheelhouse, 'synthetic_{0}'.format(i), version)
+        get_cloudify.index_wheelhouse(wheelhouse)
+        index_url = get_cloudify.get_wheelhouse_index_url(wheelhouse)
+        cmd = [sys.executable, '-m', 'pip', 'download', '--isolated',
+               '--disable-pip-version-check', '--no-deps', '-d', destination,
+               'synthetic-125']
+
+        def download(*source):
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(cmd + list(source),
+                                      stdout=devnull, stderr=devnull)
+        return [
+            ('find-links', _timed(lambda: download(
+                '--no-index', '--find-links', wheelhouse), iterations)),
+            ('index', _timed(lambda: download(
+                '--index-url', index_url), iterations)),
+        ]
+    finally:
+        shutil.rmtree(wheelhouse)
+        shutil.rmtree(destination)
+
+
+def bench_virtualenv(iterations):
+    """Creating a virtualenv, and cloning one
+    """
+    tempdir = tempfile.mkdtemp()
+    golden = os.path.join(tempdir, 'golden')
+    counter = [0]
+
+    def target():
+        counter[0] += 1
+        return os.path.join(tempdir, 'env{0}'.format(counter[0]))
+    try:
+        get_cloudify.make_virtualenv(golden, sys.executable)
+        return [
+            ('make_virtualenv', _timed(lambda: get_cloudify.make_virtualenv(
+                target(), sys.executable), iterations)),
+            ('clone_virtualenv', _timed(lambda: get_cloudify.clone_virtualenv(
+                golden, target()), iterations)),
+        ]
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def _remove_bytecode(path):
+    for root, dirs, files in os.walk(path):
+        if '__pycache__' in dirs:
+            dirs.remove('__pycache__')
+            shutil.rmtree(os.path.join(root, '__pycache__'))
+        for name in files:
+            if name.endswith(('.pyc', '.pyo')):
+                os.remove(os.path.join(root, name))
+
+
+def _cold_start(env, command, precompiled, iterations):
+    """Runs a command of a virtualenv right after its bytecode is removed
+    (and, if `precompiled`, precompiled again)
+    """
+    bin_path = get_cloudify._get_env_bin_path(env)
+    duration = 0
+    for _ in range(iterations):
+        _remove_bytecode(env)
+        if precompiled:
+            get_cloudify.precompile(
+                env, python=os.path.join(bin_path, 'python'))
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(os.path.join(bin_path, command),
+                                  shell=True, stdout=devnull, stderr=devnull)
+        duration += time.time() - start
+    return duration
+
+
+def bench_precompile(iterations):
+    """First run of `cfy --version` in a fresh virtualenv, with and without
+    precompiling it
+
+    Cloudify is installed from the wheelhouse in $CLOUDIFY_WHEELHOUSE if
+    set, or else from PyPI.
+    """
+    env = tempfile.mkdtemp()
+    try:
+        get_cloudify.make_virtualenv(env, sys.executable)
+        get_cloudify.install_module(
+            'cloudify', pre=True, virtualenv_path=env,
+            wheelspath=os.environ.get('CLOUDIFY_WHEELHOUSE'))
+        return [
+            ('compiled on import', _cold_start(
+                env, 'cfy --version', False, iterations)),
+            ('precompiled', _cold_start(
+                env, 'cfy --version', True, iterations)),
+        ]
+    finally:
+        shutil.rmtree(env)
+
+
+class _IndexRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves the server's root directory rather than the working one
+    """
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(urlparse.urlparse(path).path))
+        return os.path.join(self.server.root, *[
+            part for part in path.split('/') if part not in ('', '.', '..')])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _IndexServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def _serve(root):
+    """Serves a directory over HTTP on localhost, yielding its url
+    """
+    server = _IndexServer(('127.0.0.1', 0), _IndexRequestHandler)
+    server.root = root
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def _environ(**variables):
+    """Sets (or, if None, unsets) environment variables
+    """
+    environ = dict(os.environ)
+    for name, value in variables.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+# the synthetic projects served along with Cloudify, and how many of them
+# Cloudify (if synthetic) requires.
+INSTALL_SYNTHETIC_PROJECTS = 200
+INSTALL_SYNTHETIC_REQUIREMENTS = 20
+
+
+def _make_index(path):
+    """Makes a wheelhouse to serve as a package index, along with a
+    requirements file
+
+    It holds synthetic wheels, and Cloudify's wheels from
+    $CLOUDIFY_WHEELHOUSE if set. Otherwise, Cloudify is synthetic too.
+    """
+    os.makedirs(path)
+    for i in range(INSTALL_SYNTHETIC_PROJECTS):
+        _make_wheel(path, 'synthetic_{0}'.format(i), '1.0')
+    real_wheelhouse = os.environ.get('CLOUDIFY_WHEELHOUSE')
+    if real_wheelhouse:
+        for wheel in glob.glob(os.path.join(real_wheelhouse, '*.whl')):
+            shutil.copy(wheel, path)
+    else:
+        _make_wheel(path, 'cloudify', '3.3', requires=[
+            'synthetic_{0}'.format(i)
+            for i in range(INSTALL_SYNTHETIC_REQUIREMENTS)])
+    with open(os.path.join(path, 'requirements.txt'), 'w') as f:
+        f.write('synthetic_{0}\n'.format(INSTALL_SYNTHETIC_REQUIREMENTS))
+    get_cloudify.index_wheelhouse(path)
+
+
+def _make_partial_wheelhouse(index_path, path):
+    """Copies Cloudify's wheel and every other wheel of an index into a
+    wheelhouse
+    """
+    os.makedirs(path)
+    wheels = sorted(os.path.basename(wheel) for wheel in glob.glob(
+        os.path.join(index_path, '*.whl')))
+    cloudify = [wheel for wheel in wheels if wheel.startswith('cloudify-')]
+    others = [wheel for wheel in wheels if wheel not in cloudify]
+    for wheel in cloudify + others[::2]:
+        shutil.copy(os.path.join(index_path, wheel), path)
+    get_cloudify.index_wheelhouse(path)
+
+
+def _time_install(tempdir, cache_dir, **kwargs):
+    """Times installing Cloudify into a new virtualenv, using the download
+    and pip caches in `cache_dir`
+    """
+    env = os.path.join(tempfile.mkdtemp(dir=tempdir), 'env')
+    installer = get_cloudify.CloudifyInstaller(
+        virtualenv=env, cachedir=os.path.join(cache_dir, 'downloads'),
+        pre=True, **kwargs)
+    with _environ(PIP_CACHE_DIR=os.path.join(cache_dir, 'pip')):
+        start = time.time()
+        installer.execute()
+        return time.time() - start
+
+
+@contextlib.contextmanager
+def _no_online_fallback():
+    """Makes offline installations fail rather than fall back online, so
+    that the fallback isn't timed instead of them
+    """
+    def install_module(module, **kwargs):
+        raise RuntimeError('The offline installation of {0} fell back '
+                           'online.'.format(module))
+
+    original = get_cloudify.install_module
+    get_cloudify.install_module = install_module
+    try:
+        yield
+    finally:
+        get_cloudify.install_module = original
+
+
+def bench_install(iterations):
+    """Installing Cloudify end to end from a package index on localhost:
+    online, offline (from a wheelhouse), hybrid (from a wheelhouse missing
+    half of the wheels) and online with warm caches
+
+    Every other variant starts with cold caches. Real wheels are served if
+    $CLOUDIFY_WHEELHOUSE is set (see _make_index). The offline and hybrid
+    variants fail if they fall back online.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        index_path = os.path.join(tempdir, 'index')
+        partial_path = os.path.join(tempdir, 'partial')
+        _make_index(index_path)
+        _make_partial_wheelhouse(index_path, partial_path)
+        with _serve(index_path) as url:
+            index_url = url + get_cloudify.WHEELHOUSE_INDEX_DIR + '/'
+            common = {'withrequirements': [url + 'requirements.txt']}
+
+            def install(cache_dir=None, **kwargs):
+                kwargs.update(common)
+                return _time_install(
+                    tempdir, cache_dir or tempfile.mkdtemp(dir=tempdir),
+                    **kwargs)
+
+            with _environ(PIP_INDEX_URL=index_url, PIP_EXTRA_INDEX_URL=None):
+                results = [
+                    ('online', sum(install(forceonline=True)
+                                   for _ in range(iterations))),
+                ]
+                with _no_online_fallback():
+                    results.extend([
+                        ('offline', sum(install(wheelspath=index_path)
+                                        for _ in range(iterations))),
+                        ('hybrid', sum(install(wheelspath=partial_path,
+                                               hybrid=True)
+                                       for _ in range(iterations))),
+                    ])
+                warm_cache = tempfile.mkdtemp(dir=tempdir)
+                install(warm_cache, forceonline=True)
+                results.append(('cached', sum(
+                    install(warm_cache, forceonline=True)
+                    for _ in range(iterations))))
+                return results
+    finally:
+        shutil.rmtree(tempdir)
+
+
+# name -> (benchmark, default iterations)
+BENCHMARKS = {
+    'install': (bench_install, 3),
+    'precompile': (bench_precompile, 5),
+    'run': (bench_run, 100),
+    'virtualenv': (bench_virtualenv, 3),
+    'wheelhouse': (bench_wheelhouse, 5),
+}
+
+
+def _get_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _load_runs(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return []
+
+
+def _get_previous_time(runs, name, variant):
+    """Returns the time per iteration of a variant in the last of `runs`
+    it was run in
+    """
+    for run in reversed(runs):
+        result = run['results'].get(name)
+        if result and variant in result['variants']:
+            return result['variants'][variant] / result['iterations']
+    return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-n', '--iterations', type=int,
+        help='Number of iterations per variant (defaults to a number '
+             'set per benchmark).')
+    parser.add_argument(
+        '--json', metavar='PATH',
+        help='Append the results to a JSON file of runs, for comparing '
+             'them between commits. Results are printed along with their '
+             'change since the last run in the file.')
+    parser.add_argument(
+        'benchmarks', nargs='*', metavar='BENCHMARK',
+        help='Benchmarks to run (defaults to all of: {0}).'.format(
+            ', '.join(sorted(BENCHMARKS))))
+    args = parser.parse_args(args)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: {0}'.format(
+            ', '.join(sorted(unknown))))
+
+    runs = _load_runs(args.json) if args.json else []
+    run = {
+        'commit': _get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'results': {},
+    }
+    get_cloudify.lgr.setLevel(logging.ERROR)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        benchmark, iterations = BENCHMARKS[name]
+        iterations = args.iterations or iterations
+        results = benchmark(iterations)
+        run['results'][name] = {
+            'iterations': iterations, 'variants': dict(results)}
+
+        def describe(variant, duration):
+            description = '{0} {1:.3f}s'.format(variant, duration)
+            previous = _get_previous_time(runs, name, variant)
+            if previous:
+                description += ' ({0:+.1%})'.format(
+                    duration / iterations / previous - 1)
+            return description
+        print('{0}: {1}'.format(name, ', '.join(
+            describe(variant, duration) for variant, duration in results)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(runs + [run], f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -48,13 +48,37 @@ import argparse
 import platform
 import os
 import urllib
+import urllib2
+import urlparse
+import httplib
 import struct
 import tempfile
 import logging
 import shutil
 import time
+import hashlib
 import tarfile
+import posixpath
+import re
+import select
+import shlex
+import pipes
+import errno
+import collections
+import contextlib
+import threading
+import json
+import glob
+import Queue
+import zipfile
 from threading import Thread
+try:
+    import resource
+except ImportError:
+    # not available on Windows.
+    resource = None
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 DESCRIPTION = '''This script attempts(!) to install Cloudify's CLI on Linux,
@@ -82,7 +106,29 @@ Passing the --wheelspath allows for an offline installation of Cloudify
 from predownloaded Cloudify dependency wheels. Note that if wheels are found
 within the default wheels directory or within --wheelspath, they will (unless
 the --forceonline flag is set) be used instead of performing an online
-installation.
+installation. A wheelhouse can be built using the --buildwheelhouse flag.
+Wheelhouses indexed using the --indexwheelhouse flag (built ones are indexed
+automatically) are installed from faster.
+
+Passing --goldenvirtualenv along with --virtualenv creates the virtualenv by
+cloning a "golden" virtualenv (created if missing) instead, which is much
+faster. Anything installed in the golden virtualenv (e.g. Cloudify) is
+cloned as well.
+
+Installations in a virtualenv are checkpointed, so that rerunning a failed
+installation skips the phases it completed, unless --noresume is set.
+
+Cloudify can be installed in several virtualenvs at once by repeating the
+--target flag. Prerequisites are installed once, after which the targets are
+installed concurrently, each logging to its own file.
+
+Downloads (e.g. of get-pip.py and --source archives) are mirrored. The
+fastest responsive mirror is used, and the download fails over to the other
+mirrors if it fails. More mirrors can be added using --mirror.
+
+The distribution, package manager and other facts about the host are read
+from /etc/os-release and cached in ~/.cache/cloudify/host-facts.json, where
+other tools may read them from as well.
 
 The script will attempt to install all necessary requirements including
 python-dev and gcc (for Fabric on Linux), pycrypto (for Fabric on Windows),
@@ -114,12 +160,83 @@ PIP_URL = 'https://bootstrap.pypa.io/get-pip.py'
 PYCR64_URL = 'http://www.voidspace.org.uk/downloads/pycrypto26/pycrypto-2.6.win-amd64-py2.7.exe'  # NOQA
 PYCR32_URL = 'http://www.voidspace.org.uk/downloads/pycrypto26/pycrypto-2.6.win32-py2.7.exe'  # NOQA
 
+WHEELHOUSE_INDEX_DIR = 'simple'
+WHEELHOUSE_MANIFEST = 'manifest.json'
+# maps the sources of wheels built by --buildwheelhouse to their wheels.
+WHEELHOUSE_BUILD_MANIFEST = 'build-manifest.json'
+# maps the distributions installed by incremental upgrades to the sha256 of
+# their wheels, kept in the environment's prefix.
+INSTALLED_WHEELS_MANIFEST = 'cloudify-installed-wheels.json'
+# distributions virtualenvs are created with, which upgrades never remove.
+BASE_DISTRIBUTIONS = ('pip', 'setuptools', 'wheel', 'distribute')
+# records the installation phases completed in an environment.
+CHECKPOINT_FILE = 'cloudify-install-checkpoint.json'
+
 PLATFORM = sys.platform
 IS_WIN = (PLATFORM == 'win32')
 IS_DARWIN = (PLATFORM == 'darwin')
 IS_LINUX = (PLATFORM == 'linux2')
 
-PROCESS_POLLING_INTERVAL = 0.1
+PIPE_READ_SIZE = 65536
+# the amount of a command's output (per stream) kept in memory. Anything
+# beyond it is spilled to a temporary file.
+CAPTURE_BUFFER_SIZE = 1024 * 1024
+
+DOWNLOAD_THREADS = 4
+# files smaller than two parts are downloaded in a single stream.
+DOWNLOAD_PART_SIZE = 4 * 1024 * 1024
+DOWNLOAD_BLOCK_SIZE = 65536
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'cloudify', 'downloads')
+# in MB
+DOWNLOAD_CACHE_SIZE = 1024
+
+# the facts probed about the host, reused by later runs (see get_host_facts).
+HOST_FACTS_FILE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'cloudify', 'host-facts.json')
+OS_RELEASE_PATHS = ('/etc/os-release', '/usr/lib/os-release')
+# package manager -> the distributions (os-release IDs, as well as names
+# used by platform.linux_distribution) using it, in order of preference.
+PACKAGE_MANAGERS = (
+    ('apt-get', ('debian', 'ubuntu')),
+    ('dnf', ('fedora', 'rhel', 'redhat', 'centos')),
+    ('yum', ('fedora', 'rhel', 'redhat', 'centos', 'amzn')),
+    ('zypper', ('suse', 'opensuse', 'sles')),
+    ('pacman', ('arch', 'archlinux')),
+    ('apk', ('alpine',)),
+)
+PYTHONDEV_COMMANDS = {
+    'apt-get': 'apt-get install -y gcc python-dev',
+    'dnf': 'dnf -y install gcc python-devel',
+    'yum': 'yum -y install gcc python-devel',
+    'zypper': 'zypper --non-interactive install gcc python-devel',
+    # Arch doesn't require a python-dev package.
+    # It's already supplied with Python.
+    'pacman': 'pacman -S gcc --noconfirm',
+    'apk': 'apk add gcc musl-dev python2-dev',
+}
+
+# mirror urls -> the fastest of them and when it was picked.
+MIRROR_CACHE_FILE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'cloudify', 'mirrors.json')
+# in seconds
+MIRROR_TTL = 3600
+MIRROR_PROBE_TIMEOUT = 5
+# resource url -> the other urls it's mirrored at, in order of preference.
+MIRRORS = {
+    PIP_URL: [
+        'https://raw.githubusercontent.com/pypa/get-pip/master/public/2.7/'
+        'get-pip.py',
+    ],
+}
+# GitHub archives (e.g. of --source) are mirrored by codeload.github.com.
+_GITHUB_ARCHIVE_PATTERN = \
+    r'^https?://github\.com/([^/]+)/([^/]+)/archive/(.+)\.(tar\.gz|zip)$'
+
+# the Linux ioctl cloning a file's extents into another (see linux/fs.h).
+FICLONE = 0x40049409
 
 # defined below
 lgr = None
@@ -140,32 +257,133 @@ def init_logger(logger_name):
     return logger
 
 
-def run(cmd, suppress_errors=False):
+def run(cmd, suppress_errors=False, capture_size=CAPTURE_BUFFER_SIZE):
     """Executes a command
+
+    The process's stdout and stderr are read until EOF so that no output
+    written right before the process exits is lost. They are captured in
+    `stdout_capture` and `stderr_capture` on the returned process, keeping
+    at most `capture_size` bytes of each in memory. `aggr_stdout` and
+    `aggr_stderr` hold their summaries.
     """
     lgr.debug('Executing: {0}...'.format(cmd))
+    start = time.time()
     pipe = subprocess.PIPE
     proc = subprocess.Popen(
         cmd, shell=True, stdout=pipe, stderr=pipe)
 
     stderr_log_level = logging.NOTSET if suppress_errors else logging.ERROR
 
-    stdout_thread = PipeReader(proc.stdout, proc, lgr, logging.DEBUG)
-    stderr_thread = PipeReader(proc.stderr, proc, lgr, stderr_log_level)
+    stdout_handler = OutputHandler(
+        lgr, logging.DEBUG, CaptureBuffer(capture_size))
+    stderr_handler = OutputHandler(
+        lgr, stderr_log_level, CaptureBuffer(capture_size))
+    streams = [(proc.stdout, stdout_handler), (proc.stderr, stderr_handler)]
 
-    stdout_thread.start()
-    stderr_thread.start()
+    if IS_WIN:
+        # select can't poll pipes on Windows.
+        readers = [PipeReader(fd, handler) for fd, handler in streams]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+    else:
+        multiplex_pipes(streams)
+    cpu_time, peak_rss = wait_for_process(proc)
+    phase = get_current_phase()
+    if phase:
+        phase.add_command(cmd, proc.returncode, time.time() - start,
+                          cpu_time, peak_rss)
+
+    proc.stdout_capture = stdout_handler.capture
+    proc.stderr_capture = stderr_handler.capture
+    proc.aggr_stdout = proc.stdout_capture.summary()
+    proc.aggr_stderr = proc.stderr_capture.summary()
 
-    while proc.poll() is None:
-        time.sleep(PROCESS_POLLING_INTERVAL)
+    return proc
 
-    stdout_thread.join()
-    stderr_thread.join()
 
-    proc.aggr_stdout = stdout_thread.aggr
-    proc.aggr_stderr = stderr_thread.aggr
+def quote_command(args):
+    """Returns the command line of a list of arguments, quoted for the
+    shell run() executes commands in
+    """
+    if IS_WIN:
+        # cmd.exe takes what's within double quotes literally.
+        return ' '.join(
+            '"{0}"'.format(arg.replace('"', '\\"'))
+            if re.search(r'[\s"<>|&^()%]', arg) else arg for arg in args)
+    return ' '.join(pipes.quote(arg) for arg in args)
 
-    return proc
+
+def wait_for_process(proc):
+    """Waits for a process to terminate
+
+    Returns the CPU time and the peak RSS (in KB) of the process, including
+    those of its terminated children, or Nones where they can't be measured.
+    """
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return None, None
+    while True:
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+            break
+        except OSError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+        else os.WEXITSTATUS(status)
+    return usage.ru_utime + usage.ru_stime, _get_rss_kb(usage.ru_maxrss)
+
+
+def _get_rss_kb(maxrss):
+    # ru_maxrss is in bytes on Darwin and in kilobytes elsewhere.
+    return maxrss // 1024 if IS_DARWIN else maxrss
+
+
+def multiplex_pipes(streams):
+    """Reads a list of (pipe, OutputHandler) tuples on a single event loop
+
+    Returns only after every pipe has reached EOF. epoll is used where
+    available, falling back to select otherwise.
+    """
+    handlers = dict((pipe.fileno(), (pipe, handler))
+                    for pipe, handler in streams)
+    if hasattr(select, 'epoll'):
+        poller = select.epoll()
+        for fd in handlers:
+            poller.register(fd, select.EPOLLIN)
+
+        def wait():
+            return [fd for fd, _ in poller.poll()]
+    else:
+        poller = None
+
+        def wait():
+            return select.select(list(handlers), [], [])[0]
+
+    try:
+        while handlers:
+            try:
+                ready = wait()
+            except (IOError, OSError, select.error) as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, PIPE_READ_SIZE)
+                pipe, handler = handlers[fd]
+                if data:
+                    handler.write(data)
+                    continue
+                if poller:
+                    poller.unregister(fd)
+                del handlers[fd]
+                handler.close()
+                pipe.close()
+    finally:
+        if poller:
+            poller.close()
 
 
 def drop_root_privileges():
@@ -196,6 +414,84 @@ def make_virtualenv(virtualenv_dir, python_path):
         sys.exit('Could not create virtualenv: {0}'.format(virtualenv_dir))
 
 
+def clone_virtualenv(source, destination):
+    """Clones a virtualenv into a new location
+
+    This is much faster than creating a virtualenv, as neither the
+    interpreter nor pip and setuptools are set up again. Files are
+    reflinked where the filesystem supports it and copied where it
+    doesn't. They're never hardlinked, as writing to the clone's files
+    (e.g. pip upgrading a module, or Python rewriting a .pyc file) would
+    write to the source's as well. Scripts, activate scripts and
+    path files referring to `source` are rewritten to refer to
+    `destination`, as are absolute symlinks into `source`.
+    """
+    lgr.info('Cloning virtualenv {0} into {1}...'.format(
+        source, destination))
+    source = os.path.abspath(source)
+    destination = os.path.abspath(destination)
+    bin_path = os.path.abspath(_get_env_bin_path(source))
+    can_reflink = IS_LINUX
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.normpath(
+            os.path.join(destination, os.path.relpath(root, source)))
+        _mkdir(target_root)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(path):
+                link = os.readlink(path)
+                if link == source or link.startswith(source + os.sep):
+                    link = destination + link[len(source):]
+                os.symlink(link, target)
+            elif name in dirs:
+                continue
+            elif (root == bin_path or name.endswith(('.pth', '.egg-link'))) \
+                    and _relocate_file(path, target, source, destination):
+                continue
+            elif can_reflink:
+                try:
+                    _reflink(path, target)
+                except (IOError, OSError):
+                    # reflinks are supported per filesystem, not per file.
+                    can_reflink = False
+                    shutil.copy2(path, target)
+            else:
+                shutil.copy2(path, target)
+
+
+def _relocate_file(path, target, source, destination):
+    """Writes a text file referring to `source` as referring to
+    `destination` instead, returning False if it isn't such a file
+
+    Only paths within `source` are replaced, and not paths merely starting
+    with it (e.g. `source2`).
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    source_pattern = re.compile(
+        r'{0}(?=[/\\\'"\s]|$)'.format(re.escape(source)), re.MULTILINE)
+    if '\0' in content or not source_pattern.search(content):
+        return False
+    with open(target, 'wb') as f:
+        f.write(source_pattern.sub(lambda match: destination, content))
+    shutil.copymode(path, target)
+    return True
+
+
+def _reflink(path, target):
+    import fcntl
+    try:
+        with open(path, 'rb') as src:
+            with open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        if os.path.isfile(target):
+            os.remove(target)
+        raise
+    shutil.copymode(path, target)
+
+
 def install_module(module, version=False, pre=False, virtualenv_path=False,
                    wheelspath=False, requirement_files=None, upgrade=False):
     """This will install a Python module.
@@ -207,7 +503,34 @@ def install_module(module, version=False, pre=False, virtualenv_path=False,
     Can specify a local wheelspath to use for offline installation.
     Can request an upgrade.
     """
-    lgr.info('Installing {0}...'.format(module))
+    requirement = '{0}=={1}'.format(module, version) if version else module
+    result = install_modules([requirement], pre=pre,
+                             virtualenv_path=virtualenv_path,
+                             wheelspath=wheelspath,
+                             requirement_files=requirement_files,
+                             upgrade=upgrade)
+    if not result.returncode == 0:
+        sys.exit('Could not install module: {0}.'.format(module))
+
+
+def install_modules(modules, pre=False, virtualenv_path=False,
+                    wheelspath=False, requirement_files=None, upgrade=False,
+                    no_deps=False, force_reinstall=False, find_links=None):
+    """Installs a batch of Python modules in a single pip run
+
+    `modules` are requirement specifiers (e.g. `cloudify==3.2`), which are
+    resolved along with the requirements in `requirement_files` in one
+    pass, so that pip's start-up and dependency resolution are paid once
+    per environment rather than once per module. `no_deps`,
+    `force_reinstall` and `find_links` (a list of directories) are passed on
+    to pip. The other arguments are those of install_module.
+
+    Returns the pip process, with `packages` mapping each of `modules`,
+    followed by any other package pip failed on, to a (status, detail)
+    tuple. The status is one of 'installed', 'satisfied', 'failed' or
+    'skipped' (not installed because of other failures).
+    """
+    lgr.info('Installing {0}...'.format(', '.join(modules)))
     pip_cmd = ['pip', 'install']
     if virtualenv_path:
         pip_cmd[0] = os.path.join(
@@ -215,48 +538,1257 @@ def install_module(module, version=False, pre=False, virtualenv_path=False,
     if requirement_files:
         for req_file in requirement_files:
             pip_cmd.extend(['-r', req_file])
-    pip_cmd.append(module)
-    if version:
-        pip_cmd.append(version)
+    pip_cmd.extend(modules)
     if wheelspath:
-        pip_cmd.extend(
-            ['--use-wheel', '--no-index', '--find-links', wheelspath])
+        pip_cmd.extend(_get_use_wheel_args(virtualenv_path))
+        index_url = get_wheelhouse_index_url(wheelspath)
+        if index_url:
+            pip_cmd.extend(['--index-url', index_url])
+        else:
+            pip_cmd.extend(['--no-index', '--find-links', wheelspath])
+    for path in find_links or []:
+        pip_cmd.extend(['--find-links', path])
     if pre:
         pip_cmd.append('--pre')
     if upgrade:
         pip_cmd.append('--upgrade')
+    if no_deps:
+        pip_cmd.append('--no-deps')
+    if force_reinstall:
+        pip_cmd.append('--force-reinstall')
     if IS_VIRTUALENV and not virtualenv_path:
         lgr.info('Installing within current virtualenv: {0}...'.format(
             IS_VIRTUALENV))
-    result = run(' '.join(pip_cmd))
+    # pip's log holds all of its output, of which run only keeps the head
+    # and tail.
+    log_fd, log_path = tempfile.mkstemp(suffix='.log')
+    os.close(log_fd)
+    try:
+        pip_cmd.extend(['--log', log_path])
+        result = run(quote_command(pip_cmd))
+        result.packages = _get_install_results(
+            modules, log_path, result.returncode)
+    finally:
+        os.remove(log_path)
     if not result.returncode == 0:
-        lgr.error(result.aggr_stdout)
-        sys.exit('Could not install module: {0}.'.format(module))
+        lgr.error(result.stdout_capture.summary())
+        for package, (status, detail) in result.packages.items():
+            if status == 'failed':
+                lgr.error('Could not install {0}: {1}'.format(
+                    package, detail))
+    return result
+
+
+def _get_use_wheel_args(virtualenv_path=False):
+    """Returns the arguments making the pip of an environment use wheels
+
+    pip uses wheels by default since 1.5, and rejects --use-wheel since 10,
+    so it's only passed to older versions.
+    """
+    version = get_installed_version('pip', virtualenv_path or None)
+    numbers = [int(n) for n in re.findall(r'\d+', version or '')[:2]]
+    return ['--use-wheel'] if numbers and numbers < [1, 5] else []
+
+
+def uninstall_modules(modules, virtualenv_path=False):
+    """Uninstalls Python modules in a single pip run
+
+    Returns the pip process.
+    """
+    lgr.info('Uninstalling {0}...'.format(', '.join(modules)))
+    pip = os.path.join(_get_env_bin_path(virtualenv_path), 'pip') \
+        if virtualenv_path else 'pip'
+    result = run(quote_command([pip, 'uninstall', '-y'] + list(modules)))
+    if not result.returncode == 0:
+        lgr.error(result.stdout_capture.summary())
+    return result
+
+
+_PIP_PACKAGE_PATTERN = r'([A-Za-z0-9][A-Za-z0-9._-]*)'
+_PIP_LOG_PATTERNS = [
+    ('satisfied', re.compile(
+        r'Requirement already (?:satisfied|up-to-date): ' +
+        _PIP_PACKAGE_PATTERN)),
+    ('failed', re.compile(
+        r'No matching distribution found for ' + _PIP_PACKAGE_PATTERN)),
+    ('failed', re.compile(
+        r'Could not find a version that satisfies the requirement ' +
+        _PIP_PACKAGE_PATTERN)),
+    ('failed', re.compile(
+        r'Command .* failed with error code \d+ in \S*pip-[^/\s]*[/\\]' +
+        _PIP_PACKAGE_PATTERN)),
+]
+
+
+def _get_requirement_name(requirement):
+    """Returns the normalized project name of a requirement specifier, or
+    None if it's a url or a path
+    """
+    match = re.match(_PIP_PACKAGE_PATTERN + r'\s*(?:[\[(<>=!~;]|$)',
+                     requirement.strip())
+    return _normalize_project_name(match.group(1)) if match else None
+
+
+def _get_install_results(modules, log_path, returncode):
+    """Maps the modules of a pip install, and the packages it failed on,
+    to their (status, detail) according to pip's log
+    """
+    statuses = {}
+    try:
+        with open(log_path) as log:
+            for line in log:
+                line = line.rstrip()
+                match = re.search(r'Successfully installed (.+)$', line)
+                if match:
+                    for package in match.group(1).split():
+                        statuses[_normalize_project_name(
+                            package.rsplit('-', 1)[0])] = ('installed', None)
+                    continue
+                for status, pattern in _PIP_LOG_PATTERNS:
+                    match = pattern.search(line)
+                    if match:
+                        name = _normalize_project_name(match.group(1))
+                        if statuses.get(name, ('',))[0] != 'failed':
+                            statuses[name] = (status, line[match.start():])
+                        break
+    except IOError:
+        pass
+
+    default = ('installed', None) if returncode == 0 else ('skipped', None)
+    results = collections.OrderedDict()
+    for module in modules:
+        name = _get_requirement_name(module)
+        if name:
+            results[module] = statuses.pop(name, default)
+        else:
+            # urls and paths can't be matched to package names.
+            results[module] = ('installed', None) if returncode == 0 \
+                else ('failed', None)
+    for name, (status, detail) in sorted(statuses.items()):
+        if status == 'failed':
+            results[name] = (status, detail)
+    return results
 
 
 def untar_requirement_files(archive, destination):
     """This will extract requirement files from an archive.
+
+    `archive` is a file object (e.g. an HTTP response) which is read as a
+    stream. Only requirement files at the archive's top two levels are
+    extracted, and reading stops as soon as a single directory holding all
+    of them is found. Returns the paths of the requirement files in the
+    shallowest directory holding any.
+    """
+    # extracted directory -> requirement file names found in it.
+    found = collections.OrderedDict()
+    depths = {}
+    with tarfile.open(fileobj=archive, mode='r|*') as tar:
+        for member in tar:
+            parts = posixpath.normpath(member.name).split('/')
+            if not member.isfile() or len(parts) > 2 or \
+                    parts[-1] not in REQUIREMENT_FILE_NAMES or \
+                    parts[0] in ('', '..'):
+                continue
+            req_dir = os.path.join(destination, *parts[:-1])
+            _mkdir(req_dir)
+            with open(os.path.join(req_dir, parts[-1]), 'wb') as req_file:
+                shutil.copyfileobj(tar.extractfile(member), req_file)
+            depths[req_dir] = len(parts)
+            names = found.setdefault(req_dir, set())
+            names.add(parts[-1])
+            if names == set(REQUIREMENT_FILE_NAMES):
+                break
+    if not found:
+        return []
+    req_dir = min(found, key=depths.get)
+    return [os.path.join(req_dir, f) for f in REQUIREMENT_FILE_NAMES
+            if f in found[req_dir]]
+
+
+def open_url(url):
+    return urllib2.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+
+
+class TeeReader(object):
+    """Reads a file object, writing everything read to another one
+    """
+    def __init__(self, fileobj, output):
+        self.fileobj = fileobj
+        self.output = output
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.output.write(data)
+        return data
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class HeadRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Follows redirects of HEAD requests with HEAD requests
+
+    urllib2 would otherwise turn them into GET requests.
     """
-    with tarfile.open(name=archive) as tar:
-        req_files = [req_file for req_file in tar.getmembers()
-                     if os.path.basename(req_file.name)
-                     in REQUIREMENT_FILE_NAMES]
-        tar.extractall(path=destination, members=req_files)
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_req = urllib2.HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+        if new_req is not None and req.get_method() == 'HEAD':
+            new_req = HeadRequest(new_req.get_full_url(),
+                                  headers=new_req.headers,
+                                  origin_req_host=req.get_origin_req_host(),
+                                  unverifiable=True)
+        return new_req
+
+
+def resolve_url(url):
+    """Resolves a url's redirects using HEAD requests
+
+    Returns the final url and its headers. If the server refuses HEAD
+    requests, the original url is returned without headers.
+    """
+    opener = urllib2.build_opener(HeadRedirectHandler)
+    try:
+        response = opener.open(HeadRequest(url), timeout=DOWNLOAD_TIMEOUT)
+    except urllib2.HTTPError as ex:
+        lgr.debug('HEAD request to {0} failed ({1})'.format(url, ex))
+        return url, None
+    try:
+        return response.geturl(), response.info()
+    finally:
+        response.close()
 
 
-def download_file(url, destination):
+def _download_part(url, path, start, end, use_ranges, phase=None):
+    """Downloads bytes `start` to `end` (inclusive) of a url into `path`
+
+    If `end` is None, the url is downloaded to its end. When `use_ranges`
+    is set, whatever `path` already holds is considered to be the beginning
+    of the part and is not downloaded again, which is also how interrupted
+    transfers are retried. Downloaded bytes are accounted to `phase`.
+    """
+    retries = DOWNLOAD_RETRIES
+    open(path, 'ab').close()
+    while True:
+        done = os.path.getsize(path) if os.path.isfile(path) else 0
+        if end is not None and start + done > end:
+            if start + done > end + 1:
+                raise IOError('{0} is larger than expected'.format(path))
+            return
+        if not use_ranges:
+            done = 0
+        request = urllib2.Request(url)
+        if use_ranges:
+            request.add_header('Range', 'bytes={0}-{1}'.format(
+                start + done, '' if end is None else end))
+        try:
+            response = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+            try:
+                if use_ranges and response.getcode() != 206:
+                    raise IOError('{0} ignored the requested range'.format(
+                        url))
+                with open(path, 'ab' if done else 'wb') as f:
+                    for block in iter(
+                            lambda: response.read(DOWNLOAD_BLOCK_SIZE), ''):
+                        f.write(block)
+                        if phase:
+                            phase.add_download(len(block))
+            finally:
+                response.close()
+            if end is None:
+                return
+            if start + os.path.getsize(path) <= end:
+                raise IOError('Connection closed before the end of '
+                              '{0}'.format(url))
+        except (IOError, httplib.HTTPException) as ex:
+            if not retries:
+                raise
+            retries -= 1
+            lgr.debug('Retrying download of {0} ({1})'.format(url, ex))
+
+
+def download_file(url, destination, cache=None, threads=DOWNLOAD_THREADS,
+                  part_size=DOWNLOAD_PART_SIZE):
+    """Downloads a url to `destination`
+
+    Redirects are resolved once, before downloading. If the server reports
+    the file's size and accepts byte ranges, the file is downloaded in up
+    to `threads` parallel parts of at least `part_size` bytes. The parts
+    of an interrupted download are kept beside `destination` and are
+    resumed by the next call.
+
+    If a DownloadCache is provided, an up to date cached copy of the url
+    is used instead of downloading it, and new downloads are added to it.
+    """
     lgr.info('Downloading {0} to {1}'.format(url, destination))
-    final_url = urllib.urlopen(url).geturl()
+    final_url, headers = resolve_url(url)
     if final_url != url:
         lgr.debug('Redirected to {0}'.format(final_url))
-    f = urllib.URLopener()
-    f.retrieve(final_url, destination)
+    if cache and cache.get(url, headers, destination):
+        return
+
+    size = None
+    use_ranges = False
+    state = {'url': final_url}
+    if headers:
+        length = headers.getheader('content-length', '')
+        size = int(length) if length.isdigit() else None
+        use_ranges = size is not None and \
+            headers.getheader('accept-ranges', '').lower() == 'bytes'
+        state['etag'] = headers.getheader('etag')
+        state['last_modified'] = headers.getheader('last-modified')
+    if not use_ranges:
+        bounds = [(0, None if size is None else size - 1)]
+    else:
+        count = max(1, min(threads, size // part_size))
+        bounds = [(i * size // count, (i + 1) * size // count - 1)
+                  for i in range(count)]
+    state['size'] = size
+    state['parts'] = bounds
+
+    state_path = '{0}.download'.format(destination)
+    part_paths = ['{0}.part{1}'.format(destination, i)
+                  for i in range(len(bounds))]
+    if not use_ranges or _load_download_state(state_path) != state:
+        _remove_download_parts(destination)
+    if use_ranges:
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+        resumed = sum(os.path.getsize(path) for path in part_paths
+                      if os.path.isfile(path))
+        if resumed:
+            lgr.debug('Resuming download of {0} ({1} bytes done)'.format(
+                final_url, resumed))
+
+    jobs = [(final_url, path, start, end, use_ranges, get_current_phase())
+            for path, (start, end) in zip(part_paths, bounds)]
+    if len(jobs) == 1:
+        _download_part(*jobs[0])
+    else:
+        lgr.debug('Downloading {0} in {1} parts'.format(
+            final_url, len(jobs)))
+        pool = ThreadPool(len(jobs))
+        try:
+            pool.map(lambda job: _download_part(*job), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    if os.path.isfile(destination):
+        os.remove(destination)
+    if len(part_paths) == 1:
+        os.rename(part_paths[0], destination)
+    else:
+        with open(destination, 'wb') as f:
+            for path in part_paths:
+                with open(path, 'rb') as part:
+                    shutil.copyfileobj(part, f, DOWNLOAD_BLOCK_SIZE)
+    _remove_download_parts(destination)
+    if size is not None and os.path.getsize(destination) != size:
+        raise IOError('Downloaded {0} bytes of {1} instead of {2}'.format(
+            os.path.getsize(destination), final_url, size))
+    if cache:
+        cache.put(url, headers, destination)
+
+
+def _load_download_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    # json turns the parts' bounds into lists.
+    state['parts'] = [tuple(bound) for bound in state.get('parts', [])]
+    return state
+
+
+def _remove_download_parts(destination):
+    for path in glob.glob('{0}.part*'.format(destination)) + \
+            glob.glob('{0}.download'.format(destination)):
+        os.remove(path)
+
+
+# the errors download failures surface as.
+DOWNLOAD_ERRORS = (IOError, httplib.HTTPException)
+
+
+def _probe_mirror(url):
+    """Returns how long a mirror took to respond to a HEAD request, or
+    None if it didn't
+    """
+    opener = urllib2.build_opener(HeadRedirectHandler)
+    start = time.time()
+    try:
+        opener.open(HeadRequest(url), timeout=MIRROR_PROBE_TIMEOUT).close()
+    except urllib2.HTTPError as ex:
+        # the mirror responded, even if it refused HEAD requests.
+        if ex.code not in (405, 501):
+            lgr.debug('Probing {0} failed ({1})'.format(url, ex))
+            return None
+    except DOWNLOAD_ERRORS as ex:
+        lgr.debug('Probing {0} failed ({1})'.format(url, ex))
+        return None
+    return time.time() - start
+
+
+def probe_mirrors(urls):
+    """Probes mirrors concurrently, returning their latencies (None for
+    those which didn't respond)
+    """
+    pool = ThreadPool(len(urls))
+    try:
+        return pool.map(_probe_mirror, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class MirrorSelector(object):
+    """Orders the mirrors of resources by latency
+
+    The mirrors of a url (see get_mirror_urls) are probed concurrently, and
+    ordered by how fast they responded, followed by those which didn't, in
+    order of preference. The fastest mirror is cached in `cache_path` for
+    `ttl` seconds, during which the mirrors aren't probed again.
+
+    `mirrors` maps urls to the urls they're mirrored at, in addition to
+    MIRRORS.
+    """
+    def __init__(self, mirrors=None, cache_path=MIRROR_CACHE_FILE,
+                 ttl=MIRROR_TTL):
+        self.mirrors = mirrors or {}
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def get_mirror_urls(self, url):
+        """Returns the urls a url is mirrored at, itself first
+        """
+        urls = [url] + MIRRORS.get(url, []) + self.mirrors.get(url, [])
+        match = re.match(_GITHUB_ARCHIVE_PATTERN, url)
+        if match:
+            owner, repo, ref, extension = match.groups()
+            urls.append('https://codeload.github.com/{0}/{1}/{2}/{3}'.format(
+                owner, repo, extension, ref))
+        return list(collections.OrderedDict.fromkeys(urls))
+
+    def select(self, url):
+        """Returns the mirrors of a url, fastest first
+        """
+        urls = self.get_mirror_urls(url)
+        if len(urls) == 1:
+            return urls
+        with self._lock:
+            cached = self._load().get(url)
+        if cached and cached['mirror'] in urls and \
+                0 <= time.time() - cached['time'] < self.ttl:
+            lgr.debug('Using mirror {0} of {1}'.format(cached['mirror'], url))
+            return [cached['mirror']] + [
+                mirror for mirror in urls if mirror != cached['mirror']]
+
+        latencies = probe_mirrors(urls)
+        responsive = sorted((latency, mirror) for mirror, latency
+                            in zip(urls, latencies) if latency is not None)
+        if not responsive:
+            lgr.warning('None of the mirrors of {0} responded.'.format(url))
+            return urls
+        fastest = responsive[0][1]
+        lgr.info('Selected mirror {0} of {1} ({2:.0f} ms)'.format(
+            fastest, url, responsive[0][0] * 1000))
+        self._update(url, fastest)
+        return [mirror for _, mirror in responsive] + [
+            mirror for mirror, latency in zip(urls, latencies)
+            if latency is None]
+
+    def failed(self, url, mirror):
+        """Stops using a mirror of a url which failed, if it was cached
+        """
+        with self._lock:
+            cached = self._load().get(url)
+        if cached and cached['mirror'] == mirror:
+            self._update(url, None)
+
+    def _load(self):
+        if not (self.cache_path and self.ttl):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return cached if isinstance(cached, dict) else {}
+
+    def _update(self, url, mirror):
+        if not (self.cache_path and self.ttl):
+            return
+        with self._lock:
+            cached = self._load()
+            if mirror:
+                cached[url] = {'mirror': mirror, 'time': time.time()}
+            else:
+                cached.pop(url, None)
+            try:
+                _write_json(self.cache_path, cached)
+            except (IOError, OSError) as ex:
+                lgr.warning('Could not cache mirrors in {0} ({1}).'.format(
+                    self.cache_path, ex))
+
+
+def with_mirrors(mirrors, url, func):
+    """Calls `func` with the mirrors of a url, fastest first, until a call
+    succeeds
+
+    Download errors (including those in the middle of a transfer) fail over
+    to the next mirror. The last mirror's error is raised. `mirrors` is a
+    MirrorSelector, or None to use the url only.
+    """
+    urls = mirrors.select(url) if mirrors else [url]
+    for index, mirror in enumerate(urls):
+        try:
+            return func(mirror)
+        except DOWNLOAD_ERRORS as ex:
+            if mirrors:
+                mirrors.failed(url, mirror)
+            if index == len(urls) - 1:
+                raise
+            lgr.warning('Could not download {0} ({1}). Failing over to '
+                        '{2}...'.format(mirror, ex, urls[index + 1]))
+
+
+def _normalize_project_name(name):
+    """Normalizes a project name as PEP 503 requires
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _path_to_url(path):
+    return urlparse.urljoin(
+        'file:', urllib.pathname2url(os.path.abspath(path)))
+
+
+def _list_wheels(wheels_path):
+    return sorted(f for f in os.listdir(wheels_path) if f.endswith('.whl'))
+
+
+def _parse_wheel_name(wheel):
+    """Returns a wheel's project name and version, or None if the wheel's
+    file name is invalid
+    """
+    # name-version(-build)?-python-abi-platform.whl
+    parts = wheel[:-len('.whl')].split('-')
+    if len(parts) not in (5, 6):
+        return None
+    return parts[0], parts[1]
+
+
+def index_wheelhouse(wheels_path):
+    """Writes a PEP 503 simple index and a hash manifest for a wheelhouse
+
+    With the index, pip looks up the wheels of the projects it needs
+    rather than listing and parsing the name of every wheel in the
+    wheelhouse for each installation. The manifest maps every wheel to its
+    project, version and sha256.
+    """
+    lgr.info('Indexing wheelhouse {0}...'.format(wheels_path))
+    manifest = {}
+    projects = {}
+    for wheel in _list_wheels(wheels_path):
+        name_and_version = _parse_wheel_name(wheel)
+        if not name_and_version:
+            lgr.warning('Skipping invalid wheel name: {0}'.format(wheel))
+            continue
+        name, version = name_and_version
+        manifest[wheel] = {
+            'name': name,
+            'version': version,
+            'sha256': _hash_file(os.path.join(wheels_path, wheel)),
+        }
+        projects.setdefault(_normalize_project_name(name), []).append(wheel)
+
+    index_path = os.path.join(wheels_path, WHEELHOUSE_INDEX_DIR)
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path)
+    _mkdir(index_path)
+    page = '<!DOCTYPE html>\n<html><body>\n{0}</body></html>\n'
+    link = '<a href="{0}">{1}</a><br/>\n'
+    for project, wheels in projects.items():
+        _mkdir(os.path.join(index_path, project))
+        with open(os.path.join(index_path, project, 'index.html'), 'w') as f:
+            f.write(page.format(''.join(link.format(
+                '../../{0}#sha256={1}'.format(
+                    urllib.quote(wheel), manifest[wheel]['sha256']), wheel)
+                for wheel in wheels)))
+    with open(os.path.join(index_path, 'index.html'), 'w') as f:
+        f.write(page.format(''.join(
+            link.format('{0}/'.format(project), project)
+            for project in sorted(projects))))
+    with open(os.path.join(wheels_path, WHEELHOUSE_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    lgr.info('Indexed {0} wheels of {1} projects.'.format(
+        len(manifest), len(projects)))
+    return manifest
+
+
+def load_wheelhouse_manifest(wheels_path):
+    """Returns a wheelhouse's manifest if its index is up to date
+    """
+    index_path = os.path.join(wheels_path, WHEELHOUSE_INDEX_DIR)
+    try:
+        with open(os.path.join(wheels_path, WHEELHOUSE_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not os.path.isfile(os.path.join(index_path, 'index.html')):
+        return None
+    wheels = set(wheel for wheel in _list_wheels(wheels_path)
+                 if _parse_wheel_name(wheel))
+    if set(manifest) != wheels:
+        lgr.warning('The index of wheelhouse {0} is out of date. Use '
+                    '--indexwheelhouse to update it.'.format(wheels_path))
+        return None
+    return manifest
+
+
+def get_wheelhouse_index_url(wheels_path):
+    if load_wheelhouse_manifest(wheels_path) is None:
+        return None
+    return _path_to_url(os.path.join(wheels_path, WHEELHOUSE_INDEX_DIR)) + '/'
+
+
+def read_lock_file(path):
+    """Returns the distributions pinned by a lock file
+
+    A lock file is a requirements file pinning every distribution to a
+    version (as written by `pip freeze`), optionally followed by
+    `--hash=sha256:<digest>` options. Maps the distributions' normalized
+    names to their version and sha256 (None if not given).
+    """
+    pins = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            match = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*==\s*'
+                             r'([^\s;]+)', line)
+            if not match:
+                continue
+            digest = re.search(r'--hash[= ]sha256:([0-9a-f]+)', line)
+            pins[_normalize_project_name(match.group(1))] = {
+                'version': match.group(2),
+                'sha256': digest.group(1) if digest else None,
+            }
+    return pins
+
+
+def get_upgrade_targets(wheels_path=None, lock_file=None):
+    """Returns the distributions an environment should be upgraded to
+
+    These are the distributions pinned by `lock_file` or, without one,
+    the wheels in the manifest of the wheelhouse in `wheels_path`. Maps
+    their normalized names to their version, sha256 (None if unknown) and
+    the requirement to install them by, which is the path of their wheel
+    if it's in the wheelhouse. Returns None if they can't be told, as the
+    wheelhouse has no up to date manifest or holds several wheels of a
+    project.
+    """
+    manifest = load_wheelhouse_manifest(wheels_path) if wheels_path \
+        else None
+    wheels = {}
+    for wheel, entry in (manifest or {}).items():
+        name = _normalize_project_name(entry['name'])
+        wheels.setdefault(name, []).append(dict(entry, wheel=wheel))
+
+    if lock_file:
+        targets = read_lock_file(lock_file)
+        for name, target in targets.items():
+            target['requirement'] = '{0}=={1}'.format(name, target['version'])
+            for entry in wheels.get(name, []):
+                if _same_version(entry['version'], target['version']):
+                    target['requirement'] = os.path.join(
+                        wheels_path, entry['wheel'])
+                    target['sha256'] = target['sha256'] or entry['sha256']
+        return targets
+    if manifest is None or any(len(w) > 1 for w in wheels.values()):
+        return None
+    return dict((name, {'version': entry['version'],
+                        'sha256': entry['sha256'],
+                        'requirement': os.path.join(
+                            wheels_path, entry['wheel'])})
+                for name, (entry,) in wheels.items())
+
+
+def _same_version(version, other_version):
+    # `-` is escaped as `_` in the versions of wheel and dist-info names.
+    return version.replace('-', '_') == other_version.replace('-', '_')
+
+
+def incremental_upgrade(targets, virtualenv_path=False, wheelspath=False):
+    """Upgrades only the distributions whose version or wheel changed
+
+    The distributions installed in the environment are compared to the
+    `targets` returned by get_upgrade_targets, and only those which are
+    missing, of another version or (if they were installed by a previous
+    incremental upgrade) of another sha256 are installed, without their
+    dependencies, replacing the installed ones. Installed distributions
+    which aren't targets (other than BASE_DISTRIBUTIONS) are then
+    uninstalled, so that the environment matches a fresh installation.
+    This is only done in virtualenvs, as anything may be installed
+    system wide. Returns the last pip process, or None if everything is
+    up to date.
+    """
+    start = time.time()
+    installed = get_installed_distributions(virtualenv_path)
+    in_virtualenv = virtualenv_path or IS_VIRTUALENV
+    hashes_path = os.path.join(virtualenv_path or sys.prefix,
+                               INSTALLED_WHEELS_MANIFEST)
+    try:
+        with open(hashes_path) as f:
+            hashes = json.load(f)
+    except (IOError, ValueError):
+        hashes = {}
+
+    changed = []
+    for name, target in sorted(targets.items()):
+        version = installed.get(name)
+        if not version or not _same_version(version, target['version']):
+            lgr.info('{0}: {1} -> {2}'.format(
+                name, version or 'not installed', target['version']))
+        elif target['sha256'] and \
+                hashes.get(name, target['sha256']) != target['sha256']:
+            lgr.info('{0}: {1} (changed)'.format(name, version))
+        else:
+            continue
+        changed.append(name)
+    removed = sorted(set(installed) - set(targets) -
+                     set(BASE_DISTRIBUTIONS)) if in_virtualenv else []
+    for name in removed:
+        lgr.info('{0}: {1} -> removed'.format(name, installed[name]))
+    if not changed and not removed:
+        lgr.info('All {0} distributions are up to date.'.format(
+            len(targets)))
+        return None
+
+    result = None
+    if changed:
+        result = install_modules(
+            [targets[name]['requirement'] for name in changed],
+            virtualenv_path=virtualenv_path, wheelspath=wheelspath,
+            no_deps=True, force_reinstall=True)
+        if not result.returncode == 0:
+            return result
+    if removed:
+        result = uninstall_modules(removed, virtualenv_path=virtualenv_path)
+        if not result.returncode == 0:
+            return result
+    for name in changed:
+        if targets[name]['sha256']:
+            hashes[name] = targets[name]['sha256']
+    try:
+        with open(hashes_path, 'w') as f:
+            json.dump(hashes, f, indent=2, sort_keys=True)
+    except IOError as ex:
+        lgr.warning('Could not write {0} ({1}).'.format(hashes_path, ex))
+    duration = time.time() - start
+    lgr.info('Upgraded {0} of {1} distributions and removed {2} in '
+             '{3:.1f}s.'.format(len(changed), len(targets), len(removed),
+                                duration))
+    if changed:
+        # reinstalling everything isn't measured.
+        lgr.info('Estimated time saved by not upgrading all of them: '
+                 '{0:.1f}s.'.format(duration / len(changed) *
+                                    (len(targets) - len(changed))))
+    return result
+
+
+def _fingerprint_file(path):
+    """Returns the sha256 of a file, or its path if it can't be read
+    (e.g. a url)
+    """
+    try:
+        return _hash_file(path)
+    except (IOError, OSError):
+        return path
+
+
+def _fingerprint_wheelhouse(wheels_path):
+    """Returns a hash of the wheels in a wheelhouse
+
+    Wheelhouses without an up to date manifest are hashed by the names,
+    sizes and modification times of their wheels.
+    """
+    manifest = load_wheelhouse_manifest(wheels_path)
+    if manifest is None:
+        manifest = {}
+        for wheel in _list_wheels(wheels_path):
+            stat = os.stat(os.path.join(wheels_path, wheel))
+            manifest[wheel] = [stat.st_size, stat.st_mtime]
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def read_requirement_files(requirement_files):
+    """Returns the requirement specifiers in requirement files
+
+    Options (including nested requirement files) are ignored.
+    """
+    requirements = []
+    for req_file in requirement_files or []:
+        if '://' in req_file:
+            f = open_url(req_file)
+        else:
+            f = open(req_file)
+        try:
+            for line in f:
+                line = line.split(' #', 1)[0].strip()
+                if line and not line.startswith(('#', '-')):
+                    requirements.append(line)
+        finally:
+            f.close()
+    return requirements
+
+
+def _read_wheel_requirements(path):
+    """Returns the requirements of a wheel, with their environment markers
+    """
+    with zipfile.ZipFile(path) as wheel:
+        for name in wheel.namelist():
+            if name.endswith('.dist-info/METADATA') and name.count('/') == 1:
+                metadata = wheel.read(name)
+                break
+        else:
+            return []
+    requirements = []
+    for line in metadata.splitlines():
+        if not line.strip():
+            # the body follows the headers.
+            break
+        if line.startswith('Requires-Dist:'):
+            requirements.append(line[len('Requires-Dist:'):].strip())
+    return requirements
+
+
+def _parse_requirement(requirement):
+    """Returns a requirement specifier parsed by pkg_resources, or None if
+    it's a url, a path or otherwise can't be parsed
+    """
+    # setuptools is installed along with pip, which fetching wheels needs.
+    import pkg_resources
+    try:
+        return pkg_resources.Requirement.parse(requirement)
+    except ValueError:
+        return None
+
+
+def _requirement_applies(requirement, extras=()):
+    """Returns whether a parsed requirement applies to the running
+    interpreter, given the `extras` its requirer was required with
+    """
+    marker = getattr(requirement, 'marker', None)
+    return not marker or any(marker.evaluate({'extra': extra})
+                             for extra in ('',) + tuple(extras))
+
+
+def _format_requirement(requirement):
+    """Returns the specifier of a parsed requirement, without its
+    environment marker
+    """
+    extras = '[{0}]'.format(','.join(requirement.extras)) \
+        if requirement.extras else ''
+    url = getattr(requirement, 'url', None)
+    if url:
+        return '{0}{1} @ {2}'.format(requirement.project_name, extras, url)
+    return '{0}{1}{2}'.format(requirement.project_name, extras, ','.join(
+        op + version for op, version in requirement.specs))
+
+
+def _fetch_wheel(args):
+    """Fetches the wheel of a requirement in a thread pool worker
+    """
+    pip, requirement, destination, pre = args
+    wheel_dir = tempfile.mkdtemp(dir=destination)
+    try:
+        result = run(quote_command(
+            [pip, 'wheel', '--no-deps', '--wheel-dir', wheel_dir] +
+            (['--pre'] if pre else []) + [requirement]),
+            suppress_errors=True)
+        if not result.returncode == 0:
+            lgr.warning('Could not fetch {0}: {1}'.format(
+                requirement, result.stderr_capture.summary()))
+            return []
+        wheels = []
+        for wheel in _list_wheels(wheel_dir):
+            os.rename(os.path.join(wheel_dir, wheel),
+                      os.path.join(destination, wheel))
+            wheels.append(os.path.join(destination, wheel))
+        return wheels
+    finally:
+        shutil.rmtree(wheel_dir)
+
+
+def fetch_missing_wheels(requirements, wheels_path, destination, pip='pip',
+                         pre=False, threads=DOWNLOAD_THREADS):
+    """Fetches the wheels of requirements which are missing from a wheelhouse
+
+    The requirements are walked down from `requirements`, reading the
+    requirements of each project from the metadata of its wheels.
+    Requirements whose environment markers don't hold for the running
+    interpreter are skipped. Requirements which no wheel in the wheelhouse
+    (or fetched so far) satisfies are fetched (downloaded or built) into
+    `destination` by `threads` concurrent `pip wheel --no-deps` runs, and
+    their requirements walked in turn. Failing to fetch a wheel is only
+    logged, leaving it to the installation to fail.
+
+    Returns the paths of the fetched wheels.
+    """
+    # normalized project name -> [(version, wheel path)]
+    local_wheels = {}
+
+    def add_wheels(paths):
+        for path in paths:
+            name_and_version = _parse_wheel_name(os.path.basename(path))
+            if name_and_version:
+                name, version = name_and_version
+                # `-` is escaped as `_` in the versions of wheel names.
+                local_wheels.setdefault(_normalize_project_name(name), []) \
+                    .append((version.replace('_', '-'), path))
+
+    add_wheels(os.path.join(wheels_path, wheel)
+               for wheel in _list_wheels(wheels_path))
+    fetched = []
+    seen = set()
+    # the requirements to walk, along with the extras of their requirers.
+    requirements = [(requirement, ()) for requirement in requirements]
+    pool = ThreadPool(threads)
+    try:
+        while requirements:
+            missing = []
+            # the wheels to walk, along with the extras they're required with.
+            wheels = []
+            for requirement, extras in requirements:
+                parsed = _parse_requirement(requirement)
+                if parsed and not _requirement_applies(parsed, extras):
+                    continue
+                key = str(parsed) if parsed else requirement
+                if key in seen:
+                    continue
+                seen.add(key)
+                satisfying = [
+                    path for version, path in local_wheels.get(
+                        _normalize_project_name(parsed.project_name), [])
+                    if version in parsed] if parsed else []
+                if satisfying:
+                    wheels.extend((path, parsed.extras)
+                                  for path in satisfying)
+                else:
+                    missing.append((requirement, parsed))
+            if missing:
+                lgr.info('Fetching {0} missing requirements: {1}...'.format(
+                    len(missing), ', '.join(r for r, _ in missing)))
+            # markers were evaluated already, and pip can't take those
+            # of wheel metadata as they are.
+            for (_, parsed), fetched_wheels in zip(missing, pool.map(
+                    _fetch_wheel, [(pip, _format_requirement(missing_parsed)
+                                    if missing_parsed else requirement,
+                                    destination, pre)
+                                   for requirement, missing_parsed
+                                   in missing])):
+                add_wheels(fetched_wheels)
+                fetched.extend(fetched_wheels)
+                wheels.extend((path, parsed.extras if parsed else ())
+                              for path in fetched_wheels)
+            requirements = [(requirement, extras) for wheel, extras in wheels
+                            for requirement in _read_wheel_requirements(wheel)]
+    finally:
+        pool.close()
+        pool.join()
+    return fetched
+
+
+def _build_wheel(args):
+    """Builds a wheel of a source archive in a process pool worker
+    """
+    pip, source, wheel_dir = args
+    result = run(quote_command(
+        [pip, 'wheel', '--no-deps', '--wheel-dir', wheel_dir, source]),
+        suppress_errors=True)
+    wheels = _list_wheels(wheel_dir) if result.returncode == 0 else []
+    return source, wheel_dir, wheels, result.stderr_capture.summary()
+
+
+def build_wheelhouse(wheelhouse, requirements, requirement_files=None,
+                     pre=False, pip='pip', processes=None, tempdir=None):
+    """Builds the wheels of a set of requirements into a wheelhouse
+
+    The requirements are resolved and downloaded by pip. Downloaded wheels
+    are copied into the wheelhouse, while wheels of source archives are
+    built in parallel, by a pool of `processes` (defaults to the number of
+    CPUs) worker processes. Wheels already in the wheelhouse are kept if
+    their hashes match, and sources whose wheels were already built from
+    the same sha256 aren't built again. The wheelhouse is indexed
+    once built.
+    """
+    lgr.info('Building wheelhouse {0}...'.format(wheelhouse))
+    _mkdir(wheelhouse)
+    tempdir = tempfile.mkdtemp(dir=tempdir)
+    try:
+        downloads = os.path.join(tempdir, 'downloads')
+        pip_cmd = [pip, 'download', '--dest', downloads]
+        for req_file in requirement_files or []:
+            pip_cmd.extend(['-r', req_file])
+        if pre:
+            pip_cmd.append('--pre')
+        pip_cmd.extend(requirements)
+        result = run(quote_command(pip_cmd))
+        if not result.returncode == 0:
+            lgr.error(result.stdout_capture.summary())
+            sys.exit('Could not resolve requirements: {0}.'.format(
+                ', '.join(requirements)))
+
+        build_manifest_path = os.path.join(
+            wheelhouse, WHEELHOUSE_BUILD_MANIFEST)
+        try:
+            with open(build_manifest_path) as f:
+                build_manifest = json.load(f)
+        except (IOError, ValueError):
+            build_manifest = {}
+
+        jobs = []
+        digests = {}
+        for name in sorted(os.listdir(downloads)):
+            path = os.path.join(downloads, name)
+            digest = digests[path] = _hash_file(path)
+            if name.endswith('.whl'):
+                target = os.path.join(wheelhouse, name)
+                if os.path.isfile(target) and _hash_file(target) == digest:
+                    lgr.debug('{0} is up to date.'.format(name))
+                else:
+                    shutil.copyfile(path, target)
+                continue
+            built = build_manifest.get(name)
+            if built and built['sha256'] == digest and all(
+                    os.path.isfile(os.path.join(wheelhouse, wheel)) and
+                    _hash_file(os.path.join(wheelhouse, wheel)) == sha
+                    for wheel, sha in built['wheels'].items()):
+                lgr.debug('Wheel of {0} is up to date.'.format(name))
+                continue
+            wheel_dir = os.path.join(tempdir, 'wheels', str(len(jobs)))
+            _mkdir(wheel_dir)
+            jobs.append((pip, path, wheel_dir))
+
+        failed = []
+        if jobs:
+            lgr.info('Building {0} wheels...'.format(len(jobs)))
+            pool = multiprocessing.Pool(min(
+                len(jobs), processes or multiprocessing.cpu_count()))
+            try:
+                results = pool.map(_build_wheel, jobs)
+            finally:
+                pool.close()
+                pool.join()
+            for source, wheel_dir, wheels, errors in results:
+                name = os.path.basename(source)
+                if not wheels:
+                    lgr.error(errors)
+                    failed.append(name)
+                    continue
+                build_manifest[name] = {'sha256': digests[source],
+                                        'wheels': {}}
+                for wheel in wheels:
+                    shutil.copyfile(os.path.join(wheel_dir, wheel),
+                                    os.path.join(wheelhouse, wheel))
+                    build_manifest[name]['wheels'][wheel] = _hash_file(
+                        os.path.join(wheelhouse, wheel))
+            with open(build_manifest_path, 'w') as f:
+                json.dump(build_manifest, f, indent=2, sort_keys=True)
+    finally:
+        shutil.rmtree(tempdir)
+
+    index_wheelhouse(wheelhouse)
+    if failed:
+        sys.exit('Could not build wheels of: {0}.'.format(
+            ', '.join(failed)))
+
+
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def _link_or_copy(source, destination):
+    if os.path.isfile(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, destination)
 
 
 def get_os_props():
-    distro, _, release = platform.linux_distribution(
-        full_distribution_name=False)
-    return distro, release
+    facts = get_host_facts(HOST_FACTS_FILE)
+    return facts['distro'], facts['release']
+
+
+def read_os_release(path):
+    """Parses an os-release file (see os-release(5)) into a dict
+    """
+    props = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            try:
+                value = ''.join(shlex.split(value))
+            except ValueError:
+                pass
+            props[key] = value
+    return props
+
+
+def _find_os_release(os_release_paths):
+    for path in os_release_paths:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _which(executable):
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        executable_path = os.path.join(path, executable)
+        if os.path.isfile(executable_path) and \
+                os.access(executable_path, os.X_OK):
+            return executable_path
+    return None
+
+
+def get_package_manager(distros):
+    """Returns the package manager of the first of `distros` (e.g. an
+    os-release's ID followed by its ID_LIKE) to have its package manager
+    installed
+
+    If none do, the first package manager installed is returned, so that
+    unknown distributions are supported as well.
+    """
+    for distro in distros:
+        for package_manager, package_manager_distros in PACKAGE_MANAGERS:
+            if distro in package_manager_distros and _which(package_manager):
+                return package_manager
+    for package_manager, _ in PACKAGE_MANAGERS:
+        if _which(package_manager):
+            return package_manager
+    return None
+
+
+def _get_free_memory():
+    """Returns the memory available for new processes (in KB), or None if
+    it can't be told
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f if ':' in line)
+    except IOError:
+        return None
+    for key in ('MemAvailable', 'MemFree'):
+        if key in meminfo:
+            return int(meminfo[key].split()[0])
+    return None
+
+
+def probe_host_facts(os_release_paths=OS_RELEASE_PATHS):
+    """Returns the facts about the host the installer depends on
+    """
+    os_release_path = _find_os_release(os_release_paths)
+    os_release = read_os_release(os_release_path) if os_release_path else {}
+    distro = os_release.get('ID', '').lower()
+    distros = [distro] + os_release.get('ID_LIKE', '').lower().split()
+    return {
+        'platform': PLATFORM,
+        'distro': distro,
+        'distro_like': distros[1:],
+        'release': os_release.get('VERSION_ID', '').lower(),
+        'package_manager': get_package_manager(distros) if IS_LINUX
+        else None,
+        'arch': platform.machine(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'free_memory_kb': _get_free_memory(),
+    }
+
+
+def _get_host_facts_key(os_release_paths):
+    os_release_path = _find_os_release(os_release_paths)
+    # the package manager depends on those installed.
+    key = {'host': platform.node(), 'platform': PLATFORM,
+           'os_release': None,
+           'package_managers': [
+               package_manager for package_manager, _ in PACKAGE_MANAGERS
+               if IS_LINUX and _which(package_manager)]}
+    if os_release_path:
+        stat = os.stat(os_release_path)
+        key['os_release'] = [os_release_path, stat.st_size, stat.st_mtime]
+    return key
+
+
+def get_host_facts(cache_path=HOST_FACTS_FILE,
+                   os_release_paths=OS_RELEASE_PATHS):
+    """Returns the facts about the host, as probed by probe_host_facts
+
+    The facts are cached in `cache_path`, a JSON file with the facts under
+    "facts" which other tools may read as well. The cache is used for as
+    long as the host's name, os-release file and installed package
+    managers don't change. Free memory changes between runs, so it is
+    always read again.
+    """
+    key = _get_host_facts_key(os_release_paths)
+    if cache_path:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                facts = cached['facts']
+                facts['free_memory_kb'] = _get_free_memory()
+                return facts
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    facts = probe_host_facts(os_release_paths)
+    if cache_path:
+        try:
+            _write_json(cache_path, {'key': key, 'facts': facts})
+        except (IOError, OSError) as ex:
+            lgr.warning('Could not cache host facts in {0} ({1}).'.format(
+                cache_path, ex))
+    return facts
+
+
+def _write_json(path, data):
+    """Writes a JSON file atomically, creating its directory if missing
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    _mkdir(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        # mkstemp creates files only their owner can read.
+        os.chmod(temp_path, 0644)
+        if IS_WIN and os.path.isfile(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
 
 
 def _get_env_bin_path(env_path):
@@ -273,23 +1805,606 @@ def _get_env_bin_path(env_path):
         return os.path.join(env_path, 'scripts' if IS_WIN else 'bin')
 
 
+class CaptureBuffer(object):
+    """Captures a stream while keeping a bounded amount of it in memory
+
+    The first half of `max_memory` bytes is kept as the head of the stream
+    and the last half as its tail, in a ring. Whatever falls out of the
+    ring is spilled, in order, to a temporary file so that the whole
+    stream can still be read back.
+    """
+    def __init__(self, max_memory=CAPTURE_BUFFER_SIZE):
+        self.size = 0
+        self._head_limit = max_memory // 2
+        self._tail_limit = max_memory - self._head_limit
+        self._head = []
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._spill = None
+        self._spilled = 0
+
+    @property
+    def memory_size(self):
+        return self._head_size + self._tail_size
+
+    @property
+    def spilled(self):
+        return self._spilled
+
+    def write(self, data):
+        self.size += len(data)
+        if self._head_size < self._head_limit:
+            head = data[:self._head_limit - self._head_size]
+            self._head.append(head)
+            self._head_size += len(head)
+            data = data[len(head):]
+            if not data:
+                return
+        self._tail.append(data)
+        self._tail_size += len(data)
+        while self._tail_size > self._tail_limit:
+            chunk = self._tail.popleft()
+            excess = self._tail_size - self._tail_limit
+            if len(chunk) > excess:
+                self._tail.appendleft(chunk[excess:])
+                chunk = chunk[:excess]
+            self._spill_write(chunk)
+            self._tail_size -= len(chunk)
+
+    def _spill_write(self, data):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.write(data)
+        self._spilled += len(data)
+
+    def head(self):
+        return ''.join(self._head)
+
+    def tail(self):
+        return ''.join(self._tail)
+
+    def read(self):
+        """Returns the entire stream, including its spilled part
+        """
+        spilled = ''
+        if self._spill is not None:
+            self._spill.flush()
+            self._spill.seek(0)
+            spilled = self._spill.read()
+            self._spill.seek(0, os.SEEK_END)
+        return self.head() + spilled + self.tail()
+
+    def summary(self):
+        """Returns the entire stream if nothing was spilled, or its head
+        and tail otherwise.
+        """
+        if not self._spilled:
+            return self.head() + self.tail()
+        return '{0}\n[... {1} bytes omitted ...]\n{2}'.format(
+            self.head(), self._spilled, self.tail())
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class OutputHandler(object):
+    """Captures a process's output and logs it line by line
+    """
+    def __init__(self, logger, log_level, capture=None):
+        self.logger = logger
+        self.log_level = log_level
+        self.capture = capture or CaptureBuffer()
+        self._partial_line = ''
+
+    def write(self, data):
+        self.capture.write(data)
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self.logger.log(self.log_level, line)
+        # don't let output without newlines accumulate.
+        if len(self._partial_line) > PIPE_READ_SIZE:
+            self.logger.log(self.log_level, self._partial_line)
+            self._partial_line = ''
+
+    def close(self):
+        if self._partial_line:
+            self.logger.log(self.log_level, self._partial_line)
+            self._partial_line = ''
+
+
 class PipeReader(Thread):
-    def __init__(self, fd, proc, logger, log_level):
+    def __init__(self, fd, handler):
         Thread.__init__(self)
         self.fd = fd
-        self.proc = proc
-        self.logger = logger
-        self.log_level = log_level
-        self.aggr = ''
+        self.handler = handler
 
     def run(self):
-        while self.proc.poll() is None:
-            output = self.fd.readline()
-            if len(output) > 0:
-                self.aggr += output
-                self.logger.log(self.log_level, output)
-            else:
-                time.sleep(PROCESS_POLLING_INTERVAL)
+        for output in iter(self.fd.readline, ''):
+            self.handler.write(output)
+        self.handler.close()
+        self.fd.close()
+
+
+_phase_context = threading.local()
+
+
+def get_current_phase():
+    """Returns the Phase the current thread is in, if any
+    """
+    return getattr(_phase_context, 'phase', None)
+
+
+class Phase(object):
+    """Records the resources used by an installation phase
+
+    Phases record the commands they run and the bytes they download. They
+    are made current per thread by Timings.phase.
+    """
+    def __init__(self, name):
+        self.name = name
+        # set to a list to hold the phase's log records instead of emitting
+        # them (see PhaseLogFilter).
+        self.log_records = None
+        self.wall_time = None
+        self.self_peak_rss = None
+        self.bytes_downloaded = 0
+        self.commands = []
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def add_command(self, cmd, returncode, wall_time, cpu_time, peak_rss):
+        with self._lock:
+            self.commands.append({
+                'cmd': cmd,
+                'returncode': returncode,
+                'wall_time': wall_time,
+                'cpu_time': cpu_time,
+                'peak_rss_kb': peak_rss,
+            })
+
+    def add_download(self, size):
+        with self._lock:
+            self.bytes_downloaded += size
+
+    def hold_log_record(self, record):
+        """Holds a log record back if the phase buffers its logs
+
+        Returns whether the record was held back.
+        """
+        with self._log_lock:
+            if self.log_records is None:
+                return False
+            self.log_records.append(record)
+            return True
+
+    def stop_buffering_logs(self, emit=None):
+        """Stops holding back the phase's log records
+
+        The records held back so far are passed to `emit` before any
+        record the phase logs afterwards is emitted, and are returned.
+        """
+        with self._log_lock:
+            records = self.log_records or []
+            self.log_records = None
+            for record in records if emit else []:
+                emit(record)
+            return records
+
+    def to_dict(self):
+        cpu_times = [c['cpu_time'] for c in self.commands
+                     if c['cpu_time'] is not None]
+        peak_rss = [c['peak_rss_kb'] for c in self.commands
+                    if c['peak_rss_kb'] is not None]
+        return {
+            'name': self.name,
+            'wall_time': self.wall_time,
+            'child_cpu_time': sum(cpu_times) if cpu_times else None,
+            'peak_rss_kb': max(peak_rss) if peak_rss else None,
+            'self_peak_rss_kb': self.self_peak_rss,
+            'bytes_downloaded': self.bytes_downloaded,
+            'commands': self.commands,
+        }
+
+
+class Timings(object):
+    """Records the wall time and resources used by installation phases
+    """
+    def __init__(self):
+        self.phases = []
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name, buffer_logs=False):
+        phase = Phase(name)
+        if buffer_logs:
+            phase.log_records = []
+        self.phases.append(phase)
+        parent = get_current_phase()
+        _phase_context.phase = phase
+        start = time.time()
+        try:
+            yield phase
+        finally:
+            phase.wall_time = time.time() - start
+            if resource:
+                phase.self_peak_rss = _get_rss_kb(resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss)
+            lgr.debug('Phase {0} took {1:.2f}s, ran {2} commands and '
+                      'downloaded {3} bytes.'.format(
+                          name, phase.wall_time, len(phase.commands),
+                          phase.bytes_downloaded))
+            _phase_context.phase = parent
+
+    def to_dict(self):
+        phases = [phase.to_dict() for phase in self.phases]
+        return {
+            'platform': PLATFORM,
+            'wall_time': time.time() - self.start,
+            'bytes_downloaded': sum(p['bytes_downloaded'] for p in phases),
+            'phases': phases,
+        }
+
+    def write(self, path):
+        lgr.info('Writing timings to {0}...'.format(path))
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class PhaseLogFilter(logging.Filter):
+    """Holds back the log records of phases buffering their logs
+    """
+    def filter(self, record):
+        phase = get_current_phase()
+        return not (phase and phase.hold_log_record(record))
+
+
+class PhaseGraph(object):
+    """Runs installation phases concurrently, as their dependencies allow
+
+    Phases must be added after the phases they require. Requirements which
+    were not added are ignored, so that optional phases may be required.
+    Each phase runs in its own thread. Logs are emitted grouped per phase
+    and in the order in which phases were added, no matter which phase
+    ended first: the logs of the first phase which didn't end yet are
+    emitted as they're logged, and those of the phases after it are held
+    back until it ends.
+
+    Once a phase fails, no other phase starts, and the failure of the
+    first failed phase (in the order in which phases were added) is
+    raised once running phases end.
+
+    Given a Checkpoint, phases completed by a previous run are skipped,
+    as long as their fingerprint (a callable returning a JSON serializable
+    description of the phase's inputs, called once the phases it requires
+    end) is unchanged and none of the phases they require ran again.
+    Phases without a fingerprint always run, and must not change the
+    environment.
+    """
+    def __init__(self, timings, checkpoint=None):
+        self.timings = timings
+        self.checkpoint = checkpoint
+        self.phases = collections.OrderedDict()
+        # the phase whose logs are emitted as they're logged, and the
+        # phases which are running.
+        self._live = None
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, func, requires=(), fingerprint=None):
+        self.phases[name] = (
+            func, [r for r in requires if r in self.phases], fingerprint)
+
+    def _run_phase(self, name, func, ended):
+        phase = None
+        exc_info = None
+        try:
+            with self.timings.phase(name, buffer_logs=True) as phase:
+                with self._lock:
+                    self._running[name] = phase
+                    if name == self._live:
+                        phase.stop_buffering_logs()
+                func()
+        except BaseException:
+            exc_info = sys.exc_info()
+        with self._lock:
+            self._running.pop(name, None)
+            records = phase.stop_buffering_logs() if phase else []
+        ended.put((name, records, exc_info))
+
+    def run(self):
+        pending = collections.OrderedDict(self.phases)
+        ended = Queue.Queue()
+        # phase name -> (log records or None if skipped, exc_info)
+        results = {}
+        fingerprints = {}
+        # phases which ran and changed the environment.
+        changed = set()
+        running = 0
+        failed = False
+        names = list(self.phases)
+        emitted = 0
+        self._live = names[0] if names else None
+        while pending or running:
+            ready = not failed
+            while ready:
+                ready = False
+                for name, (func, requires, fingerprint) in pending.items():
+                    if not all(r in results for r in requires):
+                        continue
+                    del pending[name]
+                    ready = True
+                    fingerprint = fingerprints[name] = \
+                        fingerprint() if fingerprint else None
+                    if fingerprint is not None and not any(
+                            r in changed for r in requires) and \
+                            self.checkpoint and \
+                            self.checkpoint.is_completed(name, fingerprint):
+                        results[name] = (None, None)
+                        continue
+                    if fingerprint is not None or any(
+                            r in changed for r in requires):
+                        changed.add(name)
+                    running += 1
+                    thread = Thread(target=self._run_phase,
+                                    args=(name, func, ended))
+                    thread.daemon = True
+                    thread.start()
+            with self._lock:
+                while emitted < len(names) and names[emitted] in results:
+                    self._emit(names[emitted], results[names[emitted]][0])
+                    emitted += 1
+                self._live = names[emitted] if emitted < len(names) \
+                    else None
+                if self._live in self._running:
+                    self._running[self._live].stop_buffering_logs(
+                        lgr.handle)
+            if running:
+                name, records, exc_info = ended.get()
+                running -= 1
+                results[name] = (records, exc_info)
+                if exc_info is not None:
+                    failed = True
+                elif self.checkpoint and fingerprints[name] is not None:
+                    self.checkpoint.complete(name, fingerprints[name])
+            elif failed or pending:
+                break
+        for name in names[emitted:]:
+            if name in results:
+                self._emit(name, results[name][0])
+        for name in names:
+            if name in results and results[name][1]:
+                exc_info = results[name][1]
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+    @staticmethod
+    def _emit(name, records):
+        if records is None:
+            lgr.info('Skipping {0}, completed by a previous run.'.format(
+                name))
+            return
+        for record in records:
+            lgr.handle(record)
+
+
+class Checkpoint(object):
+    """Records the installation phases completed in an environment
+
+    Every completed phase is recorded along with its fingerprint, so that
+    reruns (e.g. after a later phase failed) can skip it (see PhaseGraph).
+    The checkpoint is only written once its directory exists, as it's
+    kept in the environment being installed.
+    """
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.phases = {}
+        if resume:
+            try:
+                with open(path) as f:
+                    self.phases = json.load(f)['phases']
+            except (IOError, ValueError, KeyError):
+                pass
+        self._lock = threading.Lock()
+
+    def is_completed(self, name, fingerprint):
+        # fingerprints are compared as they're read back from the file.
+        return name in self.phases and \
+            self.phases[name] == json.loads(json.dumps(fingerprint))
+
+    def complete(self, name, fingerprint):
+        with self._lock:
+            self.phases[name] = json.loads(json.dumps(fingerprint))
+            if not os.path.isdir(os.path.dirname(os.path.abspath(
+                    self.path))):
+                return
+            temp_path = '{0}.tmp'.format(self.path)
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump({'phases': self.phases}, f, indent=2,
+                              sort_keys=True)
+                if IS_WIN and os.path.isfile(self.path):
+                    os.remove(self.path)
+                os.rename(temp_path, self.path)
+            except (IOError, OSError) as ex:
+                lgr.warning('Could not write checkpoint {0} ({1}).'.format(
+                    self.path, ex))
+
+
+class FileLock(object):
+    """An exclusive lock, shared between processes using a lock file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        if IS_WIN:
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if IS_WIN:
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+
+
+class DownloadCache(object):
+    """A persistent, content addressed cache of downloaded files
+
+    Files are stored by their sha256 and indexed by the url they were
+    downloaded from, along with its ETag and Last-Modified headers. A
+    cached file is only used while the url's headers still match. Once
+    the cache grows beyond `max_size` bytes, the least recently used files
+    are evicted. The index is only accessed under a lock so that the cache
+    can be shared by concurrent installer processes.
+
+    Cache errors are logged and never fail a download.
+    """
+    def __init__(self, path=DOWNLOAD_CACHE_DIR,
+                 max_size=DOWNLOAD_CACHE_SIZE * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self._index_path = os.path.join(path, 'index.json')
+
+    @staticmethod
+    def get_validators(headers):
+        if not headers:
+            return None
+        validators = {'etag': headers.getheader('etag'),
+                      'last_modified': headers.getheader('last-modified')}
+        return validators if any(validators.values()) else None
+
+    def _get_object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def _lock(self):
+        _mkdir(self.path)
+        return FileLock(os.path.join(self.path, 'lock'))
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        temp_path = '{0}.tmp'.format(self._index_path)
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        if IS_WIN and os.path.isfile(self._index_path):
+            os.remove(self._index_path)
+        os.rename(temp_path, self._index_path)
+
+    def get(self, url, headers, destination):
+        """Puts the cached copy of a url in `destination`
+
+        Returns False if there's no up to date copy of the url.
+        """
+        validators = self.get_validators(headers)
+        try:
+            if validators:
+                with self._lock():
+                    index = self._load_index()
+                    entry = index.get(url)
+                    if entry and entry['validators'] == validators and \
+                            os.path.isfile(
+                                self._get_object_path(entry['sha256'])):
+                        _link_or_copy(self._get_object_path(entry['sha256']),
+                                      destination)
+                        entry['last_used'] = time.time()
+                        self._save_index(index)
+                        self.hits += 1
+                        self.bytes_served += entry['size']
+                        lgr.debug('Download cache hit for {0} ({1})'.format(
+                            url, entry['sha256']))
+                        return True
+        except (IOError, OSError) as ex:
+            lgr.warning('Could not read from the download cache '
+                        '({0})'.format(ex))
+        self.misses += 1
+        lgr.debug('Download cache miss for {0}'.format(url))
+        return False
+
+    def put(self, url, headers, source):
+        """Adds a url's downloaded file to the cache
+        """
+        validators = self.get_validators(headers)
+        if not validators:
+            lgr.debug('Not caching {0} as it has neither an ETag nor a '
+                      'Last-Modified header'.format(url))
+            return
+        try:
+            _mkdir(self.path)
+            fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='tmp')
+            sha = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f, open(source, 'rb') as src:
+                for block in iter(
+                        lambda: src.read(DOWNLOAD_BLOCK_SIZE), ''):
+                    sha.update(block)
+                    f.write(block)
+            digest = sha.hexdigest()
+            object_path = self._get_object_path(digest)
+            with self._lock():
+                if os.path.isfile(object_path):
+                    os.remove(temp_path)
+                else:
+                    _mkdir(os.path.dirname(object_path))
+                    # cached files may be hard linked to destinations.
+                    os.chmod(temp_path, 0444)
+                    os.rename(temp_path, object_path)
+                index = self._load_index()
+                index[url] = {
+                    'sha256': digest,
+                    'size': os.path.getsize(object_path),
+                    'validators': validators,
+                    'last_used': time.time(),
+                }
+                self._evict(index)
+                self._save_index(index)
+            lgr.debug('Cached {0} as {1}'.format(url, digest))
+        except (IOError, OSError) as ex:
+            lgr.warning('Could not write to the download cache '
+                        '({0})'.format(ex))
+
+    def _evict(self, index):
+        sizes = dict((entry['sha256'], entry['size'])
+                     for entry in index.values())
+        total_size = sum(sizes.values())
+        by_last_use = sorted(index.items(),
+                             key=lambda item: item[1]['last_used'])
+        for url, entry in by_last_use:
+            if total_size <= self.max_size:
+                break
+            del index[url]
+            digest = entry['sha256']
+            if not any(e['sha256'] == digest for e in index.values()):
+                lgr.debug('Evicting {0} ({1}) from the download '
+                          'cache'.format(url, digest))
+                os.remove(self._get_object_path(digest))
+                total_size -= sizes[digest]
+
+    def log_stats(self):
+        lgr.debug('Download cache: {0} hits, {1} misses, {2} bytes served '
+                  'from {3}'.format(self.hits, self.misses,
+                                    self.bytes_served, self.path))
 
 
 class CloudifyInstaller():
@@ -299,7 +2414,11 @@ class CloudifyInstaller():
                  pythonpath='python', installpip=False,
                  installvirtualenv=False, installpythondev=False,
                  installpycrypto=False, os_distro=None, os_release=None,
-                 **kwargs):
+                 cachedir=DOWNLOAD_CACHE_DIR, cachesize=DOWNLOAD_CACHE_SIZE,
+                 nocache=False, timingsjson=None, goldenvirtualenv=None,
+                 incrementalupgrade=False, lockfile=None, noresume=False,
+                 hybrid=False, savewheels=False, precompile=False,
+                 mirror=None, mirrorttl=MIRROR_TTL, **kwargs):
         self.force = force
         self.upgrade = upgrade
         self.virtualenv = virtualenv
@@ -314,6 +2433,27 @@ class CloudifyInstaller():
         self.installvirtualenv = installvirtualenv
         self.installpythondev = installpythondev
         self.installpycrypto = installpycrypto
+        self.cache = None if nocache else \
+            DownloadCache(cachedir, cachesize * 1024 * 1024)
+        mirrors = collections.defaultdict(list)
+        for url, mirror_url in mirror or []:
+            mirrors[url].append(mirror_url)
+        self.mirrors = MirrorSelector(mirrors, ttl=mirrorttl)
+        self.tempdir = None
+        self.cache_writers = []
+        self.timings = Timings()
+        self.timings_path = timingsjson
+        self.golden_virtualenv = goldenvirtualenv
+        self.incremental_upgrade = incrementalupgrade
+        self.lock_file = lockfile
+        self.hybrid = hybrid
+        self.save_wheels = savewheels
+        self.precompile = precompile
+        # system wide installations aren't checkpointed.
+        env_path = self.virtualenv or (sys.prefix if IS_VIRTUALENV else None)
+        self.checkpoint = Checkpoint(
+            os.path.join(env_path, CHECKPOINT_FILE),
+            resume=not noresume) if env_path else None
 
         # TODO: we should test all mutually exclusive arguments.
         if not IS_WIN and self.installpycrypto:
@@ -321,9 +2461,11 @@ class CloudifyInstaller():
         if not (IS_LINUX or IS_DARWIN) and self.installpythondev:
             lgr.warning('Pythondev only relevant on Linux or OSx.')
 
-        os_props = get_os_props()
-        self.distro = os_distro or os_props[0].lower()
-        self.release = os_release or os_props[1].lower()
+        facts = get_host_facts(HOST_FACTS_FILE)
+        self.distro = (os_distro or facts['distro']).lower()
+        self.release = (os_release or facts['release']).lower()
+        self.package_manager = get_package_manager([self.distro]) \
+            if os_distro else facts['package_manager']
 
     def execute(self):
         """Installation Logic
@@ -334,40 +2476,201 @@ class CloudifyInstaller():
         If an offline installation fails (for instance, not all wheels were
         found), an online installation process will commence.
         """
-        lgr.debug('Identified Platform: {0}'.format(PLATFORM))
-        lgr.debug('Identified Distribution: {0}'.format(self.distro))
-        lgr.debug('Identified Release: {0}'.format(self.release))
-
-        module = self.source or 'cloudify'
-
-        if self.force or self.installpip:
-            self.install_pip()
-
+        try:
+            lgr.debug('Identified Platform: {0}'.format(PLATFORM))
+            lgr.debug('Identified Distribution: {0}'.format(self.distro))
+            lgr.debug('Identified Release: {0}'.format(self.release))
+            lgr.debug('Identified Package Manager: {0}'.format(
+                self.package_manager))
+
+            self._get_phase_graph().run()
+
+            if self.virtualenv:
+                env_bin_path = _get_env_bin_path(self.virtualenv)
+                activate_path = os.path.join(env_bin_path, 'activate')
+                activate_command = \
+                    '{0}.bat'.format(activate_path) if IS_WIN \
+                    else 'source {0}'.format(activate_path)
+                lgr.info('You can now run: "{0}" to activate '
+                         'the Virtualenv.'.format(activate_command))
+        finally:
+            self._cleanup()
+
+    def _get_phase_graph(self):
+        """Returns the installation phases and the phases they require
+
+        Phases requiring root privileges all run before they're dropped,
+        as privileges are dropped for the whole process. Other than that,
+        installing python-dev, creating the virtualenv and fetching the
+        requirement files are independent of each other.
+
+        Phases changing the environment are fingerprinted by their inputs,
+        to be skipped by reruns if they were completed.
+        """
+        graph = PhaseGraph(self.timings, self.checkpoint)
+        self._add_prerequisite_phases(graph, bool(self.virtualenv))
+        if (IS_VIRTUALENV or self.virtualenv) and not IS_WIN \
+                and os.getuid() == 0:
+            # drop root permissions so that installation is done using
+            # the current user.
+            graph.add('drop_root_privileges', drop_root_privileges,
+                      requires=list(graph.phases))
+        if self.virtualenv and not os.path.isfile(os.path.join(
+                _get_env_bin_path(self.virtualenv),
+                ('activate.bat' if IS_WIN else 'activate'))):
+            graph.add('make_virtualenv', self._make_virtualenv,
+                      requires=['install_virtualenv', 'drop_root_privileges'],
+                      fingerprint=lambda: {
+                          'python': self.python_path,
+                          'golden_virtualenv': self.golden_virtualenv})
+        if IS_WIN and (self.force or self.installpycrypto):
+            graph.add('install_pycrypto',
+                      lambda: self.install_pycrypto(self.virtualenv),
+                      requires=['install_pip', 'make_virtualenv'],
+                      fingerprint=lambda: {})
+        # requirement files are fetched as the user who installs them.
+        graph.add('requirement_files', self._resolve_requirement_files,
+                  requires=['drop_root_privileges'])
+        graph.add('install_module', self._install_module,
+                  requires=list(graph.phases),
+                  fingerprint=self._get_install_module_fingerprint)
+        if self.precompile:
+            graph.add('precompile', self._precompile,
+                      requires=['install_module'], fingerprint=lambda: {})
+        return graph
+
+    def _precompile(self):
         if self.virtualenv:
-            if self.force or self.installvirtualenv:
-                self.install_virtualenv()
-            env_bin_path = _get_env_bin_path(self.virtualenv)
+            python = os.path.join(_get_env_bin_path(self.virtualenv),
+                                  'python')
+        else:
+            python = sys.executable if IS_VIRTUALENV else self.python_path
+        precompile(self.virtualenv, python=python)
 
+    def _add_prerequisite_phases(self, graph, virtualenv):
+        """Adds the phases installing system wide prerequisites
+        """
+        if self.force or self.installpip:
+            graph.add('install_pip', self.install_pip,
+                      fingerprint=lambda: {'python': self.python_path})
+        if virtualenv and (self.force or self.installvirtualenv):
+            graph.add('install_virtualenv', self.install_virtualenv,
+                      requires=['install_pip'], fingerprint=lambda: {})
         if IS_LINUX and (self.force or self.installpythondev):
-            self.install_pythondev(self.distro)
-        if (IS_VIRTUALENV or self.virtualenv) and not IS_WIN:
-            # drop root permissions so that installation is done using the
-            # current user.
-            drop_root_privileges()
-        if self.virtualenv:
-            if not os.path.isfile(os.path.join(
-                    env_bin_path, ('activate.bat' if IS_WIN else 'activate'))):
-                make_virtualenv(self.virtualenv, self.python_path)
+            graph.add('install_pythondev',
+                      lambda: self.install_pythondev(self.package_manager),
+                      fingerprint=lambda: {
+                          'distro': self.distro, 'release': self.release,
+                          'package_manager': self.package_manager})
+
+    def install_targets(self, targets, argv, jobs=None, log_dir=None):
+        """Installs Cloudify in several Virtualenvs concurrently
+
+        System wide prerequisites are installed once, and each target is
+        then installed by a child process (see install_targets). What the
+        targets share and would otherwise set up concurrently, which are
+        the golden virtualenv and the wheels fetched into the wheelhouse
+        of hybrid installations, is set up beforehand as well.
+
+        As each target drops root privileges before using what they share,
+        root privileges are dropped before setting it up, so that it's
+        owned by the user as well.
+        """
+        try:
+            graph = PhaseGraph(self.timings)
+            self._add_prerequisite_phases(graph, True)
+            if not IS_WIN and os.getuid() == 0:
+                graph.add('drop_root_privileges', drop_root_privileges,
+                          requires=list(graph.phases))
+            if self.golden_virtualenv:
+                graph.add('make_golden_virtualenv',
+                          self._make_golden_virtualenv,
+                          requires=['install_virtualenv',
+                                    'drop_root_privileges'])
+            if self._is_hybrid() and self.save_wheels:
+                graph.add('requirement_files',
+                          self._resolve_requirement_files,
+                          requires=['drop_root_privileges'])
+                graph.add('fetch_missing_wheels',
+                          lambda: self._fetch_missing_wheels(
+                              self._get_module()),
+                          requires=['install_pip', 'requirement_files'])
+            graph.run()
+        finally:
+            self._cleanup()
+        return install_targets(targets, argv, jobs=jobs, log_dir=log_dir,
+                               timings_path=self.timings_path)
+
+    def _get_install_module_fingerprint(self):
+        """Returns the inputs of the module's installation, or None if
+        they can't be told (as when upgrading to the latest version)
+        """
+        offline = not self.force_online and os.path.isdir(self.wheels_path)
+        if self.upgrade and not (self.version or offline or self.lock_file):
+            return None
+        return {
+            'module': self.source or 'cloudify',
+            'version': self.version,
+            'pre': self.pre,
+            'upgrade': self.upgrade,
+            'requirement_files': [
+                _fingerprint_file(f) for f in self.withrequirements or []],
+            'wheelhouse': _fingerprint_wheelhouse(self.wheels_path)
+            if offline else None,
+            'lock_file': _fingerprint_file(self.lock_file)
+            if self.lock_file else None,
+        }
+
+    def _make_virtualenv(self):
+        """Creates the virtualenv, cloning the golden virtualenv if set
+
+        The golden virtualenv is created first if it doesn't exist.
+        """
+        if not self.golden_virtualenv:
+            make_virtualenv(self.virtualenv, self.python_path)
+            return
+        self._make_golden_virtualenv()
+        clone_virtualenv(self.golden_virtualenv, self.virtualenv)
 
-        if IS_WIN and (self.force or self.installpycrypto):
-            self.install_pycrypto(self.virtualenv)
+    def _make_golden_virtualenv(self):
+        """Creates the golden virtualenv if it doesn't exist
 
-        # if withrequirements is not provided, this will be False.
-        # if it's provided without a value, it will be a list.
-        if isinstance(self.withrequirements, list):
-            self.withrequirements = self.withrequirements \
-                or self._get_default_requirement_files(self.source)
+        It's created under a lock, so that installers sharing it create it
+        once.
+        """
+        golden_virtualenv = os.path.abspath(self.golden_virtualenv)
+        _mkdir(os.path.dirname(golden_virtualenv))
+        with FileLock('{0}.lock'.format(golden_virtualenv)):
+            if not os.path.isfile(os.path.join(
+                    _get_env_bin_path(golden_virtualenv),
+                    ('activate.bat' if IS_WIN else 'activate'))):
+                make_virtualenv(golden_virtualenv, self.python_path)
 
+    def _get_module(self):
+        module = self.source or 'cloudify'
+        if '://' in module:
+            module = self.mirrors.select(module)[0]
+        return module
+
+    def _is_hybrid(self):
+        return self.hybrid and not self.force_online and \
+            os.path.isdir(self.wheels_path)
+
+    def _install_module(self):
+        module = self._get_module()
+        if self.upgrade and self.incremental_upgrade:
+            wheels_path = None if self.force_online \
+                or not os.path.isdir(self.wheels_path) else self.wheels_path
+            targets = get_upgrade_targets(wheels_path, self.lock_file)
+            if targets is not None:
+                result = incremental_upgrade(
+                    targets, virtualenv_path=self.virtualenv,
+                    wheelspath=wheels_path)
+                if result and not result.returncode == 0:
+                    sys.exit('Could not upgrade module: {0}.'.format(module))
+                return
+            lgr.warning('The distributions to upgrade to are unknown '
+                        '(see --lockfile). Upgrading all of them...')
         if self.force_online or not os.path.isdir(self.wheels_path):
             install_module(module=module,
                            version=self.version,
@@ -379,37 +2682,104 @@ class CloudifyInstaller():
             lgr.info('Wheels directory found: "{0}". '
                      'Attemping offline installation...'.format(
                          self.wheels_path))
-            try:
-                install_module(module=module,
-                               pre=True,
-                               virtualenv_path=self.virtualenv,
-                               wheelspath=self.wheels_path,
-                               requirement_files=self.withrequirements,
-                               upgrade=self.upgrade)
-            except Exception as ex:
-                lgr.warning('Offline installation failed ({0}).'.format(
-                    str(ex)))
+            find_links = [self._fetch_missing_wheels(module)] \
+                if self.hybrid else []
+            # install_module exits on failure, which would prevent falling
+            # back to an online installation.
+            result = install_modules([module],
+                                     pre=True,
+                                     virtualenv_path=self.virtualenv,
+                                     wheelspath=self.wheels_path,
+                                     requirement_files=self.withrequirements,
+                                     upgrade=self.upgrade,
+                                     find_links=find_links)
+            if not result.returncode == 0:
+                lgr.warning('Offline installation failed. '
+                            'Attempting online installation...')
                 install_module(module=module,
                                version=self.version,
                                pre=self.pre,
                                virtualenv_path=self.virtualenv,
                                requirement_files=self.withrequirements,
                                upgrade=self.upgrade)
+
+    def _get_pip(self):
+        pip = 'pip'
         if self.virtualenv:
-            activate_path = os.path.join(env_bin_path, 'activate')
-            activate_command = \
-                '{0}.bat'.format(activate_path) if IS_WIN \
-                else 'source {0}'.format(activate_path)
-            lgr.info('You can now run: "{0}" to activate '
-                     'the Virtualenv.'.format(activate_command))
+            pip = os.path.join(_get_env_bin_path(self.virtualenv), pip)
+        return pip
+
+    def _fetch_missing_wheels(self, module):
+        """Fetches the wheels missing from the wheelhouse
+
+        Returns the directory they're fetched to, which is the wheelhouse
+        itself if they're saved into it. Wheels are saved into the
+        wheelhouse, and it's reindexed, under a lock, so that installers
+        sharing it don't write to it concurrently.
+        """
+        requirements = [module] + read_requirement_files(
+            self.withrequirements)
+        if not self.save_wheels:
+            destination = os.path.join(self._get_tempdir(), 'missing-wheels')
+            _mkdir(destination)
+            fetch_missing_wheels(requirements, self.wheels_path, destination,
+                                 pip=self._get_pip(), pre=self.pre)
+            return destination
+        with FileLock(os.path.join(self.wheels_path, '.lock')):
+            indexed = os.path.isdir(
+                os.path.join(self.wheels_path, WHEELHOUSE_INDEX_DIR))
+            fetched = fetch_missing_wheels(
+                requirements, self.wheels_path, self.wheels_path,
+                pip=self._get_pip(), pre=self.pre)
+            if fetched and indexed:
+                index_wheelhouse(self.wheels_path)
+        return self.wheels_path
+
+    def build_wheelhouse(self, wheelhouse):
+        """Builds a wheelhouse for offline installations
+
+        The wheelhouse holds wheels of Cloudify (or --source) and of its
+        requirements, including --withrequirements files, and is indexed
+        so that it can be used as --wheelspath.
+        """
+        try:
+            with self.timings.phase('requirement_files'):
+                self._resolve_requirement_files()
+            requirement = self.source or 'cloudify'
+            if self.version:
+                requirement = '{0}=={1}'.format(requirement, self.version)
+            with self.timings.phase('build_wheelhouse'):
+                build_wheelhouse(wheelhouse, [requirement],
+                                 requirement_files=self.withrequirements,
+                                 pre=self.pre, pip=self._get_pip(),
+                                 tempdir=self._get_tempdir())
+        finally:
+            self._cleanup()
+
+    def _resolve_requirement_files(self):
+        # if withrequirements is not provided, this will be False.
+        # if it's provided without a value, it will be a list.
+        if isinstance(self.withrequirements, list):
+            self.withrequirements = self.withrequirements \
+                or self._get_default_requirement_files(self.source)
+        if self.withrequirements and self.cache:
+            self.withrequirements = self._download_requirement_files(
+                self.withrequirements)
+
+    def _cleanup(self):
+        for writer in self.cache_writers:
+            writer.join()
+        if self.tempdir:
+            shutil.rmtree(self.tempdir)
+            self.tempdir = None
+        if self.cache:
+            self.cache.log_stats()
+        if self.timings_path:
+            self.timings.write(self.timings_path)
 
     @staticmethod
     def find_virtualenv():
-        try:
-            import virtualenv  # NOQA
-            return True
-        except:
-            return False
+        return get_installed_version('virtualenv') is not None
 
     def install_virtualenv(self):
         if not self.find_virtualenv():
@@ -420,11 +2790,7 @@ class CloudifyInstaller():
 
     @staticmethod
     def find_pip():
-        try:
-            import pip  # NOQA
-            return True
-        except:
-            return False
+        return get_installed_version('pip') is not None
 
     def install_pip(self):
         lgr.info('Installing pip...')
@@ -433,7 +2799,9 @@ class CloudifyInstaller():
                 tempdir = tempfile.mkdtemp()
                 get_pip_path = os.path.join(tempdir, 'get-pip.py')
                 try:
-                    download_file(PIP_URL, get_pip_path)
+                    with_mirrors(self.mirrors, PIP_URL, lambda url:
+                                 download_file(url, get_pip_path,
+                                               cache=self.cache))
                 except StandardError as e:
                     sys.exit('Failed downloading pip from {0}. ({1})'.format(
                              PIP_URL, e.message))
@@ -446,57 +2814,125 @@ class CloudifyInstaller():
         else:
             lgr.info('pip is already installed in the path.')
 
-    @staticmethod
-    def _get_default_requirement_files(source):
+    def _download_requirement_files(self, requirement_files):
+        """Replaces requirement file urls with cached local copies
+        """
+        local_files = []
+        for index, req_file in enumerate(requirement_files):
+            if '://' in req_file and not req_file.startswith('file:'):
+                path = os.path.join(self._get_tempdir(), '{0}-{1}'.format(
+                    index, os.path.basename(req_file.rstrip('/'))))
+                try:
+                    with_mirrors(self.mirrors, req_file, lambda url:
+                                 download_file(url, path, cache=self.cache))
+                except Exception as ex:
+                    lgr.error('Could not download {0} ({1})'.format(
+                        req_file, str(ex)))
+                    sys.exit(1)
+                req_file = path
+            local_files.append(req_file)
+        return local_files
+
+    def _get_tempdir(self):
+        """Returns a temp dir which is removed once execution ends
+        """
+        if not self.tempdir:
+            self.tempdir = tempfile.mkdtemp()
+        return self.tempdir
+
+    def _get_default_requirement_files(self, source):
+        """Returns the requirement files found in a --source dir or archive
+
+        Archives are streamed and only read until their requirement files
+        are found. If the download cache holds an up to date copy of the
+        archive, it's read instead. Otherwise, when the archive can be
+        cached, the stream is also written to a file, into which the rest
+        of the archive is downloaded in the background once the requirement
+        files are found, and which is then added to the cache.
+        """
         if os.path.isdir(source):
             return [os.path.join(source, f) for f in REQUIREMENT_FILE_NAMES
                     if os.path.isfile(os.path.join(source, f))]
-        else:
-            tempdir = tempfile.mkdtemp()
-            archive = os.path.join(tempdir, 'cli_source')
-            # TODO: need to handle deletion of the temp source dir
-            try:
-                download_file(source, archive)
-            except Exception as ex:
-                lgr.error('Could not download {0} ({1})'.format(
-                    source, str(ex)))
-                sys.exit(1)
+        tempdir = self._get_tempdir()
+        archive_path = os.path.join(tempdir, 'cli_source')
+
+        def extract(url):
+            final_url, headers = resolve_url(url) if self.cache \
+                else (url, None)
+            if self.cache and self.cache.get(url, headers, archive_path):
+                archive = open(archive_path, 'rb')
+                cache_file = None
+            else:
+                lgr.info('Streaming {0}...'.format(final_url))
+                archive = open_url(final_url)
+                cache_file = open(archive_path, 'wb') \
+                    if self.cache and self.cache.get_validators(headers) \
+                    else None
             try:
-                untar_requirement_files(archive, tempdir)
-            except Exception as ex:
-                lgr.error('Could not extract {0} ({1})'.format(
-                    archive, str(ex)))
-                sys.exit(1)
-            finally:
-                os.remove(archive)
-            # GitHub always adds a single parent directory to the tree.
-            # TODO: look in parent dir, then one level underneath.
-            # the GitHub style tar assumption isn't a very good one.
-            req_dir = os.path.join(tempdir, os.listdir(tempdir)[0])
-            return [os.path.join(req_dir, f) for f in REQUIREMENT_FILE_NAMES
-                    if os.path.isfile(os.path.join(req_dir, f))]
-
-    def install_pythondev(self, distro):
+                req_files = untar_requirement_files(
+                    TeeReader(archive, cache_file) if cache_file
+                    else archive,
+                    os.path.join(tempdir, 'cli_source_requirements'))
+            except Exception:
+                archive.close()
+                if cache_file:
+                    cache_file.close()
+                raise
+            if cache_file:
+                writer = Thread(target=self._cache_rest, args=(
+                    url, headers, archive, cache_file))
+                writer.daemon = True
+                writer.start()
+                self.cache_writers.append(writer)
+            else:
+                archive.close()
+            return req_files
+        try:
+            # streamed archives fail over while being extracted as well.
+            return with_mirrors(self.mirrors, source, extract)
+        except DOWNLOAD_ERRORS as ex:
+            lgr.error('Could not download {0} ({1})'.format(
+                source, str(ex)))
+            sys.exit(1)
+        except Exception as ex:
+            lgr.error('Could not extract requirement files from {0} '
+                      '({1})'.format(source, str(ex)))
+            sys.exit(1)
+
+    def _cache_rest(self, url, headers, response, cache_file):
+        """Downloads the rest of a partly read response into `cache_file`
+        and adds it to the cache
+        """
+        try:
+            tee = TeeReader(response, cache_file)
+            with cache_file:
+                while tee.read(DOWNLOAD_BLOCK_SIZE):
+                    pass
+            length = headers.getheader('content-length', '')
+            if length.isdigit() and \
+                    os.path.getsize(cache_file.name) != int(length):
+                raise IOError('Connection closed before the end of '
+                              '{0}'.format(url))
+            self.cache.put(url, headers, cache_file.name)
+        except DOWNLOAD_ERRORS as ex:
+            lgr.debug('Could not cache {0} ({1})'.format(url, ex))
+        finally:
+            response.close()
+
+    def install_pythondev(self, package_manager):
         """Installs python-dev and gcc
 
-        This will try to match a command for your platform and distribution.
+        This will try to match a command for your platform and package
+        manager.
         """
         lgr.info('Installing python-dev...')
-        if distro in ('ubuntu', 'debian'):
-            cmd = 'apt-get install -y gcc python-dev'
-        elif distro in ('centos', 'redhat', 'fedora'):
-            cmd = 'yum -y install gcc python-devel'
-        elif os.path.isfile('/etc/arch-release'):
-            # Arch doesn't require a python-dev package.
-            # It's already supplied with Python.
-            cmd = 'pacman -S gcc --noconfirm'
-        elif IS_DARWIN:
+        if IS_DARWIN:
             lgr.info('python-dev package not required on Darwin.')
             return
-        else:
+        if package_manager not in PYTHONDEV_COMMANDS:
             sys.exit('python-dev package installation not supported '
                      'in current distribution.')
-        run(cmd)
+        run(PYTHONDEV_COMMANDS[package_manager])
 
     # Windows only
     def install_pycrypto(self, virtualenv_path):
@@ -513,35 +2949,312 @@ class CloudifyInstaller():
             '32' if is_pyx32 else '64'))
         # easy install is used instead of pip as pip doesn't handle windows
         # executables.
-        cmd = 'easy_install {0}'.format(PYCR32_URL if is_pyx32 else PYCR64_URL)
+        url = self.mirrors.select(PYCR32_URL if is_pyx32 else PYCR64_URL)[0]
+        cmd = 'easy_install {0}'.format(url)
         if virtualenv_path:
             cmd = os.path.join(_get_env_bin_path(virtualenv_path), cmd)
         run(cmd)
 
 
-def check_cloudify_installed(virtualenv_path=None):
-    if virtualenv_path:
-        result = run(
-            os.path.join(_get_env_bin_path(virtualenv_path),
-                         'python -c "import cloudify"'),
-            suppress_errors=True)
-        return result.returncode == 0
-    else:
+# matches the names of `*.dist-info`, `*.egg-info` and `*.egg` entries,
+# in which `-` is escaped as `_` in both the name and the version.
+_DISTRIBUTION_PATTERN = re.compile(
+    r'^([A-Za-z0-9_.]+)-([^-]+?)(?:-py\d.*)?'
+    r'\.(?:dist-info|egg-info|egg)$')
+
+
+def _get_site_packages(env_path=None):
+    if not env_path:
+        return [path for path in sys.path if path and os.path.isdir(path)]
+    if IS_WIN:
+        return [os.path.join(env_path, 'Lib', 'site-packages')]
+    return glob.glob(os.path.join(env_path, 'lib', 'python*',
+                                  'site-packages'))
+
+
+def _read_egg_link(path):
+    """Returns the name and version of a distribution installed in
+    develop mode, or Nones if it can't be read
+    """
+    try:
+        with open(path) as f:
+            project_path = f.readline().strip()
+        for pkg_info in glob.glob(os.path.join(
+                project_path, '*.egg-info', 'PKG-INFO')):
+            headers = {}
+            with open(pkg_info) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if not value:
+                        break
+                    headers[key.strip().lower()] = value.strip()
+            return headers.get('name'), headers.get('version')
+    except IOError:
+        pass
+    return None, None
+
+
+def get_installed_distributions(env_path=None):
+    """Returns the distributions installed in an environment
+
+    Maps the normalized names of the distributions installed in the
+    virtualenv in `env_path` (or, if not set, importable by the running
+    interpreter) to their versions. These are read from the names of the
+    `*.dist-info`, `*.egg-info` and `*.egg` entries in site-packages, so
+    that no interpreter has to be spawned nor any package imported.
+    """
+    distributions = {}
+    for site_packages in _get_site_packages(env_path):
         try:
-            import cloudify  # NOQA
-            return True
-        except ImportError:
-            return False
+            entries = sorted(os.listdir(site_packages))
+        except OSError:
+            continue
+        for entry in entries:
+            match = _DISTRIBUTION_PATTERN.match(entry)
+            if match:
+                name, version = match.groups()
+            elif entry.endswith('.egg-link'):
+                name, version = _read_egg_link(
+                    os.path.join(site_packages, entry))
+                if not name:
+                    continue
+            else:
+                continue
+            # the first distribution found is the one imported.
+            distributions.setdefault(_normalize_project_name(name), version)
+    return distributions
+
+
+def get_installed_version(name, env_path=None):
+    """Returns the version of a distribution installed in an environment,
+    or None if it isn't installed
+    """
+    return get_installed_distributions(env_path).get(
+        _normalize_project_name(name))
 
 
-def handle_upgrade(upgrade=False, virtualenv=''):
-    if check_cloudify_installed(virtualenv):
-        lgr.info('Cloudify is already installed in the path.')
+# prints the site-packages directories of an interpreter.
+_SITE_PACKAGES_SCRIPT = '''
+import site
+from distutils.sysconfig import get_python_lib
+paths = [get_python_lib(), get_python_lib(True)]
+# e.g. /usr/local/lib/python2.7/dist-packages on Debian.
+paths.extend(getattr(site, "getsitepackages", list)())
+print("\\n".join(paths))
+'''
+
+
+def _get_interpreter_site_packages(python):
+    """Returns the site-packages directories of an interpreter
+    """
+    proc = subprocess.Popen([python, '-c', _SITE_PACKAGES_SCRIPT],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if not proc.returncode == 0:
+        lgr.warning('Could not find the site-packages of {0}: {1}'.format(
+            python, stderr))
+        return []
+    paths = []
+    for path in stdout.splitlines():
+        if path and os.path.isdir(path) and path not in paths:
+            paths.append(path)
+    return paths
+
+
+# compiles the modules listed in its stdin, writing the number of modules
+# it couldn't compile.
+_PRECOMPILE_SCRIPT = '''
+import sys, py_compile
+failed = 0
+for path in sys.stdin:
+    try:
+        py_compile.compile(path.rstrip("\\n"), doraise=True)
+    except Exception:
+        failed += 1
+sys.stdout.write(str(failed))
+'''
+
+
+def _compile_modules(args):
+    """Compiles modules in a child process, in a thread pool worker
+    """
+    cmd, paths = args
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate(''.join(p + '\n' for p in paths))
+    if not proc.returncode == 0:
+        lgr.warning('Could not precompile modules: {0}'.format(stderr))
+        return len(paths)
+    return int(stdout)
+
+
+def precompile(env_path=None, python='python', processes=None):
+    """Compiles the modules in an environment's site-packages to bytecode
+
+    Otherwise, modules are compiled (and their bytecode written) as they're
+    first imported, which slows down the first run of the CLI. As bytecode
+    depends on the interpreter, the modules are compiled by `processes`
+    (defaults to the number of CPUs) concurrent `python` processes. The
+    environment is the virtualenv in `env_path` or, if not set, the
+    site-packages of `python`.
+
+    Returns the number of modules compiled.
+    """
+    paths = []
+    for site_packages in _get_site_packages(env_path) if env_path \
+            else _get_interpreter_site_packages(python):
+        if os.path.basename(site_packages) not in (
+                'site-packages', 'dist-packages'):
+            continue
+        for root, _, files in os.walk(site_packages):
+            paths.extend(os.path.join(root, f) for f in files
+                         if f.endswith('.py'))
+    if not paths:
+        return 0
+    processes = min(processes or multiprocessing.cpu_count(), len(paths))
+    lgr.info('Precompiling {0} modules...'.format(len(paths)))
+    cmd = [python, '-c', _PRECOMPILE_SCRIPT]
+    pool = ThreadPool(processes)
+    try:
+        failed = sum(pool.map(_compile_modules, [
+            (cmd, paths[i::processes]) for i in range(processes)]))
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        # e.g. modules of other Python versions, which are never imported.
+        lgr.debug('Could not compile {0} modules.'.format(failed))
+    return len(paths) - failed
+
+
+def check_cloudify_installed(virtualenv_path=None):
+    return get_installed_version('cloudify', virtualenv_path) is not None
+
+
+# arguments handled once for all targets, mapped to the number of values
+# they take (None for --target's one or two).
+_TARGETS_ARGS = {
+    '--target': None,
+    '--jobs': 1,
+    '--logdir': 1,
+    '--timingsjson': 1,
+    '-f': 0,
+    '--force': 0,
+    '--installpip': 0,
+    '--installvirtualenv': 0,
+    '--installpythondev': 0,
+}
+
+
+def get_target_argv(argv):
+    """Returns the arguments to install each target with, out of those
+    this script was called with
+    """
+    target_argv = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        option = arg.split('=', 1)[0]
+        if option not in _TARGETS_ARGS:
+            target_argv.append(arg)
+        elif '=' not in arg:
+            values = _TARGETS_ARGS[option]
+            for _ in range(2 if values is None else values):
+                if argv and (values or not argv[0].startswith('-')):
+                    argv.pop(0)
+    return target_argv
+
+
+def _get_script_path():
+    path = os.path.abspath(__file__)
+    return path[:-1] if path.endswith('.pyc') else path
+
+
+def _install_target(args):
+    """Installs a target in a child process, in a thread pool worker
+    """
+    script, argv, virtualenv, python_path, log_path, timings_path = args
+    cmd = [sys.executable, script] + argv + ['--virtualenv', virtualenv]
+    if python_path:
+        cmd.extend(['--pythonpath', python_path])
+    if timings_path:
+        cmd.extend(['--timingsjson', timings_path])
+    lgr.info('Installing Cloudify in {0} (logging to {1})...'.format(
+        virtualenv, log_path))
+    with open(log_path, 'w') as log:
+        return subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def install_targets(targets, argv, jobs=None, log_dir=None,
+                    timings_path=None, script=None):
+    """Installs Cloudify in several targets concurrently
+
+    `targets` are (virtualenv, python path) pairs, the python path being
+    None for the default one. Each target is installed by running this
+    script (or `script`) with `argv` and the target's --virtualenv and
+    --pythonpath in a child process, by a pool of `jobs` workers (which
+    defaults to the number of CPUs). The targets share the download cache
+    and the wheelhouse, and each logs to its own file in `log_dir` (which
+    defaults to a temp dir) and, if `timings_path` is set, writes its
+    timings next to it.
+
+    Returns the exit code of each target's installation, by virtualenv.
+    """
+    log_dir = log_dir or tempfile.mkdtemp(prefix='get-cloudify-')
+    _mkdir(log_dir)
+    jobs = min(jobs or multiprocessing.cpu_count(), len(targets))
+    args = []
+    for index, (virtualenv, python_path) in enumerate(targets):
+        name = '{0}-{1}'.format(index, re.sub(
+            r'[^\w.-]', '_', os.path.basename(virtualenv.rstrip('/\\'))))
+        target_timings_path = None
+        if timings_path:
+            root, ext = os.path.splitext(timings_path)
+            target_timings_path = '{0}-{1}{2}'.format(root, name, ext)
+        args.append((script or _get_script_path(), argv, virtualenv,
+                     python_path, os.path.join(log_dir, name + '.log'),
+                     target_timings_path))
+    pool = ThreadPool(jobs)
+    try:
+        returncodes = pool.map(_install_target, args)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = collections.OrderedDict()
+    for (_, _, virtualenv, _, log_path, _), returncode in zip(
+            args, returncodes):
+        results[virtualenv] = returncode
+        if returncode == 0:
+            lgr.info('Installed Cloudify in {0}.'.format(virtualenv))
+            continue
+        with open(log_path) as log:
+            tail = collections.deque(log, 20)
+        lgr.error('Could not install Cloudify in {0} (exit code {1}). The '
+                  'end of {2}:\n{3}'.format(virtualenv, returncode, log_path,
+                                            ''.join(tail).rstrip()))
+    return results
+
+
+def handle_upgrade(upgrade=False, virtualenv='', version=None):
+    """Checks whether Cloudify is already installed before installing it
+
+    Returns the installed version, if any. Exits if it must be upgraded
+    but --upgrade wasn't set, or if the requested version is installed.
+    """
+    installed_version = get_installed_version('cloudify', virtualenv)
+    if installed_version:
+        lgr.info('Cloudify {0} is already installed in the path.'.format(
+            installed_version))
+        if version == installed_version:
+            lgr.info('Nothing to install.')
+            sys.exit(0)
         if upgrade:
-            lgr.info('Upgrading...')
+            lgr.info('Upgrading from {0}...'.format(installed_version))
         else:
             lgr.error('Use the --upgrade flag to upgrade.')
             sys.exit(1)
+    return installed_version
 
 
 def parse_args(args=None):
@@ -567,6 +3280,25 @@ def parse_args(args=None):
     parser.add_argument(
         '-e', '--virtualenv', type=str,
         help='Path to a Virtualenv to install Cloudify in.')
+    parser.add_argument(
+        '--target', nargs='+', action='append',
+        metavar=('VIRTUALENV', 'PYTHONPATH'),
+        help='A Virtualenv to install Cloudify in, created using\n'
+             'PYTHONPATH (defaults to --pythonpath). Can be repeated to\n'
+             'install in several Virtualenvs concurrently.')
+    parser.add_argument(
+        '--jobs', type=int,
+        help='Number of --target installations to run concurrently\n'
+             '(defaults to the number of CPUs).')
+    parser.add_argument(
+        '--logdir', type=str, metavar='PATH',
+        help='Directory to write the log of each --target to\n'
+             '(defaults to a temporary directory).')
+    parser.add_argument(
+        '--goldenvirtualenv', type=str, metavar='PATH',
+        help='Create the Virtualenv by cloning the Virtualenv in PATH\n'
+             '(which is created if missing). Cloudify can be preinstalled\n'
+             'in it to be cloned as well.')
     version_group.add_argument(
         '--version', type=str,
         help='Attempt to install a specific version of Cloudify.')
@@ -583,12 +3315,36 @@ def parse_args(args=None):
     parser.add_argument(
         '-u', '--upgrade', action='store_true',
         help='Upgrades Cloudify if already installed.')
+    parser.add_argument(
+        '--incrementalupgrade', action='store_true',
+        help='With --upgrade, only install the distributions whose\n'
+             'version (or wheel) differs from the installed one. These\n'
+             'are pinned by --lockfile or are the wheels in --wheelspath.')
+    parser.add_argument(
+        '--lockfile', type=str, metavar='PATH',
+        help='A requirements file pinning the versions (and optionally\n'
+             'the hashes) of all distributions, for --incrementalupgrade.')
     online_group.add_argument(
         '--forceonline', action='store_true',
         help='Even if wheels are found locally, install from PyPI.')
     online_group.add_argument(
         '--wheelspath', type=str, default='wheelhouse',
         help='Path to wheels (defaults to "<cwd>/wheelhouse").')
+    parser.add_argument(
+        '--hybrid', action='store_true',
+        help='Install the wheels found in --wheelspath, downloading only\n'
+             'the missing ones.')
+    parser.add_argument(
+        '--savewheels', action='store_true',
+        help='With --hybrid, add the downloaded wheels to --wheelspath.')
+    parser.add_argument(
+        '--indexwheelhouse', action='store_true',
+        help='Write a simple index and a hash manifest for the wheels in\n'
+             '--wheelspath (used by offline installations) and exit.')
+    parser.add_argument(
+        '--buildwheelhouse', type=str, metavar='PATH',
+        help='Build wheels of Cloudify and its requirements into PATH,\n'
+             'to be used as --wheelspath, instead of installing.')
     if IS_WIN:
         parser.add_argument(
             '--pythonpath', type=str, default='c:/python27/python.exe',
@@ -599,6 +3355,39 @@ def parse_args(args=None):
             '--pythonpath', type=str, default='python',
             help='Python path to use (defaults to "python") '
                  'when creating a virtualenv.')
+    parser.add_argument(
+        '--cachedir', type=str, default=DOWNLOAD_CACHE_DIR,
+        help='Path to a cache of downloaded files shared between runs '
+             '(defaults to "{0}").'.format(DOWNLOAD_CACHE_DIR))
+    parser.add_argument(
+        '--cachesize', type=int, default=DOWNLOAD_CACHE_SIZE,
+        help='Maximum size of the download cache in MB '
+             '(defaults to {0}).'.format(DOWNLOAD_CACHE_SIZE))
+    parser.add_argument(
+        '--nocache', action='store_true',
+        help='Do not use the download cache.')
+    parser.add_argument(
+        '--mirror', nargs=2, action='append', metavar=('URL', 'MIRROR'),
+        help='A url which URL is mirrored at. Can be repeated. The\n'
+             'fastest responsive mirror of a download is used, failing\n'
+             'over to the others.')
+    parser.add_argument(
+        '--mirrorttl', type=int, default=MIRROR_TTL, metavar='SECONDS',
+        help='How long the fastest mirror of a download is used for\n'
+             'without probing its mirrors again (defaults to {0}, 0\n'
+             'probes them every time).'.format(MIRROR_TTL))
+    parser.add_argument(
+        '--precompile', action='store_true',
+        help='Compile the installed modules to bytecode, so that the\n'
+             'first run of the CLI is faster.')
+    parser.add_argument(
+        '--noresume', action='store_true',
+        help='Run all installation phases, rather than skip those\n'
+             'completed by a previous run in the same Virtualenv.')
+    parser.add_argument(
+        '--timingsjson', type=str, metavar='PATH',
+        help='Write the time and resources used by every installation\n'
+             'phase to PATH as JSON.')
     parser.add_argument(
         '--installpip', action='store_true',
         help='Attempt to install pip.')
@@ -613,10 +3402,19 @@ def parse_args(args=None):
         parser.add_argument(
             '--installpycrypto', action='store_true',
             help='Attempt to install PyCrypto.')
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.target:
+        if args.virtualenv or args.buildwheelhouse:
+            parser.error('--target can not be used with --virtualenv or '
+                         '--buildwheelhouse.')
+        if any(len(target) > 2 for target in args.target):
+            parser.error('--target takes a Virtualenv path and an optional '
+                         'Python path.')
+    return args
 
 
 lgr = init_logger(__file__)
+lgr.addFilter(PhaseLogFilter())
 
 
 if __name__ == '__main__':
@@ -627,9 +3425,23 @@ if __name__ == '__main__':
         lgr.setLevel(logging.DEBUG)
     else:
         lgr.setLevel(logging.INFO)
-    handle_upgrade(args.upgrade, args.virtualenv)
+    if args.indexwheelhouse:
+        index_wheelhouse(args.wheelspath)
+        sys.exit(0)
+    if not (args.buildwheelhouse or args.target):
+        handle_upgrade(args.upgrade, args.virtualenv, args.version)
 
     xargs = ['quiet', 'verbose']
     args = {arg: v for arg, v in vars(args).items() if arg not in xargs}
     installer = CloudifyInstaller(**args)
-    installer.execute()
+    if args['buildwheelhouse']:
+        installer.build_wheelhouse(args['buildwheelhouse'])
+    elif args['target']:
+        results = installer.install_targets(
+            [(target[0], target[1] if len(target) > 1 else None)
+             for target in args['target']],
+            get_target_argv(sys.argv[1:]), jobs=args['jobs'],
+            log_dir=args['logdir'])
+        sys.exit(0 if all(code == 0 for code in results.values()) else 1)
+    else:
+        installer.execute()
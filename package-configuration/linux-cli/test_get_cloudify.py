@@ -14,6 +14,7 @@
 # limitations under the License.
 ############
 import testtools
+import sys
 import urllib
 import tempfile
 from StringIO import StringIO
@@ -21,11 +22,33 @@ import mock
 import shutil
 import os
 import tarfile
+import resource
+import logging
+import threading
+import BaseHTTPServer
+import glob
+import json
+import hashlib
+import SocketServer
+import zipfile
+import time
+import shlex
 
 
 get_cloudify = __import__("get-cloudify")
 
 
+def setUpModule():
+    # installers cache the host's facts, which tests mustn't do in the home
+    # directory.
+    get_cloudify.HOST_FACTS_FILE = os.path.join(
+        tempfile.mkdtemp(), 'host-facts.json')
+
+
+def tearDownModule():
+    shutil.rmtree(os.path.dirname(get_cloudify.HOST_FACTS_FILE))
+
+
 class CliBuilderUnitTests(testtools.TestCase):
     """Unit tests for functions in get_cloudify.py"""
 
@@ -33,6 +56,9 @@ class CliBuilderUnitTests(testtools.TestCase):
         super(CliBuilderUnitTests, self).setUp()
         self.get_cloudify = get_cloudify
         self.get_cloudify.IS_VIRTUALENV = False
+        # some of the tests replace download_file with mocks.
+        self.addCleanup(setattr, get_cloudify, 'download_file',
+                        get_cloudify.download_file)
 
     def _create_dummy_requirements_tar(self, url, destination):
         tempdir = os.path.dirname(destination)
@@ -78,6 +104,80 @@ class CliBuilderUnitTests(testtools.TestCase):
         self.assertIsNot(proc.returncode, 0, 'command \'{}\' execution was '
                                              'expected to fail'.format(cmd))
 
+    def test_run_aggregates_output(self):
+        proc = self.get_cloudify.run('echo out; echo err >&2; printf tail')
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual('out\ntail', proc.aggr_stdout)
+        self.assertEqual('err\n', proc.aggr_stderr)
+
+    def test_run_drains_output_after_exit(self):
+        # write more than a pipe buffer to both streams so that most of
+        # the output is still unread when the process exits.
+        cmd = 'python -c "import sys; ' \
+              'sys.stdout.write(\'o\' * 200000); ' \
+              'sys.stderr.write(\'e\' * 200000)"'
+        proc = self.get_cloudify.run(cmd, suppress_errors=True)
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(200000, len(proc.aggr_stdout))
+        self.assertEqual(200000, len(proc.aggr_stderr))
+
+    def test_output_handler_logs_lines(self):
+        logger = mock.Mock()
+        handler = self.get_cloudify.OutputHandler(logger, 10)
+        handler.write('first\nsec')
+        handler.write('ond\nthird')
+        handler.close()
+        self.assertEqual(
+            [mock.call(10, 'first'), mock.call(10, 'second'),
+             mock.call(10, 'third')],
+            logger.log.call_args_list)
+        self.assertEqual('first\nsecond\nthird', handler.capture.read())
+
+    def test_capture_buffer_spills_to_disk(self):
+        capture = self.get_cloudify.CaptureBuffer(max_memory=10)
+        written = ''
+        for i in range(100):
+            chunk = str(i) * 3
+            capture.write(chunk)
+            written += chunk
+            self.assertLessEqual(capture.memory_size, 10)
+        self.assertEqual(len(written), capture.size)
+        self.assertEqual(written[:5], capture.head())
+        self.assertEqual(written[-5:], capture.tail())
+        self.assertEqual(len(written) - 10, capture.spilled)
+        self.assertEqual(written, capture.read())
+        self.assertEqual(
+            '{0}\n[... {1} bytes omitted ...]\n{2}'.format(
+                written[:5], len(written) - 10, written[-5:]),
+            capture.summary())
+        capture.close()
+
+    def test_capture_buffer_no_spill(self):
+        capture = self.get_cloudify.CaptureBuffer(max_memory=10)
+        capture.write('abc')
+        capture.write('defgh')
+        self.assertEqual(0, capture.spilled)
+        self.assertEqual('abcdefgh', capture.summary())
+
+    def test_run_output_memory_is_bounded(self):
+        # 64MB of output used to be held in memory in its entirety.
+        cmd = 'python -c "import sys; ' \
+              '[sys.stdout.write(\'x\' * 1023 + \'\\n\') ' \
+              'for _ in range(65536)]"'
+        # don't let captured debug logging skew the measurement.
+        self.addCleanup(self.get_cloudify.lgr.setLevel,
+                        self.get_cloudify.lgr.level)
+        self.get_cloudify.lgr.setLevel(logging.INFO)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        proc = self.get_cloudify.run(cmd, capture_size=1024 * 1024)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(64 * 1024 * 1024, proc.stdout_capture.size)
+        self.assertLessEqual(proc.stdout_capture.memory_size, 1024 * 1024)
+        self.assertLess(len(proc.aggr_stdout), 2 * 1024 * 1024)
+        # ru_maxrss is in kilobytes on Linux.
+        self.assertLess(rss_after - rss_before, 32 * 1024)
+
     def test_install_pip_failed_download(self):
         installer = self.get_cloudify.CloudifyInstaller()
 
@@ -126,6 +226,67 @@ class CliBuilderUnitTests(testtools.TestCase):
         self.assertEqual(
             'Could not install module: nonexisting_module.', ex.message)
 
+    def _install_modules(self, modules, log, returncode=0):
+        def run(cmd, **kwargs):
+            with open(cmd.split('--log ')[1], 'w') as f:
+                f.write(log)
+            return mock.Mock(returncode=returncode)
+        self.patch(self.get_cloudify, 'run', run)
+        return self.get_cloudify.install_modules(modules).packages
+
+    def test_install_modules_results(self):
+        packages = self._install_modules(
+            ['cloudify==3.2', 'Six', 'http://host/cloudify-dsl.tar.gz'],
+            'Requirement already satisfied: six in /lib (1.9.0)\n'
+            'Successfully installed cloudify-3.2 cloudify-rest-client-3.2\n')
+        self.assertEqual(
+            [('cloudify==3.2', ('installed', None)),
+             ('Six', ('satisfied',
+                      'Requirement already satisfied: six in /lib (1.9.0)')),
+             ('http://host/cloudify-dsl.tar.gz', ('installed', None))],
+            packages.items())
+
+    def test_install_modules_failures(self):
+        packages = self._install_modules(
+            ['cloudify', 'sh'],
+            'Requirement already satisfied: sh in /lib (1.11)\n'
+            'Collecting pycrypto (from cloudify)\n'
+            'Command "python setup.py egg_info" failed with error code 1 '
+            'in /tmp/pip-build-OqoDfm/pycrypto/\n', returncode=1)
+        self.assertEqual(
+            [('cloudify', ('skipped', None)),
+             ('sh', ('satisfied',
+                     'Requirement already satisfied: sh in /lib (1.11)')),
+             ('pycrypto', ('failed',
+                           'Command "python setup.py egg_info" failed with '
+                           'error code 1 in /tmp/pip-build-OqoDfm/'
+                           'pycrypto/'))],
+            packages.items())
+
+    def test_install_modules_quotes_specifiers(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        # a pip which records its arguments.
+        bin_path = self.get_cloudify._get_env_bin_path(tempdir)
+        os.makedirs(bin_path)
+        pip = os.path.join(bin_path, 'pip')
+        argv_path = os.path.join(tempdir, 'argv')
+        with open(pip, 'w') as f:
+            f.write('#!/bin/sh\nprintf "%s\\n" "$@" > {0}\n'.format(
+                argv_path))
+        os.chmod(pip, 0755)
+        cwd = os.getcwd()
+        os.chdir(tempdir)
+        self.addCleanup(os.chdir, cwd)
+        result = self.get_cloudify.install_modules(
+            ['requests>=2.0,<3', 'six'], virtualenv_path=tempdir)
+        self.assertEqual(0, result.returncode)
+        with open(argv_path) as f:
+            argv = f.read().splitlines()
+        self.assertEqual(['install', 'requests>=2.0,<3', 'six', '--log'],
+                         argv[:4])
+        self.assertEqual(['argv', 'bin'], sorted(os.listdir(tempdir)))
+
     def test_get_os_props(self):
         distro = self.get_cloudify.get_os_props()[0]
         distros = ('ubuntu', 'redhat', 'debian', 'fedora', 'centos',
@@ -163,17 +324,74 @@ class CliBuilderUnitTests(testtools.TestCase):
             shutil.rmtree(tmp_venv)
 
     def test_get_requirements_from_source_url(self):
-        def get(url, destination):
-            return self._create_dummy_requirements_tar(url, destination)
+        archive = self._make_tar([
+            ('maindir/dev-requirements.txt', 'sh==1.11\n')])
+        self.patch(self.get_cloudify, 'resolve_url', lambda url: (url, None))
+        self.patch(self.get_cloudify, 'open_url', lambda url: archive)
+        installer = self.get_cloudify.CloudifyInstaller()
+        self.addCleanup(installer._cleanup)
+        req_list = installer._get_default_requirement_files('null')
+        self.assertEquals(len(req_list), 1)
+        self.assertIn('dev-requirements.txt', req_list[0])
 
-        self.get_cloudify.download_file = get
-        try:
-            installer = self.get_cloudify.CloudifyInstaller()
-            req_list = installer._get_default_requirement_files('null')
-            self.assertEquals(len(req_list), 1)
-            self.assertIn('dev-requirements.txt', req_list[0])
-        finally:
-            self.get_cloudify.download_file = get_cloudify.download_file
+    def test_get_requirements_streamed_from_source_url(self):
+        archive = self._make_tar([
+            ('repo-master/setup.py', ''),
+            ('repo-master/requirements.txt', 'sh==1.11\n'),
+            ('repo-master/dev-requirements.txt', 'sh==1.11\n')])
+        self.patch(self.get_cloudify, 'open_url', lambda url: archive)
+        installer = self.get_cloudify.CloudifyInstaller(nocache=True)
+        self.addCleanup(shutil.rmtree, installer._get_tempdir())
+        req_list = installer._get_default_requirement_files('null')
+        self.assertEqual(['dev-requirements.txt', 'requirements.txt'],
+                         [os.path.basename(f) for f in req_list])
+        self.assertEqual('repo-master',
+                         os.path.basename(os.path.dirname(req_list[0])))
+        self.assertTrue(archive.closed)
+
+    @staticmethod
+    def _make_tar(members, mode='w:gz'):
+        archive = StringIO()
+        with tarfile.open(fileobj=archive, mode=mode) as tar:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, StringIO(content))
+        archive.seek(0)
+        return archive
+
+    def test_untar_requirement_files_stops_early(self):
+        archive = self._make_tar([
+            ('repo/requirements.txt', 'sh==1.11\n'),
+            ('repo/dev-requirements.txt', 'sh==1.11\n'),
+            ('repo/big', os.urandom(4 * 1024 * 1024))], mode='w')
+        archive_size = len(archive.getvalue())
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        req_list = self.get_cloudify.untar_requirement_files(archive, tempdir)
+        self.assertEqual(2, len(req_list))
+        self.assertLess(archive.tell(), archive_size / 4)
+
+    def test_untar_requirement_files_prefers_top_level(self):
+        archive = self._make_tar([
+            ('sub/dev-requirements.txt', 'sh==1.11\n'),
+            ('requirements.txt', 'sh==1.11\n')])
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        req_list = self.get_cloudify.untar_requirement_files(archive, tempdir)
+        self.assertEqual([os.path.join(tempdir, 'requirements.txt')],
+                         req_list)
+
+    def test_untar_requirement_files_ignores_deep_and_unsafe_paths(self):
+        archive = self._make_tar([
+            ('../dev-requirements.txt', 'sh==1.11\n'),
+            ('/requirements.txt', 'sh==1.11\n'),
+            ('a/b/requirements.txt', 'sh==1.11\n')])
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.assertEqual(
+            [], self.get_cloudify.untar_requirement_files(archive, tempdir))
+        self.assertEqual([], os.listdir(tempdir))
 
     def test_get_requirements_from_source_path(self):
         tempdir = tempfile.mkdtemp()
@@ -187,6 +405,1461 @@ class CliBuilderUnitTests(testtools.TestCase):
             shutil.rmtree(tempdir)
 
 
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's `content` at /file, honoring Range headers
+    """
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        server = self.server
+        server.requests.append(
+            (self.command, self.path, self.headers.getheader('Range')))
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.end_headers()
+            return
+        if self.command == 'HEAD' and not server.allow_head:
+            self.send_error(405)
+            return
+        start, end = 0, len(server.content) - 1
+        range_header = self.headers.getheader('Range')
+        if range_header and server.allow_ranges:
+            first, last = range_header.split('=')[1].split('-')
+            start, end = int(first), int(last or end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(server.content)))
+        else:
+            self.send_response(200)
+        if server.allow_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if server.etag:
+            self.send_header('ETag', server.etag)
+        body = server.content[start:end + 1]
+        self.send_header('Content-Length', str(
+            server.reported_size or len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        if server.interrupt_after:
+            # simulate a dropped connection.
+            body = body[:server.interrupt_after]
+            server.interrupt_after = 0
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class LocalServerTestCase(testtools.TestCase):
+    """Runs a local server supporting ranges for the test's downloads"""
+
+    def setUp(self):
+        super(LocalServerTestCase, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0),
+                                         RangeRequestHandler)
+        self.server.content = ''.join(
+            chr(i % 251) for i in range(1024 * 1024 + 7))
+        self.server.requests = []
+        self.server.allow_head = True
+        self.server.allow_ranges = True
+        self.server.reported_size = None
+        self.server.interrupt_after = 0
+        self.server.etag = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.destination = os.path.join(self.tempdir, 'file')
+
+    def _read_destination(self):
+        with open(self.destination, 'rb') as f:
+            return f.read()
+
+    def _get_ranges(self):
+        return sorted(r for method, _, r in self.server.requests
+                      if method == 'GET')
+
+
+class DownloadFileTests(LocalServerTestCase):
+    """Tests download_file against a local server supporting ranges"""
+
+    def test_parallel_download(self):
+        self.get_cloudify.download_file(
+            self.url + '/file', self.destination, threads=4,
+            part_size=256 * 1024)
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual(['bytes=0-262144', 'bytes=262145-524290',
+                          'bytes=524291-786436', 'bytes=786437-1048582'],
+                         self._get_ranges())
+        self.assertEqual([self.destination], glob.glob(
+            self.destination + '*'))
+
+    def test_small_file_downloaded_in_one_part(self):
+        self.get_cloudify.download_file(
+            self.url + '/file', self.destination, part_size=1024 * 1024)
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual(['bytes=0-1048582'], self._get_ranges())
+
+    def test_redirect_resolved_once(self):
+        self.get_cloudify.download_file(
+            self.url + '/redirect', self.destination, threads=2,
+            part_size=256 * 1024)
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual(
+            [('HEAD', '/redirect', None), ('HEAD', '/file', None)],
+            [r for r in self.server.requests if r[0] == 'HEAD'])
+        self.assertEqual(
+            ['/file', '/file'],
+            [path for method, path, _ in self.server.requests
+             if method == 'GET'])
+
+    def test_interrupted_download_retried_from_offset(self):
+        self.server.interrupt_after = 1000
+        self.get_cloudify.download_file(self.url + '/file', self.destination)
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual(['bytes=0-1048582', 'bytes=1000-1048582'],
+                         self._get_ranges())
+
+    def test_resume_previous_download(self):
+        self.server.interrupt_after = 1000
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        self.assertRaises(IOError, self.get_cloudify.download_file,
+                          self.url + '/file', self.destination,
+                          threads=2, part_size=256 * 1024)
+        self.assertTrue(os.path.isfile(self.destination + '.download'))
+        self.server.requests = []
+        self.get_cloudify.download_file(
+            self.url + '/file', self.destination, threads=2,
+            part_size=256 * 1024)
+        self.assertEqual(self.server.content, self._read_destination())
+        # one of the two parts was interrupted after 1000 bytes.
+        ranges = self._get_ranges()
+        self.assertEqual(1, len(ranges))
+        self.assertIn(ranges[0], ('bytes=1000-524290',
+                                  'bytes=525291-1048582'))
+        self.assertEqual([self.destination], glob.glob(
+            self.destination + '*'))
+
+    def test_download_without_ranges(self):
+        self.server.allow_ranges = False
+        self.server.interrupt_after = 1000
+        self.get_cloudify.download_file(
+            self.url + '/file', self.destination, part_size=256 * 1024)
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual([None, None], self._get_ranges())
+
+    def test_download_without_head(self):
+        self.server.allow_head = False
+        self.get_cloudify.download_file(
+            self.url + '/file', self.destination, part_size=256 * 1024)
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual([None], self._get_ranges())
+
+    def test_download_size_mismatch(self):
+        self.server.allow_ranges = False
+        self.server.reported_size = len(self.server.content) + 10
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        self.assertRaises(IOError, self.get_cloudify.download_file,
+                          self.url + '/file', self.destination)
+
+    def test_download_accounted_to_phase(self):
+        timings = self.get_cloudify.Timings()
+        with timings.phase('download') as phase:
+            self.get_cloudify.download_file(
+                self.url + '/file', self.destination, threads=4,
+                part_size=256 * 1024)
+        self.assertEqual(len(self.server.content), phase.bytes_downloaded)
+        self.assertEqual(len(self.server.content),
+                         timings.to_dict()['bytes_downloaded'])
+
+
+class MirrorTests(LocalServerTestCase):
+    """Tests selecting mirrors and failing over between them"""
+
+    def setUp(self):
+        super(MirrorTests, self).setUp()
+        self.cache_path = os.path.join(self.tempdir, 'mirrors.json')
+        # nothing listens on port 1.
+        self.dead_url = 'http://127.0.0.1:1/file'
+        self.file_url = self.url + '/file'
+        self.redirect_url = self.url + '/redirect'
+
+    def _get_selector(self, mirrors, ttl=60):
+        return self.get_cloudify.MirrorSelector(
+            mirrors, cache_path=self.cache_path, ttl=ttl)
+
+    def _read_cache(self):
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def test_select_fastest_responsive_mirror(self):
+        selector = self._get_selector({self.dead_url: [self.file_url]})
+        self.assertEqual([self.file_url, self.dead_url],
+                         selector.select(self.dead_url))
+        self.assertEqual(self.file_url,
+                         self._read_cache()[self.dead_url]['mirror'])
+        self.assertEqual([('HEAD', '/file', None)], self.server.requests)
+
+    def test_select_ordered_by_latency(self):
+        selector = self._get_selector(
+            {self.file_url: [self.dead_url, self.redirect_url]})
+        self.patch(self.get_cloudify, 'probe_mirrors',
+                   lambda urls: [0.2, None, 0.1])
+        self.assertEqual(
+            [self.redirect_url, self.file_url, self.dead_url],
+            selector.select(self.file_url))
+
+    def test_select_cached_mirror(self):
+        selector = self._get_selector({self.dead_url: [self.file_url]})
+        selector.select(self.dead_url)
+        probe = mock.Mock(side_effect=AssertionError('probed'))
+        self.patch(self.get_cloudify, 'probe_mirrors', probe)
+        self.assertEqual([self.file_url, self.dead_url], self._get_selector(
+            {self.dead_url: [self.file_url]}).select(self.dead_url))
+
+    def test_select_cached_mirror_expired(self):
+        self.get_cloudify._write_json(self.cache_path, {self.dead_url: {
+            'mirror': self.dead_url, 'time': time.time() - 61}})
+        selector = self._get_selector({self.dead_url: [self.file_url]})
+        self.assertEqual([self.file_url, self.dead_url],
+                         selector.select(self.dead_url))
+
+    def test_select_without_ttl(self):
+        selector = self._get_selector(
+            {self.dead_url: [self.file_url]}, ttl=0)
+        self.assertEqual([self.file_url, self.dead_url],
+                         selector.select(self.dead_url))
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_select_unmirrored(self):
+        probe = mock.Mock(side_effect=AssertionError('probed'))
+        self.patch(self.get_cloudify, 'probe_mirrors', probe)
+        self.assertEqual([self.file_url],
+                         self._get_selector({}).select(self.file_url))
+
+    def test_github_archive_mirror(self):
+        self.assertEqual(
+            ['https://github.com/cloudify-cosmo/cloudify-cli/archive/'
+             '3.2.tar.gz',
+             'https://codeload.github.com/cloudify-cosmo/cloudify-cli/'
+             'tar.gz/3.2'],
+            self._get_selector({}).get_mirror_urls(
+                'https://github.com/cloudify-cosmo/cloudify-cli/archive/'
+                '3.2.tar.gz'))
+
+    def test_failover_mid_transfer(self):
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        self.patch(self.get_cloudify, 'probe_mirrors',
+                   lambda urls: [0.1, 0.2])
+        self.server.interrupt_after = 1000
+        selector = self._get_selector({self.file_url: [self.redirect_url]})
+        self.get_cloudify.with_mirrors(
+            selector, self.file_url, lambda url:
+            self.get_cloudify.download_file(url, self.destination))
+        self.assertEqual(self.server.content, self._read_destination())
+        self.assertEqual(['/file', '/file'], [
+            path for method, path, _ in self.server.requests
+            if method == 'GET'])
+        # the mirror which failed isn't used by later runs.
+        self.assertNotIn(self.file_url, self._read_cache())
+
+    def test_all_mirrors_failed(self):
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        selector = self._get_selector(
+            {self.dead_url: ['http://127.0.0.1:1/other']})
+        self.assertRaises(
+            IOError, self.get_cloudify.with_mirrors, selector, self.dead_url,
+            lambda url: self.get_cloudify.download_file(
+                url, self.destination))
+
+    def test_mirror_args(self):
+        args = self.get_cloudify.parse_args([
+            '--mirror', self.file_url, self.redirect_url,
+            '--mirror', self.file_url, self.dead_url, '--mirrorttl', '0'])
+        installer = self.get_cloudify.CloudifyInstaller(**vars(args))
+        self.assertEqual([self.file_url, self.redirect_url, self.dead_url],
+                         installer.mirrors.get_mirror_urls(self.file_url))
+        self.assertEqual(0, installer.mirrors.ttl)
+
+
+class DownloadCacheTests(LocalServerTestCase):
+    """Tests downloads through a DownloadCache"""
+
+    def setUp(self):
+        super(DownloadCacheTests, self).setUp()
+        self.server.etag = '"v1"'
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.cache = self.get_cloudify.DownloadCache(self.cache_dir)
+
+    def _download(self, path='/file', cache=None):
+        self.get_cloudify.download_file(
+            self.url + path, self.destination, cache=cache or self.cache)
+        return self._read_destination()
+
+    def _get_index(self):
+        with open(os.path.join(self.cache_dir, 'index.json')) as f:
+            return json.load(f)
+
+    def test_hit_after_miss(self):
+        self.assertEqual(self.server.content, self._download())
+        self.assertEqual(1, len(self._get_ranges()))
+        os.remove(self.destination)
+        self.assertEqual(self.server.content, self._download())
+        self.assertEqual(1, len(self._get_ranges()))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(len(self.server.content), self.cache.bytes_served)
+
+    def test_content_addressed(self):
+        self._download('/file?1')
+        self._download('/file?2')
+        index = self._get_index()
+        self.assertEqual(
+            hashlib.sha256(self.server.content).hexdigest(),
+            index[self.url + '/file?1']['sha256'])
+        self.assertEqual(index[self.url + '/file?1']['sha256'],
+                         index[self.url + '/file?2']['sha256'])
+        self.assertEqual(1, len(glob.glob(
+            os.path.join(self.cache_dir, 'objects', '*', '*'))))
+
+    def test_changed_etag_is_a_miss(self):
+        self._download()
+        self.server.etag = '"v2"'
+        self.server.content = self.server.content[::-1]
+        self.assertEqual(self.server.content, self._download())
+        self.assertEqual(2, len(self._get_ranges()))
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_not_cached_without_validators(self):
+        self.server.etag = None
+        self._download()
+        self._download()
+        self.assertEqual(2, len(self._get_ranges()))
+        self.assertFalse(os.path.isfile(
+            os.path.join(self.cache_dir, 'index.json')))
+
+    def test_lru_eviction(self):
+        self.cache.max_size = len(self.server.content) * 2
+        self._download('/file?1')
+        self.server.content = self.server.content[::-1]
+        self._download('/file?2')
+        # make /file?1 the most recently used file.
+        self._download('/file?1')
+        self.server.content = self.server.content[1:]
+        self._download('/file?3')
+        self.assertEqual(
+            sorted([self.url + '/file?1', self.url + '/file?3']),
+            sorted(self._get_index()))
+        self.assertEqual(2, len(glob.glob(
+            os.path.join(self.cache_dir, 'objects', '*', '*'))))
+
+    def test_source_requirements_streamed_into_cache(self):
+        self.server.content = CliBuilderUnitTests._make_tar([
+            ('repo/requirements.txt', 'sh==1.11\n'),
+            ('repo/dev-requirements.txt', 'sh==1.11\n'),
+            ('repo/big', os.urandom(4 * 1024 * 1024))], mode='w').getvalue()
+
+        def get_requirement_files():
+            installer = self.get_cloudify.CloudifyInstaller(
+                cachedir=self.cache_dir)
+            self.addCleanup(installer._cleanup)
+            req_list = installer._get_default_requirement_files(
+                self.url + '/file')
+            self.assertEqual(2, len(req_list))
+            return installer
+
+        # the rest of the archive is cached once the installer is done.
+        get_requirement_files()._cleanup()
+        index = self._get_index()
+        self.assertEqual(hashlib.sha256(self.server.content).hexdigest(),
+                         index[self.url + '/file']['sha256'])
+
+        get_requirement_files()
+        self.assertEqual(1, len(self._get_ranges()))
+
+    def test_concurrent_access(self):
+        def download(i):
+            cache = self.get_cloudify.DownloadCache(self.cache_dir)
+            self.get_cloudify.download_file(
+                '{0}/file?{1}'.format(self.url, i),
+                '{0}{1}'.format(self.destination, i), cache=cache)
+
+        threads = [threading.Thread(target=download, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8, len(self._get_index()))
+        for i in range(8):
+            with open('{0}{1}'.format(self.destination, i), 'rb') as f:
+                self.assertEqual(self.server.content, f.read())
+
+
+class WheelhouseIndexTests(testtools.TestCase):
+    """Tests indexing wheelhouses for offline installations"""
+
+    def setUp(self):
+        super(WheelhouseIndexTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.wheelhouse = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.wheelhouse)
+        self.wheels = ['Cloudify_Rest_Client-3.2-py27-none-any.whl',
+                       'cloudify_rest_client-3.3-py27-none-any.whl',
+                       'sh-1.11-1-py2.py3-none-any.whl']
+        for wheel in self.wheels:
+            self._add_file(wheel)
+
+    def _add_file(self, name):
+        with open(os.path.join(self.wheelhouse, name), 'w') as f:
+            f.write(name)
+
+    def _read_index(self, *path):
+        with open(os.path.join(self.wheelhouse, 'simple', *path)) as f:
+            return f.read()
+
+    def test_index_wheelhouse(self):
+        self._add_file('pip-7.0.1.tar.gz')
+        self._add_file('invalid.whl')
+        manifest = self.get_cloudify.index_wheelhouse(self.wheelhouse)
+        self.assertEqual(sorted(self.wheels), sorted(manifest))
+        self.assertEqual(
+            {'name': 'sh', 'version': '1.11',
+             'sha256': hashlib.sha256(self.wheels[2]).hexdigest()},
+            manifest[self.wheels[2]])
+        with open(os.path.join(self.wheelhouse, 'manifest.json')) as f:
+            self.assertEqual(manifest, json.load(f))
+
+        root = self._read_index('index.html')
+        self.assertIn('<a href="cloudify-rest-client/">', root)
+        self.assertIn('<a href="sh/">', root)
+        project = self._read_index('cloudify-rest-client', 'index.html')
+        for wheel in self.wheels[:2]:
+            self.assertIn('<a href="../../{0}#sha256={1}">'.format(
+                wheel, manifest[wheel]['sha256']), project)
+        self.assertNotIn('sh-1.11', project)
+
+    def test_index_url(self):
+        self.assertIsNone(
+            self.get_cloudify.get_wheelhouse_index_url(self.wheelhouse))
+        self.get_cloudify.index_wheelhouse(self.wheelhouse)
+        self.assertEqual(
+            'file://{0}/simple/'.format(self.wheelhouse),
+            self.get_cloudify.get_wheelhouse_index_url(self.wheelhouse))
+
+    def test_stale_index_is_ignored(self):
+        self.get_cloudify.index_wheelhouse(self.wheelhouse)
+        self._add_file('mock-1.0-py2-none-any.whl')
+        self.assertIsNone(
+            self.get_cloudify.get_wheelhouse_index_url(self.wheelhouse))
+
+    def _get_pip_command(self, **kwargs):
+        run = mock.Mock(return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'run', run)
+        self.get_cloudify.install_module('cloudify', **kwargs)
+        return run.call_args[0][0]
+
+    def test_offline_install_uses_index(self):
+        self.get_cloudify.index_wheelhouse(self.wheelhouse)
+        cmd = self._get_pip_command(wheelspath=self.wheelhouse)
+        self.assertIn('--index-url file://{0}/simple/'.format(
+            self.wheelhouse), cmd)
+        self.assertNotIn('--find-links', cmd)
+
+    def test_offline_install_without_index(self):
+        cmd = self._get_pip_command(wheelspath=self.wheelhouse)
+        self.assertIn('--no-index --find-links {0}'.format(
+            self.wheelhouse), cmd)
+
+    def test_use_wheel_only_passed_to_old_pip(self):
+        for version, use_wheel in (('1.4.1', True), ('1.5', False),
+                                   ('10.0.1', False), (None, False)):
+            self.patch(self.get_cloudify, 'get_installed_version',
+                       lambda name, env_path: version)
+            cmd = self._get_pip_command(wheelspath=self.wheelhouse)
+            self.assertEqual(use_wheel, '--use-wheel' in cmd)
+
+
+class BuildWheelhouseTests(testtools.TestCase):
+    """Tests building wheelhouses, with pip faked"""
+
+    def setUp(self):
+        super(BuildWheelhouseTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        # builds happen in worker processes, so they're logged to a file.
+        self.build_log = os.path.join(self.tempdir, 'builds')
+        self.sdists = {'cloudify-3.2.tar.gz': 'cloudify'}
+        self.real_run = self.get_cloudify.run
+        self.patch(self.get_cloudify, 'run', self._fake_run)
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _fake_run(self, cmd, **kwargs):
+        args = shlex.split(cmd)
+        if args[1] == 'download':
+            # the arguments the shell would pass pip.
+            self.download_args = self.real_run(
+                'printf "%s\\n" ' + cmd).aggr_stdout.splitlines()
+            downloads = args[args.index('--dest') + 1]
+            os.makedirs(downloads)
+            self._write(os.path.join(
+                downloads, 'sh-1.11-py2.py3-none-any.whl'), 'sh')
+            for name, content in self.sdists.items():
+                self._write(os.path.join(downloads, name), content)
+        elif args[1] == 'wheel':
+            with open(self.build_log, 'a') as f:
+                f.write(os.path.basename(args[-1]) + '\n')
+            if 'broken' in args[-1]:
+                return self.real_run('false')
+            wheel_dir = args[args.index('--wheel-dir') + 1]
+            name, version = os.path.basename(
+                args[-1])[:-len('.tar.gz')].rsplit('-', 1)
+            self._write(os.path.join(wheel_dir, '{0}-{1}-py27-none-any.whl'
+                                     .format(name.replace('-', '_'),
+                                             version)), name)
+        return self.real_run('true')
+
+    def _build(self):
+        self.get_cloudify.build_wheelhouse(
+            self.wheelhouse, ['cloudify'], processes=2)
+
+    def _get_builds(self):
+        if not os.path.isfile(self.build_log):
+            return []
+        with open(self.build_log) as f:
+            return f.read().splitlines()
+
+    def test_build_wheelhouse(self):
+        self.sdists['cloudify-rest-client-3.2.tar.gz'] = 'rest'
+        self._build()
+        self.assertEqual(
+            ['cloudify-3.2-py27-none-any.whl',
+             'cloudify_rest_client-3.2-py27-none-any.whl',
+             'sh-1.11-py2.py3-none-any.whl'],
+            self.get_cloudify._list_wheels(self.wheelhouse))
+        self.assertEqual(['cloudify-3.2.tar.gz',
+                          'cloudify-rest-client-3.2.tar.gz'],
+                         sorted(self._get_builds()))
+        self.assertIsNotNone(
+            self.get_cloudify.get_wheelhouse_index_url(self.wheelhouse))
+
+    def test_requirement_specifiers_passed_to_pip(self):
+        cwd = os.getcwd()
+        os.chdir(self.tempdir)
+        self.addCleanup(os.chdir, cwd)
+        self.get_cloudify.build_wheelhouse(
+            self.wheelhouse, ['cloudify>=3.2,<3.3', 'sh'], processes=2)
+        self.assertEqual(['cloudify>=3.2,<3.3', 'sh'],
+                         self.download_args[-2:])
+
+    def test_unchanged_sources_are_not_rebuilt(self):
+        self._build()
+        self._build()
+        self.assertEqual(['cloudify-3.2.tar.gz'], self._get_builds())
+        self.sdists['cloudify-3.2.tar.gz'] = 'changed'
+        self._build()
+        self.assertEqual(['cloudify-3.2.tar.gz'] * 2, self._get_builds())
+
+    def test_changed_wheels_are_rebuilt(self):
+        self._build()
+        self._write(os.path.join(
+            self.wheelhouse, 'cloudify-3.2-py27-none-any.whl'), 'changed')
+        self._build()
+        self.assertEqual(['cloudify-3.2.tar.gz'] * 2, self._get_builds())
+
+    def test_failed_build(self):
+        self.sdists['broken-1.0.tar.gz'] = 'broken'
+        ex = self.assertRaises(SystemExit, self._build)
+        self.assertEqual('Could not build wheels of: broken-1.0.tar.gz.',
+                         ex.message)
+        self.assertIn('cloudify-3.2-py27-none-any.whl',
+                      os.listdir(self.wheelhouse))
+
+
+class InstalledDistributionsTests(testtools.TestCase):
+    """Tests reading the distributions installed in virtualenvs"""
+
+    def setUp(self):
+        super(InstalledDistributionsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.env = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.env)
+        self.site_packages = os.path.join(
+            self.env, 'lib', 'python2.7', 'site-packages')
+        os.makedirs(self.site_packages)
+
+    def _add(self, name, content=None):
+        path = os.path.join(self.site_packages, name)
+        if content is None:
+            os.mkdir(path)
+        else:
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def test_installed_distributions(self):
+        self._add('cloudify-3.2.dist-info')
+        self._add('cloudify_rest_client-3.2rc1.dist-info')
+        self._add('argparse-1.2.1-py2.7.egg-info', '')
+        self._add('pycrypto-2.6-py2.7-linux-x86_64.egg')
+        self._add('Fabric-1.8.3-py2.7.egg-info')
+        self._add('cloudify')
+        self._add('six.py', '')
+        project = os.path.join(self.env, 'src', 'cloudify-dsl-parser')
+        os.makedirs(os.path.join(project, 'dsl_parser.egg-info'))
+        with open(os.path.join(
+                project, 'dsl_parser.egg-info', 'PKG-INFO'), 'w') as f:
+            f.write('Metadata-Version: 1.0\nName: cloudify-dsl-parser\n'
+                    'Version: 3.3a1\n\nDescription: DSL\n')
+        self._add('cloudify-dsl-parser.egg-link', project + '\n.')
+        self.assertEqual(
+            {'cloudify': '3.2',
+             'cloudify-rest-client': '3.2rc1',
+             'argparse': '1.2.1',
+             'pycrypto': '2.6',
+             'fabric': '1.8.3',
+             'cloudify-dsl-parser': '3.3a1'},
+            self.get_cloudify.get_installed_distributions(self.env))
+        self.assertEqual('3.2rc1', self.get_cloudify.get_installed_version(
+            'Cloudify_Rest_Client', self.env))
+        self.assertTrue(
+            self.get_cloudify.check_cloudify_installed(self.env))
+
+    def test_not_installed(self):
+        self.assertIsNone(
+            self.get_cloudify.get_installed_version('cloudify', self.env))
+        self.assertIsNone(self.get_cloudify.get_installed_version(
+            'cloudify', os.path.join(self.env, 'missing')))
+
+    def test_current_interpreter(self):
+        self.assertEqual(mock.__version__,
+                         self.get_cloudify.get_installed_version('mock'))
+
+    def test_handle_upgrade(self):
+        self.assertIsNone(self.get_cloudify.handle_upgrade(
+            virtualenv=self.env))
+        self._add('cloudify-3.2.dist-info')
+        ex = self.assertRaises(SystemExit, self.get_cloudify.handle_upgrade,
+                               virtualenv=self.env)
+        self.assertEqual(1, ex.code)
+        ex = self.assertRaises(SystemExit, self.get_cloudify.handle_upgrade,
+                               upgrade=True, virtualenv=self.env,
+                               version='3.2')
+        self.assertEqual(0, ex.code)
+        self.assertEqual('3.2', self.get_cloudify.handle_upgrade(
+            upgrade=True, virtualenv=self.env, version='3.3'))
+
+
+class HybridInstallTests(testtools.TestCase):
+    """Tests installing from wheelhouses missing some wheels"""
+
+    def setUp(self):
+        super(HybridInstallTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        self.destination = os.path.join(self.tempdir, 'missing')
+        os.makedirs(self.wheelhouse)
+        os.makedirs(self.destination)
+        # requirements of the wheels pip would fetch
+        self.remote = {'sh': [], 'requests': ['urllib3 (>=1.0)'],
+                       'urllib3': []}
+        self._make_wheel(self.wheelhouse, 'cloudify', [
+            'cloudify-rest-client (==1.0)', 'sh', 'mock; extra == "test"'])
+        self._make_wheel(self.wheelhouse, 'cloudify_rest_client',
+                         ['requests>=2.7.0,<3.0.0'])
+        self.fetched = []
+        # the requirements pip was passed.
+        self.requirements = []
+        self.patch(self.get_cloudify, 'run', self._fake_run)
+
+    def _make_wheel(self, directory, name, requirements):
+        path = os.path.join(directory, '{0}-1.0-py2-none-any.whl'.format(
+            name))
+        with zipfile.ZipFile(path, 'w') as wheel:
+            wheel.writestr('{0}-1.0.dist-info/METADATA'.format(name), (
+                'Metadata-Version: 2.0\nName: {0}\nVersion: 1.0\n{1}\n'
+                'Requires-Dist: not-a-header\n').format(name, ''.join(
+                    'Requires-Dist: {0}\n'.format(requirement)
+                    for requirement in requirements)))
+        return path
+
+    def _fake_run(self, cmd, **kwargs):
+        args = shlex.split(cmd)
+        requirement = args[-1]
+        self.requirements.append(requirement)
+        name = self.get_cloudify._get_requirement_name(requirement)
+        self.fetched.append(name)
+        if name not in self.remote:
+            return mock.Mock(returncode=1, stderr_capture=mock.Mock(
+                summary=lambda: 'Not found'))
+        self._make_wheel(args[args.index('--wheel-dir') + 1], name,
+                         self.remote[name])
+        return mock.Mock(returncode=0)
+
+    def test_fetch_missing_wheels(self):
+        fetched = self.get_cloudify.fetch_missing_wheels(
+            ['cloudify', 'nonexisting'], self.wheelhouse, self.destination)
+        self.assertEqual(['nonexisting', 'requests', 'sh', 'urllib3'],
+                         sorted(self.fetched))
+        self.assertEqual(
+            sorted(os.path.join(self.destination, '{0}-1.0-py2-none-any.whl'
+                                .format(name))
+                   for name in self.remote),
+            sorted(fetched))
+        self.assertEqual(sorted(os.path.basename(path) for path in fetched),
+                         sorted(os.listdir(self.destination)))
+
+    def test_fetch_unsatisfied_versions(self):
+        self.remote['cloudify-rest-client'] = []
+        self.get_cloudify.fetch_missing_wheels(
+            ['cloudify-rest-client>=2.0'], self.wheelhouse, self.destination)
+        self.assertEqual(['cloudify-rest-client'], self.fetched)
+
+    def test_fetch_missing_wheels_evaluates_markers(self):
+        self.get_cloudify.fetch_missing_wheels(
+            ['cloudify[test]', 'sh; python_version < "2.0"',
+             'six; sys_platform == "nonexisting"'],
+            self.wheelhouse, self.destination)
+        self.assertEqual(['mock', 'requests', 'sh', 'urllib3'],
+                         sorted(self.fetched))
+
+    def test_fetch_missing_wheels_without_markers(self):
+        self.remote['enum34'] = []
+        self._make_wheel(self.wheelhouse, 'cloudify_plugins_common', [
+            'enum34; python_version < "3.4"',
+            'requests[security] (>=2.7.0,<3.0.0); python_version < "3"'])
+        self.get_cloudify.fetch_missing_wheels(
+            ['cloudify-plugins-common'], self.wheelhouse, self.destination)
+        self.assertEqual(['enum34', 'requests', 'urllib3'],
+                         sorted(self.fetched))
+        self.assertIn('enum34', self.requirements)
+        # specifiers may be ordered either way.
+        parse = self.get_cloudify._parse_requirement
+        self.assertIn(parse('requests[security]>=2.7.0,<3.0.0'),
+                      [parse(requirement)
+                       for requirement in self.requirements])
+        self.assertIn('enum34-1.0-py2-none-any.whl',
+                      os.listdir(self.destination))
+
+    def test_read_requirement_files(self):
+        path = os.path.join(self.tempdir, 'requirements.txt')
+        with open(path, 'w') as f:
+            f.write('# comment\n-r other.txt\nsh==1.11  # pinned\n\n'
+                    '--index-url http://host\nrequests>=2.7\n')
+        self.assertEqual(['sh==1.11', 'requests>=2.7'],
+                         self.get_cloudify.read_requirement_files([path]))
+
+    def test_offline_failure_falls_back_online(self):
+        install_modules = mock.Mock(return_value=mock.Mock(returncode=1))
+        install_module = mock.Mock()
+        self.patch(self.get_cloudify, 'install_modules', install_modules)
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        installer = self.get_cloudify.CloudifyInstaller(
+            wheelspath=self.wheelhouse, hybrid=True, savewheels=True)
+        installer._install_module()
+        self.assertEqual([self.wheelhouse],
+                         install_modules.call_args[1]['find_links'])
+        self.assertIn('sh-1.0-py2-none-any.whl',
+                      os.listdir(self.wheelhouse))
+        self.assertIsNone(install_module.call_args[1].get('wheelspath'))
+
+
+class IncrementalUpgradeTests(testtools.TestCase):
+    """Tests upgrading only the distributions which changed"""
+
+    def setUp(self):
+        super(IncrementalUpgradeTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        self.env = os.path.join(self.tempdir, 'env')
+        self.site_packages = os.path.join(
+            self.env, 'lib', 'python2.7', 'site-packages')
+        os.makedirs(self.wheelhouse)
+        os.makedirs(self.site_packages)
+        for wheel in ('cloudify-3.3-py27-none-any.whl',
+                      'sh-1.11-py27-none-any.whl',
+                      'six-1.9.0-py2.py3-none-any.whl'):
+            self._add_wheel(wheel)
+        for dist_info in ('cloudify-3.2.dist-info', 'sh-1.11.dist-info'):
+            os.mkdir(os.path.join(self.site_packages, dist_info))
+        self.install_modules = mock.Mock(
+            return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'install_modules',
+                   self.install_modules)
+        self.uninstall_modules = mock.Mock(
+            return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'uninstall_modules',
+                   self.uninstall_modules)
+
+    def _add_wheel(self, wheel, content=None):
+        with open(os.path.join(self.wheelhouse, wheel), 'w') as f:
+            f.write(content or wheel)
+
+    def _upgrade(self, lock_file=None):
+        self.get_cloudify.index_wheelhouse(self.wheelhouse)
+        targets = self.get_cloudify.get_upgrade_targets(
+            self.wheelhouse, lock_file)
+        self.install_modules.reset_mock()
+        return self.get_cloudify.incremental_upgrade(
+            targets, virtualenv_path=self.env, wheelspath=self.wheelhouse)
+
+    def _get_installed(self):
+        if not self.install_modules.called:
+            return []
+        return [os.path.basename(requirement) for requirement
+                in self.install_modules.call_args[0][0]]
+
+    def test_only_changed_versions_installed(self):
+        self._upgrade()
+        self.assertEqual(['cloudify-3.3-py27-none-any.whl',
+                          'six-1.9.0-py2.py3-none-any.whl'],
+                         self._get_installed())
+        kwargs = self.install_modules.call_args[1]
+        self.assertTrue(kwargs['no_deps'])
+        self.assertTrue(kwargs['force_reinstall'])
+
+    def test_dropped_distributions_uninstalled(self):
+        for dist_info in ('requests-2.7.0.dist-info', 'pip-7.1.dist-info',
+                          'setuptools-18.0.dist-info'):
+            os.mkdir(os.path.join(self.site_packages, dist_info))
+        self._upgrade()
+        self.uninstall_modules.assert_called_once_with(
+            ['requests'], virtualenv_path=self.env)
+
+        shutil.rmtree(os.path.join(self.site_packages,
+                                   'requests-2.7.0.dist-info'))
+        self.uninstall_modules.reset_mock()
+        self._upgrade()
+        self.assertFalse(self.uninstall_modules.called)
+
+    def test_changed_wheels_installed(self):
+        self._upgrade()
+        for dist_info in ('cloudify-3.3.dist-info', 'six-1.9.0.dist-info'):
+            os.mkdir(os.path.join(self.site_packages, dist_info))
+        shutil.rmtree(os.path.join(self.site_packages,
+                                   'cloudify-3.2.dist-info'))
+        self.assertIsNone(self._upgrade())
+        self.assertEqual([], self._get_installed())
+        self._add_wheel('six-1.9.0-py2.py3-none-any.whl', 'rebuilt')
+        self._upgrade()
+        self.assertEqual(['six-1.9.0-py2.py3-none-any.whl'],
+                         self._get_installed())
+
+    def test_lock_file(self):
+        self._add_wheel('cloudify-3.2-py27-none-any.whl')
+        self.get_cloudify.index_wheelhouse(self.wheelhouse)
+        self.assertIsNone(
+            self.get_cloudify.get_upgrade_targets(self.wheelhouse))
+        lock_file = os.path.join(self.tempdir, 'lock.txt')
+        with open(lock_file, 'w') as f:
+            f.write('# pinned\nCloudify==3.2\nsh==1.12  # newer\n'
+                    'six==1.9.0 --hash=sha256:abcd\n-e git+https://x\n')
+        self.assertEqual(
+            {'cloudify': {'version': '3.2', 'sha256': None},
+             'sh': {'version': '1.12', 'sha256': None},
+             'six': {'version': '1.9.0', 'sha256': 'abcd'}},
+            self.get_cloudify.read_lock_file(lock_file))
+        self._upgrade(lock_file)
+        self.assertEqual(['sh==1.12', 'six-1.9.0-py2.py3-none-any.whl'],
+                         self._get_installed())
+
+
+class CloneVirtualenvTests(testtools.TestCase):
+    """Tests cloning virtualenvs"""
+
+    def setUp(self):
+        super(CloneVirtualenvTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.source = os.path.join(self.tempdir, 'golden')
+        self.destination = os.path.join(self.tempdir, 'clone')
+
+    def _write(self, path, content, mode=0o644):
+        path = os.path.join(self.source, path)
+        self.get_cloudify._mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, mode)
+
+    def _read(self, path):
+        with open(os.path.join(self.destination, path)) as f:
+            return f.read()
+
+    def test_clone(self):
+        self._write('bin/activate', 'VIRTUAL_ENV="{0}"\nOTHER={0}2\n'.format(
+            self.source))
+        self._write('bin/pip', '#!{0}/bin/python\n'.format(self.source),
+                    mode=0o755)
+        self._write('bin/python', '\0{0}'.format(self.source), mode=0o755)
+        self._write('lib/python2.7/site-packages/mod.py', self.source)
+        self._write('lib/python2.7/site-packages/dev.egg-link',
+                    self.source + '/src\n')
+        os.symlink('lib', os.path.join(self.source, 'lib64'))
+        os.symlink(os.path.join(self.source, 'bin/python'),
+                   os.path.join(self.source, 'bin/python2'))
+        os.symlink('/usr/lib/os.py',
+                   os.path.join(self.source, 'lib/python2.7/os.py'))
+        self.patch(self.get_cloudify, '_reflink', mock.Mock(
+            side_effect=IOError(95, 'Operation not supported')))
+
+        self.get_cloudify.clone_virtualenv(self.source, self.destination)
+
+        self.assertEqual('VIRTUAL_ENV="{0}"\nOTHER={1}2\n'.format(
+            self.destination, self.source), self._read('bin/activate'))
+        self.assertEqual('#!{0}/bin/python\n'.format(self.destination),
+                         self._read('bin/pip'))
+        self.assertTrue(os.access(
+            os.path.join(self.destination, 'bin/pip'), os.X_OK))
+        self.assertEqual(self.destination + '/src\n', self._read(
+            'lib/python2.7/site-packages/dev.egg-link'))
+        for path in ('bin/python', 'lib/python2.7/site-packages/mod.py'):
+            # copies, so that writing to the clone leaves the source intact.
+            self.assertFalse(os.path.samefile(
+                os.path.join(self.source, path),
+                os.path.join(self.destination, path)))
+            with open(os.path.join(self.source, path)) as f:
+                self.assertEqual(f.read(), self._read(path))
+        self.assertEqual('lib', os.readlink(
+            os.path.join(self.destination, 'lib64')))
+        self.assertEqual(os.path.join(self.destination, 'bin/python'),
+                         os.readlink(os.path.join(
+                             self.destination, 'bin/python2')))
+        self.assertEqual('/usr/lib/os.py', os.readlink(os.path.join(
+            self.destination, 'lib/python2.7/os.py')))
+        self.assertEqual('#!{0}/bin/python\n'.format(self.source),
+                         open(os.path.join(self.source, 'bin/pip')).read())
+
+    def test_clone_virtualenv(self):
+        self.get_cloudify.make_virtualenv(self.source, 'python')
+        self.get_cloudify.clone_virtualenv(self.source, self.destination)
+        result = self.get_cloudify.run('{0} -c "import sys; '
+                                       'print(sys.prefix)"'.format(
+                                           os.path.join(self.destination,
+                                                        'bin', 'python')))
+        self.assertEqual(self.destination, result.aggr_stdout.strip())
+        self.assertEqual(0, self.get_cloudify.run('{0} --version'.format(
+            os.path.join(self.destination, 'bin', 'pip'))).returncode)
+
+    def test_golden_virtualenv_created(self):
+        installer = self.get_cloudify.CloudifyInstaller(
+            virtualenv=self.destination, goldenvirtualenv=self.source)
+        make_virtualenv = mock.Mock()
+        clone_virtualenv = mock.Mock()
+        self.patch(self.get_cloudify, 'make_virtualenv', make_virtualenv)
+        self.patch(self.get_cloudify, 'clone_virtualenv', clone_virtualenv)
+        installer._make_virtualenv()
+        make_virtualenv.assert_called_once_with(self.source, 'python')
+        clone_virtualenv.assert_called_once_with(self.source,
+                                                 self.destination)
+
+
+class InstallTargetsTests(testtools.TestCase):
+    """Tests installing in several targets concurrently"""
+
+    def setUp(self):
+        super(InstallTargetsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.log_dir = os.path.join(self.tempdir, 'logs')
+        # prints its arguments and fails for virtualenvs named "broken".
+        self.script = os.path.join(self.tempdir, 'script.py')
+        with open(self.script, 'w') as f:
+            f.write('import sys\n'
+                    'print(" ".join(sys.argv[1:]))\n'
+                    'sys.exit(3 if sys.argv[-1].endswith("broken") or '
+                    'sys.argv[-3].endswith("broken") else 0)\n')
+
+    def test_install_targets(self):
+        results = self.get_cloudify.install_targets(
+            [('/envs/a', None), ('/envs/broken', 'python3'),
+             ('/envs/c/', None)],
+            ['--upgrade', '--cachedir', '/cache'], jobs=2,
+            log_dir=self.log_dir, script=self.script)
+        self.assertEqual(
+            [('/envs/a', 0), ('/envs/broken', 3), ('/envs/c/', 0)],
+            results.items())
+        self.assertEqual(['0-a.log', '1-broken.log', '2-c.log'],
+                         sorted(os.listdir(self.log_dir)))
+        with open(os.path.join(self.log_dir, '1-broken.log')) as f:
+            self.assertEqual('--upgrade --cachedir /cache --virtualenv '
+                             '/envs/broken --pythonpath python3\n', f.read())
+
+    def test_shared_state_set_up_once(self):
+        wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        os.makedirs(os.path.join(wheelhouse, 'simple'))
+        golden = os.path.join(self.tempdir, 'golden')
+        calls = []
+        self.patch(self.get_cloudify, 'make_virtualenv', mock.Mock(
+            side_effect=lambda path, python: calls.append('make_virtualenv')))
+        self.patch(self.get_cloudify, 'fetch_missing_wheels', mock.Mock(
+            side_effect=lambda *args, **kwargs: calls.append('fetch')))
+        self.patch(self.get_cloudify, 'install_targets', mock.Mock(
+            side_effect=lambda *args, **kwargs: calls.append('targets')))
+        installer = self.get_cloudify.CloudifyInstaller(
+            wheelspath=wheelhouse, hybrid=True, savewheels=True,
+            goldenvirtualenv=golden, nocache=True)
+        installer.install_targets([('/envs/a', None)], [])
+        self.assertEqual(['fetch', 'make_virtualenv', 'targets'],
+                         sorted(calls))
+        self.assertEqual('targets', calls[-1])
+
+    def test_shared_state_set_up_as_user(self):
+        wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        os.makedirs(os.path.join(wheelhouse, 'simple'))
+        calls = []
+
+        def record(name):
+            return mock.Mock(
+                side_effect=lambda *args, **kwargs: calls.append(name))
+
+        self.patch(self.get_cloudify.os, 'getuid', lambda: 0)
+        for name in ('drop_root_privileges', 'make_virtualenv',
+                     'fetch_missing_wheels', 'install_targets'):
+            self.patch(self.get_cloudify, name, record(name))
+        installer = self.get_cloudify.CloudifyInstaller(
+            force=True, wheelspath=wheelhouse, hybrid=True, savewheels=True,
+            goldenvirtualenv=os.path.join(self.tempdir, 'golden'),
+            nocache=True)
+        for name in ('install_pip', 'install_virtualenv',
+                     'install_pythondev'):
+            self.patch(installer, name, record(name))
+        installer.install_targets([('/envs/a', None)], [])
+        # the shared state is set up once root privileges were dropped
+        # after installing the prerequisites.
+        dropped = calls.index('drop_root_privileges')
+        self.assertEqual(['install_pip', 'install_pythondev',
+                          'install_virtualenv'], sorted(calls[:dropped]))
+        self.assertEqual(['fetch_missing_wheels', 'make_virtualenv'],
+                         sorted(calls[dropped + 1:-1]))
+        self.assertEqual('install_targets', calls[-1])
+
+    def test_golden_virtualenv_created_once(self):
+        golden = os.path.join(self.tempdir, 'golden')
+
+        def make_virtualenv(path, python):
+            time.sleep(0.1)
+            os.makedirs(os.path.join(path, 'bin'))
+            open(os.path.join(path, 'bin', 'activate'), 'w').close()
+
+        make_virtualenv = mock.Mock(side_effect=make_virtualenv)
+        self.patch(self.get_cloudify, 'make_virtualenv', make_virtualenv)
+        installers = [self.get_cloudify.CloudifyInstaller(
+            goldenvirtualenv=golden, nocache=True) for _ in range(4)]
+        threads = [threading.Thread(target=installer._make_golden_virtualenv)
+                   for installer in installers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        make_virtualenv.assert_called_once_with(golden, 'python')
+
+    def test_get_target_argv(self):
+        self.assertEqual(
+            ['-v', '--upgrade', '--wheelspath', 'wheels', '--pre'],
+            self.get_cloudify.get_target_argv([
+                '-v', '--target', 'a', '--target', 'b', 'python3', '-f',
+                '--upgrade', '--jobs', '2', '--logdir=/logs',
+                '--installpip', '--wheelspath', 'wheels', '--timingsjson',
+                't.json', '--pre']))
+
+    def test_target_args(self):
+        args = self.get_cloudify.parse_args(
+            ['--target', 'a', '--target', 'b', 'python3', '--jobs', '2'])
+        self.assertEqual([['a'], ['b', 'python3']], args.target)
+        self.assertEqual(2, args.jobs)
+        for invalid_args in (['--target', 'a', 'b', 'c'],
+                             ['--target', 'a', '--virtualenv', 'b']):
+            self.assertRaises(SystemExit, self.get_cloudify.parse_args,
+                              invalid_args)
+
+
+OS_RELEASE_FIXTURES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'os-release')
+
+
+class HostFactsTests(testtools.TestCase):
+    """Tests probing and caching the host's facts"""
+
+    def setUp(self):
+        super(HostFactsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.cache_path = os.path.join(self.tempdir, 'host-facts.json')
+        self.patch(self.get_cloudify, 'IS_LINUX', True)
+        self.installed = set()
+        self.patch(self.get_cloudify, '_which', lambda name: os.path.join(
+            '/usr/bin', name) if name in self.installed else None)
+
+    def _probe(self, fixture, *installed):
+        self.installed = set(installed)
+        return self.get_cloudify.probe_host_facts(
+            [os.path.join(OS_RELEASE_FIXTURES, fixture)])
+
+    def test_read_os_release(self):
+        os_release = self.get_cloudify.read_os_release(
+            os.path.join(OS_RELEASE_FIXTURES, 'centos-7'))
+        self.assertEqual('centos', os_release['ID'])
+        self.assertEqual('rhel fedora', os_release['ID_LIKE'])
+        self.assertEqual('7', os_release['VERSION_ID'])
+        self.assertEqual('CentOS Linux 7 (Core)', os_release['PRETTY_NAME'])
+        self.assertEqual('23', self.get_cloudify.read_os_release(os.path.join(
+            OS_RELEASE_FIXTURES, 'fedora-23'))['VERSION_ID'])
+
+    def test_probe_host_facts(self):
+        for fixture, installed, expected in [
+                ('ubuntu-14.04', ['apt-get'], ('ubuntu', '14.04', 'apt-get')),
+                ('centos-7', ['yum'], ('centos', '7', 'yum')),
+                ('fedora-23', ['dnf', 'yum'], ('fedora', '23', 'dnf')),
+                ('arch', ['pacman'], ('arch', '', 'pacman')),
+                ('opensuse-42.1', ['zypper'],
+                 ('opensuse', '42.1', 'zypper')),
+                ('elementary-0.3', ['apt-get'],
+                 ('elementary', '0.3.2', 'apt-get'))]:
+            facts = self._probe(fixture, *installed)
+            self.assertEqual(expected, (
+                facts['distro'], facts['release'], facts['package_manager']))
+            self.assertEqual(self.get_cloudify.multiprocessing.cpu_count(),
+                             facts['cpu_count'])
+        self.assertEqual(['rhel', 'fedora'],
+                         self._probe('centos-7', 'yum')['distro_like'])
+
+    def test_probe_host_facts_unknown_distribution(self):
+        facts = self._probe('missing', 'yum')
+        self.assertEqual(('', '', 'yum'), (
+            facts['distro'], facts['release'], facts['package_manager']))
+        self.assertIsNone(self._probe('ubuntu-14.04')['package_manager'])
+
+    def test_get_host_facts_cached(self):
+        os_release = os.path.join(self.tempdir, 'os-release')
+        shutil.copy(os.path.join(OS_RELEASE_FIXTURES, 'ubuntu-14.04'),
+                    os_release)
+        self.installed = set(['apt-get'])
+        facts = self.get_cloudify.get_host_facts(
+            self.cache_path, [os_release])
+        self.assertEqual('ubuntu', facts['distro'])
+        with open(self.cache_path) as f:
+            self.assertEqual('apt-get', json.load(f)['facts'][
+                'package_manager'])
+        self.assertEqual(0o644, os.stat(self.cache_path).st_mode & 0o777)
+
+        probe = mock.Mock(side_effect=AssertionError('probed'))
+        with mock.patch.object(self.get_cloudify, 'probe_host_facts', probe):
+            self.assertEqual(facts['package_manager'],
+                             self.get_cloudify.get_host_facts(
+                                 self.cache_path,
+                                 [os_release])['package_manager'])
+
+        # package managers may be installed or removed once cached.
+        self.installed = set(['yum'])
+        self.assertEqual('yum', self.get_cloudify.get_host_facts(
+            self.cache_path, [os_release])['package_manager'])
+
+        shutil.copy(os.path.join(OS_RELEASE_FIXTURES, 'centos-7'),
+                    os_release)
+        self.installed = set(['yum'])
+        facts = self.get_cloudify.get_host_facts(
+            self.cache_path, [os_release])
+        self.assertEqual(('centos', 'yum'),
+                         (facts['distro'], facts['package_manager']))
+
+    def test_get_host_facts_corrupt_cache(self):
+        with open(self.cache_path, 'w') as f:
+            f.write('{"key": ')
+        self.installed = set(['apt-get'])
+        facts = self.get_cloudify.get_host_facts(self.cache_path, [
+            os.path.join(OS_RELEASE_FIXTURES, 'ubuntu-14.04')])
+        self.assertEqual('ubuntu', facts['distro'])
+
+    def test_install_pythondev(self):
+        self.patch(self.get_cloudify, 'IS_DARWIN', False)
+        run = mock.Mock()
+        self.patch(self.get_cloudify, 'run', run)
+        installer = self.get_cloudify.CloudifyInstaller(nocache=True)
+        installer.install_pythondev('zypper')
+        run.assert_called_once_with(
+            'zypper --non-interactive install gcc python-devel')
+        self.assertRaises(SystemExit, installer.install_pythondev, None)
+
+
+class PrecompileTests(testtools.TestCase):
+    """Tests precompiling site-packages"""
+
+    def setUp(self):
+        super(PrecompileTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.env = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.env)
+        self.site_packages = os.path.join(
+            self.env, 'lib', 'python2.7', 'site-packages')
+        self.modules = [os.path.join(self.site_packages, path) for path in (
+            'six.py', 'cloudify/__init__.py', 'cloudify/cli/main.py',
+            'jinja2/asyncsupport.py')]
+        for path in self.modules:
+            self.get_cloudify._mkdir(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('async def f(): pass\n' if 'async' in path
+                        else 'x = 1\n')
+        with open(os.path.join(self.env, 'lib', 'python2.7', 'os.py'),
+                  'w') as f:
+            f.write('x = 1\n')
+
+    def test_precompile(self):
+        self.assertEqual(3, self.get_cloudify.precompile(
+            self.env, python=sys.executable, processes=2))
+        for path in self.modules[:3]:
+            self.assertTrue(os.path.isfile(path + 'c'))
+        self.assertFalse(os.path.isfile(self.modules[3] + 'c'))
+        self.assertFalse(os.path.isfile(os.path.join(
+            self.env, 'lib', 'python2.7', 'os.pyc')))
+
+    def test_precompile_interpreter(self):
+        # an interpreter whose site-packages are those of the environment.
+        python = os.path.join(self.env, 'python')
+        with open(python, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'case "$2" in *get_python_lib*) echo {0}; exit;; esac\n'
+                    'exec {1} "$@"\n'.format(self.site_packages,
+                                             sys.executable))
+        os.chmod(python, 0o755)
+        self.assertEqual([self.site_packages], self.get_cloudify
+                         ._get_interpreter_site_packages(python))
+        self.assertEqual(3, self.get_cloudify.precompile(python=python))
+        self.assertTrue(os.path.isfile(self.modules[0] + 'c'))
+
+    def test_precompile_args(self):
+        self.assertFalse(self.get_cloudify.parse_args([]).precompile)
+        self.assertTrue(
+            self.get_cloudify.parse_args(['--precompile']).precompile)
+
+
+class TimingsTests(testtools.TestCase):
+    """Tests the per phase timings"""
+
+    def setUp(self):
+        super(TimingsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.timings = self.get_cloudify.Timings()
+
+    def test_commands_recorded(self):
+        with self.timings.phase('phase') as phase:
+            self.get_cloudify.run(
+                'python -c "sum(range(10 ** 6)); '
+                'bytearray(64 * 1024 * 1024)"')
+            self.get_cloudify.run('exit 3', suppress_errors=True)
+        self.assertIsNone(self.get_cloudify.get_current_phase())
+        self.assertEqual([0, 3], [c['returncode'] for c in phase.commands])
+        phase_dict = phase.to_dict()
+        self.assertGreater(phase_dict['child_cpu_time'], 0)
+        self.assertGreater(phase_dict['peak_rss_kb'], 64 * 1024)
+        self.assertGreaterEqual(phase_dict['wall_time'],
+                                phase.commands[0]['wall_time'])
+
+    def test_commands_outside_phases_not_recorded(self):
+        self.get_cloudify.run('echo Hi!')
+        with self.timings.phase('phase') as phase:
+            pass
+        self.assertEqual([], phase.commands)
+
+    def test_nested_phases(self):
+        with self.timings.phase('outer') as outer:
+            with self.timings.phase('inner') as inner:
+                self.get_cloudify.run('echo Hi!')
+            self.assertIs(outer, self.get_cloudify.get_current_phase())
+        self.assertEqual([], outer.commands)
+        self.assertEqual(1, len(inner.commands))
+
+    def test_write(self):
+        with self.timings.phase('phase'):
+            self.get_cloudify.run('echo Hi!')
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'timings.json')
+        self.timings.write(path)
+        with open(path) as f:
+            timings = json.load(f)
+        self.assertEqual(['phase'], [p['name'] for p in timings['phases']])
+        self.assertEqual('echo Hi!',
+                         timings['phases'][0]['commands'][0]['cmd'])
+
+
+class PhaseGraphTests(testtools.TestCase):
+    """Tests running installation phases concurrently"""
+
+    def setUp(self):
+        super(PhaseGraphTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.graph = self.get_cloudify.PhaseGraph(self.get_cloudify.Timings())
+        self.stream = StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.get_cloudify.lgr.addHandler(handler)
+        self.addCleanup(self.get_cloudify.lgr.removeHandler, handler)
+        self.addCleanup(self.get_cloudify.lgr.setLevel,
+                        self.get_cloudify.lgr.level)
+        self.get_cloudify.lgr.setLevel(logging.INFO)
+        self.ran = []
+
+    def _phase(self, name, wait_for=None, set_event=None, fail=False):
+        def run():
+            self.get_cloudify.lgr.info('{0} started'.format(name))
+            if set_event:
+                set_event.set()
+            if wait_for:
+                self.assertTrue(wait_for.wait(10))
+            self.ran.append(name)
+            if fail:
+                sys.exit('{0} failed'.format(name))
+            self.get_cloudify.lgr.info('{0} ended'.format(name))
+        return run
+
+    def test_independent_phases_run_concurrently(self):
+        first, second = threading.Event(), threading.Event()
+        self.graph.add('a', self._phase('a', wait_for=second,
+                                        set_event=first))
+        self.graph.add('b', self._phase('b', wait_for=first,
+                                        set_event=second))
+        self.graph.run()
+        self.assertEqual(['a', 'b'], sorted(self.ran))
+
+    def test_requirements_run_first(self):
+        self.graph.add('a', self._phase('a'))
+        self.graph.add('b', self._phase('b'), requires=['a', 'missing'])
+        self.graph.add('c', self._phase('c'), requires=['b'])
+        self.graph.run()
+        self.assertEqual(['a', 'b', 'c'], self.ran)
+
+    def test_logs_grouped_in_order(self):
+        b_ended = threading.Event()
+        self.graph.add('a', self._phase('a', wait_for=b_ended))
+        self.graph.add('b', self._phase('b'))
+        self.graph.add('c', lambda: b_ended.set(), requires=['b'])
+        self.graph.run()
+        self.assertEqual(['b', 'a'], self.ran)
+        self.assertEqual('a started\na ended\nb started\nb ended\n',
+                         self.stream.getvalue())
+
+    def test_first_phase_logs_streamed(self):
+        b_started = threading.Event()
+        logged = []
+
+        def a():
+            self.get_cloudify.lgr.info('a started')
+            self.assertTrue(b_started.wait(10))
+            logged.append(self.stream.getvalue())
+            self.get_cloudify.lgr.info('a ended')
+
+        def b():
+            self.get_cloudify.lgr.info('b started')
+            b_started.set()
+            # once a ends, b's logs are emitted as they're logged.
+            deadline = time.time() + 10
+            while 'b started' not in self.stream.getvalue() and \
+                    time.time() < deadline:
+                time.sleep(0.01)
+            self.get_cloudify.lgr.info('b ended')
+            logged.append(self.stream.getvalue())
+
+        self.graph.add('a', a)
+        self.graph.add('b', b)
+        self.graph.run()
+        self.assertEqual(['a started\n',
+                          'a started\na ended\nb started\nb ended\n'],
+                         logged)
+
+    def test_failure(self):
+        self.graph.add('a', self._phase('a', fail=True))
+        self.graph.add('b', self._phase('b'), requires=['a'])
+        ex = self.assertRaises(SystemExit, self.graph.run)
+        self.assertEqual('a failed', ex.message)
+        self.assertEqual(['a'], self.ran)
+        self.assertEqual('a started\n', self.stream.getvalue())
+
+    def _run_graph(self, checkpoint_path, fingerprints, resume=True,
+                   fail=None):
+        self.ran = []
+        self.stream.truncate(0)
+        graph = self.get_cloudify.PhaseGraph(
+            self.get_cloudify.Timings(),
+            self.get_cloudify.Checkpoint(checkpoint_path, resume=resume))
+        graph.add('a', self._phase('a', fail=fail == 'a'),
+                  fingerprint=lambda: fingerprints['a'])
+        graph.add('b', self._phase('b'))
+        graph.add('c', self._phase('c', fail=fail == 'c'),
+                  requires=['a', 'b'], fingerprint=lambda: fingerprints['c'])
+        graph.add('d', self._phase('d'), requires=['c'],
+                  fingerprint=lambda: fingerprints['d'])
+        graph.run()
+        return sorted(self.ran)
+
+    def test_checkpoint(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'checkpoint.json')
+        fingerprints = {'a': {'version': '3.2'}, 'c': ['x'], 'd': None}
+        self.assertRaises(SystemExit, self._run_graph, path, fingerprints,
+                          fail='c')
+        self.assertEqual(['a', 'b', 'c'], sorted(self.ran))
+        with open(path) as f:
+            self.assertEqual({'a': {'version': '3.2'}},
+                             json.load(f)['phases'])
+
+        # completed phases are skipped, phases without fingerprints aren't.
+        self.assertEqual(['b', 'c', 'd'],
+                         self._run_graph(path, fingerprints))
+        self.assertIn('Skipping a, completed by a previous run.',
+                      self.stream.getvalue())
+        self.assertEqual(['b', 'd'], self._run_graph(path, fingerprints))
+
+        # phases requiring phases which ran again run again as well.
+        fingerprints['a'] = {'version': '3.3'}
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         self._run_graph(path, fingerprints))
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         self._run_graph(path, fingerprints, resume=False))
+
+    def test_checkpoint_not_written_without_directory(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'env', 'checkpoint.json')
+        checkpoint = self.get_cloudify.Checkpoint(path)
+        checkpoint.complete('a', {})
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+        os.mkdir(os.path.dirname(path))
+        checkpoint.complete('b', [])
+        self.assertEqual({'a': {}, 'b': []},
+                         self.get_cloudify.Checkpoint(path).phases)
+
+    def test_logs_outside_phases_not_held(self):
+        self.get_cloudify.lgr.info('outside')
+        self.assertEqual('outside\n', self.stream.getvalue())
+
+
 class TestArgParser(testtools.TestCase):
     """Unit tests for functions in get_cloudify.py"""
 
@@ -227,6 +1900,15 @@ class TestArgParser(testtools.TestCase):
         self.assertIsNone(args.version)
         self.assertIsNone(args.virtualenv)
         self.assertEqual(args.wheelspath, 'wheelhouse')
+        self.assertFalse(args.nocache)
+        self.assertEqual(args.cachedir, self.get_cloudify.DOWNLOAD_CACHE_DIR)
+        self.assertIsNone(args.timingsjson)
+        self.assertIsNone(args.goldenvirtualenv)
+        self.assertFalse(args.incrementalupgrade)
+        self.assertIsNone(args.lockfile)
+        self.assertFalse(args.noresume)
+        self.assertFalse(args.hybrid)
+        self.assertFalse(args.savewheels)
 
     def test_args_chosen(self):
         self.get_cloudify.IS_LINUX = True
@@ -0,0 +1,643 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+import testtools
+import sys
+import os
+import copy
+import collections
+import shutil
+import tarfile
+import tempfile
+import threading
+import BaseHTTPServer
+from StringIO import StringIO
+import mock
+
+try:
+    import packman  # NOQA
+except ImportError:
+    # get.py builds packages with packman, which these tests mock anyway.
+    for name in ('packman', 'packman.logger', 'packman.packman',
+                 'packman.utils', 'packman.python'):
+        sys.modules[name] = mock.MagicMock()
+
+import get
+
+
+# the Ubuntu-trusty-agent config of packages.yaml.
+UBUNTU_TRUSTY_AGENT = {
+    'name': 'Ubuntu-trusty-agent',
+    'version': '3.3.0',
+    'source_urls': [
+        'https://github.com/cloudify-cosmo/cloudify-manager/archive/'
+        'master.tar.gz'],
+    'package_path': '/agents/Ubuntu-agent',
+    'sources_path': '/Ubuntu-agent/env',
+    'python_modules': [
+        'billiard==2.7.3.28',
+        'celery==3.1.17',
+        'pika',
+        'https://github.com/cloudify-cosmo/cloudify-rest-client/archive/'
+        'master.tar.gz',
+        'https://github.com/cloudify-cosmo/cloudify-plugins-common/archive/'
+        'master.tar.gz',
+        '/Ubuntu-agent/env/cloudify-manager-master/plugins/agent-installer/',
+        '/Ubuntu-agent/env/cloudify-manager-master/plugins/'
+        'plugin-installer/',
+        '/Ubuntu-agent/env/cloudify-manager-master/plugins/'
+        'windows-agent-installer/',
+    ],
+    'source_package_type': 'dir',
+    'destination_package_types': ['tar.gz'],
+}
+
+
+def _make_archive(files):
+    """Returns a tar.gz archive of files, given as paths to their contents
+    """
+    data = StringIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as archive:
+        for path, content in sorted(files.items()):
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            archive.addfile(info, StringIO(content))
+    return data.getvalue()
+
+
+class _Response(StringIO):
+    """A response to a request of `urllib2.urlopen`
+    """
+    def __init__(self, data, length=None):
+        StringIO.__init__(self, data)
+        self.length = len(data) if length is None else length
+
+    def info(self):
+        headers = mock.Mock()
+        headers.getheader.side_effect = lambda name, default=None: \
+            str(self.length) if name == 'content-length' else default
+        return headers
+
+
+class ModulesTests(testtools.TestCase):
+    """Tests reading the modules of package configs"""
+
+    def setUp(self):
+        super(ModulesTests, self).setUp()
+        self.package = copy.deepcopy(UBUNTU_TRUSTY_AGENT)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        handler = mock.patch.object(get.python, 'Handler')
+        self.handler = handler.start().return_value
+        self.addCleanup(handler.stop)
+
+    def _relocated_modules(self, sources_path):
+        return [module.replace('/Ubuntu-agent/env', sources_path)
+                for module in UBUNTU_TRUSTY_AGENT['python_modules']]
+
+    def test_get_modules(self):
+        self.assertEqual(UBUNTU_TRUSTY_AGENT['python_modules'],
+                         get._get_modules(self.package))
+        self.package['modules'] = self.package.pop('python_modules')
+        self.assertEqual(UBUNTU_TRUSTY_AGENT['python_modules'],
+                         get._get_modules(self.package))
+        del self.package['modules']
+        self.assertEqual([], get._get_modules(self.package))
+
+    def test_build_agent_config(self):
+        sources_path = os.path.join(self.tempdir, 'env')
+        get._relocate_sources(self.package, sources_path)
+        self.package['package_path'] = os.path.join(self.tempdir, 'package')
+        with mock.patch.object(get, 'fetch_sources'), \
+                mock.patch.object(get, '_prepare'), \
+                mock.patch.object(get, '_fingerprint_sources',
+                                  return_value='sources'), \
+                mock.patch.object(get, 'install_modules') as install:
+            get.build_package(self.package)
+        install.assert_called_once_with(
+            self._relocated_modules(sources_path), sources_path)
+
+    def test_time_agent_config_installs(self):
+        with mock.patch.object(get, 'build_package'), \
+                mock.patch.object(get, 'install_modules') as install, \
+                mock.patch('tempfile.mkdtemp', return_value=self.tempdir), \
+                mock.patch('shutil.rmtree'):
+            timings = get.time_module_installs(self.package)
+        self.assertEqual(['per-module', 'batched'], timings.keys())
+        modules = self._relocated_modules(
+            os.path.join(self.tempdir, 'sources'))
+        self.assertEqual(
+            [mock.call(module, os.path.join(self.tempdir, 'per-module'))
+             for module in modules],
+            self.handler.pip.call_args_list)
+        install.assert_called_once_with(
+            modules, os.path.join(self.tempdir, 'batched'),
+            cache_dir=os.path.join(self.tempdir, 'batched-cache'))
+
+
+class BuildManifestTests(testtools.TestCase):
+    """Tests the records of package builds"""
+
+    def setUp(self):
+        super(BuildManifestTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.sources_path = os.path.join(self.tempdir, 'env')
+
+    def test_path_beside_sources_path(self):
+        manifest = get.BuildManifest(self.sources_path + '/')
+        self.assertEqual(self.sources_path + '.build.json', manifest.path)
+
+    def test_steps_persisted(self):
+        manifest = get.BuildManifest(self.sources_path)
+        self.assertEqual({}, manifest.steps)
+        manifest.update('config', 'a')
+        manifest.update('modules', ['pika'])
+        manifest = get.BuildManifest(self.sources_path)
+        self.assertTrue(manifest.matches('config', 'a'))
+        self.assertFalse(manifest.matches('config', 'b'))
+        self.assertFalse(manifest.matches('sources', 'a'))
+        self.assertEqual(['pika'], manifest.steps['modules'])
+
+    def test_unknown_fingerprint_never_matches(self):
+        manifest = get.BuildManifest(self.sources_path)
+        manifest.update('sources', None)
+        self.assertFalse(manifest.matches('sources', None))
+
+    def test_clear(self):
+        manifest = get.BuildManifest(self.sources_path)
+        manifest.update('config', 'a')
+        manifest.clear()
+        self.assertEqual({}, get.BuildManifest(self.sources_path).steps)
+
+    def test_force_disregards_previous_builds(self):
+        get.BuildManifest(self.sources_path).update('config', 'a')
+        self.assertEqual(
+            {}, get.BuildManifest(self.sources_path, force=True).steps)
+
+    def test_corrupt_manifest_disregarded(self):
+        with open(self.sources_path + '.build.json', 'w') as f:
+            f.write('{"config": ')
+        self.assertEqual({}, get.BuildManifest(self.sources_path).steps)
+
+
+class IncrementalBuildTests(testtools.TestCase):
+    """Tests when build_package rebuilds a package's virtualenv"""
+
+    def setUp(self):
+        super(IncrementalBuildTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.package = {
+            'name': 'agent',
+            'sources_path': os.path.join(self.tempdir, 'env'),
+            'package_path': os.path.join(self.tempdir, 'package'),
+            'source_urls': ['http://example.com/sources.tar.gz'],
+            'python_modules': ['pika', 'celery==3.1.17'],
+        }
+        self.etag = '"1"'
+        for name, kwargs in (
+                ('_prepare', {'side_effect': lambda package: shutil.rmtree(
+                    package['sources_path'], True)}),
+                ('fetch_sources', {}),
+                ('install_modules', {}),
+                ('_resolve_etag', {'side_effect': lambda url: self.etag})):
+            patcher = mock.patch.object(get, name, **kwargs)
+            setattr(self, name.lstrip('_'), patcher.start())
+            self.addCleanup(patcher.stop)
+        handler = mock.patch.object(get.python, 'Handler')
+        self.make_venv = handler.start().return_value.make_venv
+        self.make_venv.side_effect = self._make_venv
+        self.addCleanup(handler.stop)
+        self._build()
+
+    def _make_venv(self, sources_path):
+        os.makedirs(os.path.join(sources_path, 'bin'))
+        open(os.path.join(sources_path, 'bin', 'python'), 'w').close()
+
+    def _build(self, force=False):
+        """Builds the package, returning whether its virtualenv was
+        rebuilt and the modules installed into it
+        """
+        for mocked in (self.make_venv, self.install_modules):
+            mocked.reset_mock()
+        get.build_package(self.package, force=force)
+        installed = []
+        if self.install_modules.called:
+            installed = self.install_modules.call_args[0][0]
+        return self.make_venv.called, installed
+
+    def test_up_to_date(self):
+        self.assertEqual((False, []), self._build())
+
+    def test_module_added(self):
+        self.package['python_modules'].append('billiard==2.7.3.28')
+        self.assertEqual((False, ['billiard==2.7.3.28']), self._build())
+
+    def test_config_changed(self):
+        self.package['version'] = '3.3.1'
+        self.assertEqual((True, ['pika', 'celery==3.1.17']), self._build())
+
+    def test_etag_changed(self):
+        self.etag = '"2"'
+        self.assertEqual((True, ['pika', 'celery==3.1.17']), self._build())
+
+    def test_etag_unknown(self):
+        self.etag = None
+        self.assertEqual((True, ['pika', 'celery==3.1.17']), self._build())
+
+    def test_module_removed(self):
+        self.package['python_modules'].remove('pika')
+        self.assertEqual((True, ['celery==3.1.17']), self._build())
+
+    def test_force(self):
+        self.assertEqual((True, ['pika', 'celery==3.1.17']),
+                         self._build(force=True))
+
+    def test_virtualenv_removed(self):
+        shutil.rmtree(self.package['sources_path'])
+        self.assertEqual((True, ['pika', 'celery==3.1.17']), self._build())
+
+    def test_virtualenv_interpreter_removed(self):
+        os.remove(os.path.join(self.package['sources_path'], 'bin', 'python'))
+        self.assertEqual((True, ['pika', 'celery==3.1.17']), self._build())
+
+
+class FetchSourcesTests(testtools.TestCase):
+    """Tests fetching and extracting the sources of packages"""
+
+    def setUp(self):
+        super(FetchSourcesTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.sources_path = os.path.join(self.tempdir, 'env')
+        os.makedirs(os.path.join(self.sources_path, 'archives'))
+        self.package = {
+            'sources_path': self.sources_path,
+            'source_urls': ['http://example.com/manager.tar.gz',
+                            'http://example.com/plugins.tar.gz'],
+        }
+        self.archives = {
+            'http://example.com/manager.tar.gz': _make_archive({
+                'cloudify-manager-master/setup.py': 'manager',
+                'cloudify-manager-master/rest-service/setup.py': 'rest'}),
+            'http://example.com/plugins.tar.gz': _make_archive({
+                'cloudify-manager-master/plugins/setup.py': 'plugins'}),
+        }
+        self.urlopen = self._patch('urllib2.urlopen',
+                                   side_effect=self._urlopen)
+        self._patch('get._resolve_etag', return_value='"1"')
+        self._patch('get._fetcher',
+                    get.SourceFetcher(os.path.join(self.tempdir, 'cache')))
+
+    def _patch(self, target, new=mock.DEFAULT, **kwargs):
+        patcher = mock.patch(target, new, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def _urlopen(self, url, timeout=None):
+        return _Response(self.archives[url])
+
+    def _read(self, path):
+        with open(os.path.join(self.sources_path, path)) as f:
+            return f.read()
+
+    def test_archives_extracted_concurrently(self):
+        # both archives are downloaded (and extracted) at once.
+        opened = threading.Event()
+
+        def urlopen(url, timeout=None):
+            if self.urlopen.call_count == len(self.archives):
+                opened.set()
+            opened.wait(10)
+            return _Response(self.archives[url])
+        self.urlopen.side_effect = urlopen
+
+        archives = get.fetch_sources(self.package)
+        self.assertTrue(opened.is_set())
+        self.assertEqual(2, len(archives))
+        self.assertEqual('manager',
+                         self._read('cloudify-manager-master/setup.py'))
+        self.assertEqual('rest', self._read(
+            'cloudify-manager-master/rest-service/setup.py'))
+        self.assertEqual(
+            'plugins', self._read('cloudify-manager-master/plugins/setup.py'))
+        self.assertEqual(['archives', 'cloudify-manager-master'],
+                         sorted(os.listdir(self.sources_path)))
+
+    def test_failed_download_leaves_nothing_behind(self):
+        url = 'http://example.com/manager.tar.gz'
+        self.urlopen.side_effect = lambda url, timeout=None: _Response(
+            self.archives[url], length=len(self.archives[url]) + 1)
+        archive = os.path.join(self.sources_path, 'archives', 'manager')
+        self.assertRaises(IOError, get._fetcher.fetch,
+                          url, archive, self.sources_path)
+        self.assertEqual(['archives'], os.listdir(self.sources_path))
+        self.assertEqual([], os.listdir(os.path.join(
+            self.sources_path, 'archives')))
+        self.assertEqual([], [name for name in os.listdir(
+            get._fetcher.cache_dir) if not name.endswith('.lock')])
+
+
+class _RedirectingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Redirects /source.tar.gz to /archive/master.tar.gz, recording the
+    methods of the requests made
+    """
+    def do_HEAD(self):
+        self.server.requests.append((self.command, self.path))
+        if self.path == '/source.tar.gz':
+            self.send_response(302)
+            self.send_header('Location', '/archive/master.tar.gz')
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"master"')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ResolveEtagTests(testtools.TestCase):
+    """Tests resolving the ETags of sources"""
+
+    def setUp(self):
+        super(ResolveEtagTests, self).setUp()
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), _RedirectingHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(get._etags.clear)
+
+    def test_redirects_followed_with_head_requests(self):
+        url = 'http://127.0.0.1:{0}/source.tar.gz'.format(
+            self.server.server_port)
+        self.assertEqual('"master"', get._resolve_etag(url))
+        self.assertEqual('"master"', get._resolve_etag(url))
+        self.assertEqual([('HEAD', '/source.tar.gz'),
+                          ('HEAD', '/archive/master.tar.gz')],
+                         self.server.requests)
+
+
+class SourceFetcherTests(testtools.TestCase):
+    """Tests fetching each source of a build once"""
+
+    def setUp(self):
+        super(SourceFetcherTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.archive = _make_archive({'source/setup.py': 'source'})
+        self.etag = '"1"'
+        for target, kwargs in (
+                ('urllib2.urlopen', {'side_effect': lambda url, timeout:
+                                     _Response(self.archive)}),
+                ('get._resolve_etag', {'side_effect': lambda url:
+                                       self.etag})):
+            patcher = mock.patch(target, **kwargs)
+            self.addCleanup(patcher.stop)
+            setattr(self, target.split('.')[-1].lstrip('_'),
+                    patcher.start())
+        self.fetcher = get.SourceFetcher(os.path.join(self.tempdir, 'cache'))
+        self.url = 'http://example.com/source.tar.gz'
+
+    def _fetch(self, name, extract=False):
+        destination = os.path.join(self.tempdir, name)
+        extract_dir = None
+        if extract:
+            extract_dir = os.path.join(self.tempdir, '{0}-env'.format(name))
+            os.makedirs(extract_dir)
+        self.fetcher.fetch(self.url, destination, extract_dir)
+        with open(destination, 'rb') as f:
+            self.assertEqual(self.archive, f.read())
+        if extract:
+            with open(os.path.join(extract_dir, 'source', 'setup.py')) as f:
+                self.assertEqual('source', f.read())
+
+    def test_fetched_once(self):
+        self._fetch('a', extract=True)
+        self._fetch('b', extract=True)
+        self._fetch('c')
+        self.assertEqual(1, self.urlopen.call_count)
+        self.assertEqual(len(self.archive), self.fetcher.downloaded_bytes)
+        self.assertEqual(2 * len(self.archive),
+                         self.fetcher.deduplicated_bytes)
+
+    def test_fetched_once_concurrently(self):
+        threads = [threading.Thread(target=self._fetch, args=(name,))
+                   for name in 'abcd']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, self.urlopen.call_count)
+        self.assertEqual(len(self.archive), self.fetcher.downloaded_bytes)
+
+    def test_updated_source_fetched_again(self):
+        self._fetch('a')
+        self.etag = '"2"'
+        self._fetch('b')
+        self.assertEqual(2, self.urlopen.call_count)
+
+    def test_source_without_etag_fetched_once(self):
+        self.etag = None
+        self._fetch('a')
+        self._fetch('b')
+        self.assertEqual(1, self.urlopen.call_count)
+
+    def test_fetchers_share_cache(self):
+        self._fetch('a')
+        self.fetcher = get.SourceFetcher(self.fetcher.cache_dir)
+        self._fetch('b')
+        self.assertEqual(1, self.urlopen.call_count)
+        self.assertEqual(0, self.fetcher.downloaded_bytes)
+
+
+class IsolateSourcesTests(testtools.TestCase):
+    """Tests giving agents sources paths of their own"""
+
+    def setUp(self):
+        super(IsolateSourcesTests, self).setUp()
+        self.packages = collections.OrderedDict([
+            ('ubuntu-precise', {
+                'sources_path': '/Ubuntu-agent/env',
+                'python_modules': [
+                    'pika',
+                    '/Ubuntu-agent/env/cloudify-manager-master/plugins/a/',
+                    '/Ubuntu-agent/env2/plugins/a/'],
+            }),
+            ('ubuntu-trusty', copy.deepcopy(UBUNTU_TRUSTY_AGENT)),
+            ('centos-final', {
+                'sources_path': '/centos-agent/env/',
+                'modules': ['/centos-agent/env/plugins/a/'],
+            }),
+        ])
+
+    def test_shared_sources_paths_isolated(self):
+        get._isolate_sources(self.packages)
+        precise = self.packages['ubuntu-precise']
+        self.assertEqual('/Ubuntu-agent/env-ubuntu-precise',
+                         precise['sources_path'])
+        self.assertEqual(
+            ['pika',
+             '/Ubuntu-agent/env-ubuntu-precise/cloudify-manager-master/'
+             'plugins/a/',
+             '/Ubuntu-agent/env2/plugins/a/'],
+            precise['python_modules'])
+        trusty = self.packages['ubuntu-trusty']
+        self.assertEqual('/Ubuntu-agent/env-ubuntu-trusty',
+                         trusty['sources_path'])
+        self.assertEqual(
+            '/Ubuntu-agent/env-ubuntu-trusty/cloudify-manager-master/'
+            'plugins/agent-installer/', trusty['python_modules'][5])
+        self.assertEqual(UBUNTU_TRUSTY_AGENT['python_modules'][:5],
+                         trusty['python_modules'][:5])
+        # centos-final doesn't share its sources path.
+        self.assertEqual({'sources_path': '/centos-agent/env/',
+                          'modules': ['/centos-agent/env/plugins/a/']},
+                         self.packages['centos-final'])
+
+    def test_sources_root(self):
+        get._isolate_sources(self.packages, '/build')
+        self.assertEqual(
+            ['/build/ubuntu-precise/env', '/build/ubuntu-trusty/env',
+             '/build/centos-final/env'],
+            [package['sources_path'] for package in self.packages.values()])
+        self.assertEqual(['/build/centos-final/env/plugins/a/'],
+                         self.packages['centos-final']['modules'])
+        self.assertEqual(
+            '/build/ubuntu-precise/env/cloudify-manager-master/plugins/a/',
+            self.packages['ubuntu-precise']['python_modules'][1])
+
+    def test_relocate_sources(self):
+        package = {'sources_path': '/env',
+                   'python_modules': ['/env', '/env/a', '/envy/a', 'a']}
+        get._relocate_sources(package, '/build/env')
+        self.assertEqual('/build/env', package['sources_path'])
+        self.assertEqual(['/env', '/build/env/a', '/envy/a', 'a'],
+                         package['python_modules'])
+
+
+class InstallModulesTests(testtools.TestCase):
+    """Tests installing modules in a single pip run"""
+
+    def setUp(self):
+        super(InstallModulesTests, self).setUp()
+        self.modules = [
+            'billiard==2.7.3.28',
+            'celery==3.1.17',
+            'pika',
+            'requests>=2.7.0,<3.0.0',
+            'pyzmq==14.3.1; python_version < "3"',
+            'https://github.com/cloudify-cosmo/cloudify-rest-client/'
+            'archive/master.tar.gz',
+            '/Ubuntu-agent/env/cloudify-manager-master/plugins/'
+            'agent-installer/',
+        ]
+
+    def test_get_pins(self):
+        self.assertEqual(['billiard==2.7.3.28', 'celery==3.1.17'],
+                         get._get_pins(self.modules))
+
+    def test_install_command(self):
+        files = {}
+
+        def check_call(cmd):
+            for option in ('-r', '-c'):
+                with open(cmd[cmd.index(option) + 1]) as f:
+                    files[option] = f.read()
+            self.assertEqual(
+                ['/env/bin/pip', 'install',
+                 '-r', os.path.join(self.tempdir, 'requirements.txt'),
+                 '-c', os.path.join(self.tempdir, 'constraints.txt'),
+                 '--cache-dir', '/cache'],
+                cmd)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir, True)
+        with mock.patch('tempfile.mkdtemp', return_value=self.tempdir), \
+                mock.patch('subprocess.check_call',
+                           side_effect=check_call) as call:
+            get.install_modules(self.modules, '/env', cache_dir='/cache')
+        self.assertEqual(1, call.call_count)
+        self.assertEqual(''.join(
+            '{0}\n'.format(module) for module in self.modules), files['-r'])
+        self.assertEqual('billiard==2.7.3.28\ncelery==3.1.17\n', files['-c'])
+        self.assertFalse(os.path.exists(self.tempdir))
+
+
+def _create_agent(package, download, force):
+    """Builds an agent, exiting (or failing) as its package tells to
+    """
+    if package.get('exit') is not None:
+        sys.exit(package['exit'])
+    if package.get('fail'):
+        raise ValueError(package['fail'])
+
+
+class BuildAgentsTests(testtools.TestCase):
+    """Tests building agents concurrently"""
+
+    def setUp(self):
+        super(BuildAgentsTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.packages = {
+            'Ubuntu-precise-agent': {},
+            'Ubuntu-trusty-agent': {'exit': 0},
+            'centos-Final-agent': {'exit': 3},
+            'debian-jessie-agent': {'fail': 'no debian'},
+        }
+        for name, kwargs in (
+                ('get_conf', {'side_effect': lambda name: dict(
+                    self.packages[name], sources_path='/{0}/env'.format(
+                        name))}),
+                ('create_agent', {'side_effect': _create_agent})):
+            patcher = mock.patch.object(get, name, **kwargs)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+    def _build_agents(self, agents, **kwargs):
+        # workers redirect their output to their logs, which nose's
+        # captured output can't be.
+        with mock.patch('sys.stdout', sys.__stdout__):
+            return get.build_agents(
+                agents, log_dir=os.path.join(self.tempdir, 'logs'), **kwargs)
+
+    def test_exit_codes(self):
+        agents = list(reversed(get.AGENTS))
+        codes = self._build_agents(agents, jobs=2)
+        self.assertEqual(
+            [('debian-jessie', 1), ('centos-final', 3),
+             ('ubuntu-trusty', 0), ('ubuntu-precise', 0)],
+            codes.items())
+        with open(os.path.join(
+                self.tempdir, 'logs', 'debian-jessie.log')) as f:
+            self.assertIn('ValueError: no debian', f.read())
+
+    def test_exit_message_code(self):
+        self.packages['centos-Final-agent']['exit'] = 'no centos'
+        self.assertEqual({'centos-final': 1},
+                         dict(self._build_agents(['centos-final'])))
+
+    def test_main_exit_code(self):
+        for codes, expected in (({'ubuntu-trusty': 0}, 0),
+                                ({'ubuntu-trusty': 0, 'centos-final': 3}, 1)):
+            with mock.patch.object(get, 'build_agents',
+                                   return_value=codes):
+                ex = self.assertRaises(SystemExit, get.main,
+                                       ['ubuntu-trusty', 'centos-final'])
+            self.assertEqual(expected, ex.code)